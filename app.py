@@ -1,10 +1,15 @@
 # app.py
 import json
+import pandas as pd
 import streamlit as st
-from datetime import datetime
-from backend.s3_alerts import get_latest_alert, get_all_alerts
-from backend.s3_triggers import TRIGGER_LABELS, send_trigger_txt, get_related_message
-from backend.email_ses import send_email
+from datetime import datetime, time, timedelta, timezone
+from time import monotonic
+from backend.s3_alerts import (
+    PresignCache, alerts_version, get_latest_alert, get_alerts_page, get_alerts_after, get_tenants,
+)
+from backend.s3_triggers import TRIGGER_LABELS, TRIGGER_MAP, send_trigger_txt, get_related_message
+from backend.email_ses import send_alert_digest
+from backend.rollups import READINGS_KEY, RESOLUTIONS, SIGNALS, auto_resolution, get_trends
 
 # ================== PAGE ==================
 st.set_page_config(page_title="Caseiro 2o - Alerts", page_icon="🐔", layout="centered")
@@ -34,6 +39,29 @@ SES_RECIPIENTS = st.secrets.get("SES_RECIPIENTS", "")    # ex.: "maintenance@com
 # Presigned URL validity (minutes)
 PRESIGN_MINS = 30
 
+# Alerts per page in "Get all messages"
+PAGE_SIZE = 20
+
+# Cache (seconds). Alert data is also invalidated as soon as _latest.json changes.
+VERSION_TTL = 5     # how often the change signal (HEAD _latest.json) is checked
+ALERTS_TTL  = 300
+
+# Seconds to wait for a related message after sending a trigger
+RELATED_WAIT = 10
+
+# Known farms/houses (from the Lambda's tenant markers)
+TENANTS_TTL = 60
+
+# Live feed: polls every FEED_MIN_INTERVAL s, backing off (x2) up to FEED_MAX_INTERVAL while idle
+FEED_MIN_INTERVAL = 5
+FEED_MAX_INTERVAL = 60
+FEED_MAX_ITEMS    = 50
+FEED_FIRST_LOAD   = 5
+
+# Trends (rollups written by the Lambda; see backend/rollups.py)
+TRENDS_TTL  = 60
+TRENDS_DAYS = 30     # default period
+
 # ================== HELPERS ==================
 def _pretty_json(data: dict) -> str:
     return json.dumps(data, indent=2, ensure_ascii=False)
@@ -42,11 +70,168 @@ def _fmt_dt(dt: datetime) -> tuple[str, str]:
     # returns (YYYY-MM-DD, HH:MM:SS)
     return dt.strftime("%Y-%m-%d"), dt.strftime("%H:%M:%S")
 
+# Cached reads: shared by every session; the version argument changes when the
+# Lambda writes a new alert, which makes Streamlit miss the cache and refetch.
+@st.cache_data(ttl=VERSION_TTL, show_spinner=False)
+def _alerts_version() -> str:
+    return alerts_version(ALERTS_KEY, ALERTS_SECRET, ALERTS_REGION, ALERTS_BUCKET, ALERTS_PREFIX)
+
+@st.cache_data(ttl=ALERTS_TTL, show_spinner=False)
+def _cached_latest(version: str) -> dict:
+    return get_latest_alert(
+        aws_key=ALERTS_KEY,
+        aws_secret=ALERTS_SECRET,
+        region=ALERTS_REGION,
+        bucket=ALERTS_BUCKET,
+        prefix=ALERTS_PREFIX,
+        presign_mins=PRESIGN_MINS,
+    )
+
+@st.cache_data(ttl=TENANTS_TTL, show_spinner=False)
+def _cached_tenants() -> list:
+    return get_tenants(ALERTS_KEY, ALERTS_SECRET, ALERTS_REGION, ALERTS_BUCKET, ALERTS_PREFIX)
+
+@st.cache_data(ttl=ALERTS_TTL, show_spinner=False)
+def _cached_page(version: str, cursor, since, until, trigger_keys, tenants) -> dict:
+    return get_alerts_page(
+        aws_key=ALERTS_KEY,
+        aws_secret=ALERTS_SECRET,
+        region=ALERTS_REGION,
+        bucket=ALERTS_BUCKET,
+        prefix=ALERTS_PREFIX,
+        page_size=PAGE_SIZE,
+        cursor=cursor,
+        since=since,
+        until=until,
+        trigger_keys=list(trigger_keys) or None,
+        tenants=[tuple(t.split("/", 1)) for t in tenants] or None,
+    )
+
+def _related_message(trigger_key: str, sent_at: str | None = None):
+    # with sent_at, waits (bounded) for a message written after the trigger was sent
+    return get_related_message(
+        aws_key=TRIG_KEY,
+        aws_secret=TRIG_SECRET,
+        region=TRIG_REGION,
+        bucket=TRIG_BUCKET,
+        trigger_key=trigger_key,
+        # will look in messages/<trigger_key>/ and info/<trigger_key>/ by default
+        search_prefixes=None,
+        newer_than=sent_at,
+        wait_s=RELATED_WAIT if sent_at else 0,
+    )
+
+@st.cache_data(ttl=ALERTS_TTL, show_spinner=False)
+def _cached_after(version: str, after, limit: int) -> dict:
+    # keyed by (version, cursor): sessions at the same cursor share one read per new alert
+    return get_alerts_after(
+        aws_key=ALERTS_KEY,
+        aws_secret=ALERTS_SECRET,
+        region=ALERTS_REGION,
+        bucket=ALERTS_BUCKET,
+        prefix=ALERTS_PREFIX,
+        after=after,
+        limit=limit,
+    )
+
+def _poll_feed():
+    # only reads S3 when _latest.json changed; idle polls back off up to FEED_MAX_INTERVAL
+    ss = st.session_state
+    now = monotonic()
+    if now < ss.get("feed_next_poll", 0.0):
+        return
+    interval = ss.get("feed_interval", FEED_MIN_INTERVAL)
+    version = _alerts_version()
+    new_items = []
+    if version and version != ss.get("feed_version"):
+        first = "feed_after" not in ss
+        page = _cached_after(version, ss.get("feed_after"), FEED_FIRST_LOAD if first else FEED_MAX_ITEMS)
+        new_items = page["items"]
+        ss["feed_after"] = page["after"]
+        ss["feed_version"] = version
+        if new_items:
+            # the cursor re-lists a short lag window, so a late part may repeat an alert already shown
+            fresh = {item["key"] for item in new_items}
+            older = [item for item in ss.get("feed_items", []) if item["key"] not in fresh]
+            ss["feed_items"] = (new_items + older)[:FEED_MAX_ITEMS]
+            if not first:
+                st.toast(f"{len(new_items)} new alert(s)")
+    interval = FEED_MIN_INTERVAL if new_items else min(interval * 2, FEED_MAX_INTERVAL)
+    ss["feed_interval"] = interval
+    ss["feed_next_poll"] = now + interval
+
+@st.cache_data(ttl=TRENDS_TTL, show_spinner=False)
+def _cached_trends(tenants, resolution, since, until, series, signal) -> list:
+    return get_trends(
+        aws_key=ALERTS_KEY,
+        aws_secret=ALERTS_SECRET,
+        region=ALERTS_REGION,
+        bucket=ALERTS_BUCKET,
+        prefix=ALERTS_PREFIX,
+        tenants=[tuple(t.split("/", 1)) for t in tenants],
+        resolution=resolution,
+        start=since,
+        end=until,
+        trigger_keys=list(series) or None,
+        signal=signal,
+    )
+
+def _trend_frames(points: list) -> tuple[pd.DataFrame, pd.DataFrame]:
+    # (events per series, min/mean/max of the signal over all selected series)
+    events = pd.DataFrame(
+        [{"time": p["time"], "series": p["trigger_key"], "events": p["events"]} for p in points if p["events"]],
+        columns=["time", "series", "events"],
+    ).pivot_table(index="time", columns="series", values="events", aggfunc="sum", fill_value=0)
+    readings = pd.DataFrame(
+        [{"time": p["time"], "n": p["n"], "sum": p["mean"] * p["n"], "min": p["min"], "max": p["max"]}
+         for p in points if p["n"]],
+        columns=["time", "n", "sum", "min", "max"],
+    ).groupby("time").agg({"n": "sum", "sum": "sum", "min": "min", "max": "max"})
+    readings["mean"] = readings["sum"] / readings["n"]
+    return events, readings[["min", "mean", "max"]]
+
+def _load_alerts_page(cursor=None) -> dict:
+    # filters come from the widgets in "Filters" (session_state keys)
+    days = st.session_state.get("filter_days") or ()
+    since = datetime.combine(days[0], time.min, tzinfo=timezone.utc) if len(days) > 0 else None
+    until = datetime.combine(days[-1], time.max, tzinfo=timezone.utc) if len(days) > 0 else None
+    triggers = tuple(st.session_state.get("filter_triggers") or ())
+    tenants = tuple(st.session_state.get("filter_tenants") or ())
+    # pages after the first are keyed by cursor, so they stay valid across versions
+    version = _alerts_version() if cursor is None else ""
+    return _cached_page(version, cursor, since, until, triggers, tenants)
+
+def _presigner() -> PresignCache:
+    # one cache per browser session; URLs are reused until close to expiry
+    if "presigner" not in st.session_state:
+        st.session_state["presigner"] = PresignCache(ALERTS_KEY, ALERTS_SECRET, ALERTS_REGION, PRESIGN_MINS)
+    return st.session_state["presigner"]
+
+def _presigned_link(item: dict, widget_key: str):
+    # compacted alerts live inside a segment, so there is no object of their own to sign
+    if item.get("segment"):
+        st.download_button(
+            "Download JSON", _pretty_json(item["data"]), file_name=item["key"].rsplit("/", 1)[-1],
+            mime="application/json", key=widget_key,
+        )
+        return
+    # the URL is only signed when the user asks for it
+    key = item["key"]
+    opened = st.session_state.setdefault("opened_links", set())
+    if key in opened:
+        st.link_button("Open (pre-signed) ↗", _presigner().url(ALERTS_BUCKET, key))
+    elif st.button("Get pre-signed link", key=widget_key):
+        opened.add(key)
+        st.rerun()
+
 # ================== SECTION: TRIGGER ==================
 st.subheader("Trigger")
 st.caption("Select a trigger and send it to S3 (aviario-metrics). If a related message exists, it will be fetched and shown below.")
 
 chosen = st.selectbox("Trigger", options=TRIGGER_LABELS, index=0)
+f1, f2 = st.columns(2)
+farm_id = f1.text_input("Farm", value="default")
+house_id = f2.text_input("House", value="default")
 
 if st.button("Send trigger", use_container_width=True):
     try:
@@ -57,23 +242,22 @@ if st.button("Send trigger", use_container_width=True):
             bucket=TRIG_BUCKET,
             trigger_label=chosen,
             prefix=TRIG_PREFIX,
+            farm_id=farm_id,
+            house_id=house_id,
         )
         st.success(f"Trigger sent: s3://{TRIG_BUCKET}/{sent['s3_key']}")
         st.code(sent["content"], language="text")
 
-        related = get_related_message(
-            aws_key=TRIG_KEY,
-            aws_secret=TRIG_SECRET,
-            region=TRIG_REGION,
-            bucket=TRIG_BUCKET,
-            trigger_key=sent["trigger_key"],
-            # will look in messages/<trigger_key>/ and info/<trigger_key>/ by default
-            search_prefixes=None,
-        )
+        with st.spinner("Waiting for a related message…"):
+            related = _related_message(sent["trigger_key"], sent["timestamp"])
         if related:
             st.info("Related message found:")
             st.caption(f"s3://{TRIG_BUCKET}/{related['s3_key']}")
             st.code(related["content"], language="text")
+        elif (earlier := _related_message(sent["trigger_key"])):
+            st.warning("No new related message yet. Most recent one:")
+            st.caption(f"s3://{TRIG_BUCKET}/{earlier['s3_key']}")
+            st.code(earlier["content"], language="text")
         else:
             st.warning("No related message found yet.")
     except Exception as e:
@@ -81,21 +265,47 @@ if st.button("Send trigger", use_container_width=True):
 
 st.markdown("---")
 
+# ================== SECTION: LIVE FEED ==================
+st.subheader("Live feed")
+
+@st.fragment(run_every=FEED_MIN_INTERVAL)
+def _live_feed():
+    if not st.toggle("Auto-refresh", value=True, key="feed_on"):
+        st.caption("Paused.")
+        return
+    try:
+        _poll_feed()
+    except Exception as e:
+        st.error(str(e))
+    items = st.session_state.get("feed_items", [])
+    if not items:
+        st.caption("Waiting for alerts…")
+    for msg in items[:10]:
+        date_str, time_str = _fmt_dt(msg["ts"])
+        st.markdown(f"**{date_str} {time_str}** — {msg['data'].get('alert', '—')}")
+    st.caption(f"Next check in ≤ {st.session_state.get('feed_interval', FEED_MIN_INTERVAL)} s.")
+
+_live_feed()
+
+st.markdown("---")
+
 # ================== SECTION: ALERT MESSAGES ==================
 st.subheader("Alert messages")
 
+with st.expander("Filters"):
+    st.multiselect("Trigger types", options=[k for k, _ in TRIGGER_MAP.values()], key="filter_triggers")
+    try:
+        tenant_options = [f"{f}/{h}" for f, h in _cached_tenants()]
+    except Exception:
+        tenant_options = []
+    st.multiselect("Farm / house", options=tenant_options, key="filter_tenants")
+    st.date_input("Period (UTC)", value=(), key="filter_days")
+
 c1, c2 = st.columns(2)
 with c1:
     if st.button("Get latest message", use_container_width=True):
         try:
-            latest = get_latest_alert(
-                aws_key=ALERTS_KEY,
-                aws_secret=ALERTS_SECRET,
-                region=ALERTS_REGION,
-                bucket=ALERTS_BUCKET,
-                prefix=ALERTS_PREFIX,
-                presign_mins=PRESIGN_MINS,
-            )
+            latest = _cached_latest(_alerts_version())
             st.session_state["latest_alert"] = latest
             st.session_state["all_alerts"] = None
             st.success("Latest message loaded.")
@@ -105,19 +315,12 @@ with c1:
 with c2:
     if st.button("Get all messages", use_container_width=True):
         try:
-            all_msgs = get_all_alerts(
-                aws_key=ALERTS_KEY,
-                aws_secret=ALERTS_SECRET,
-                region=ALERTS_REGION,
-                bucket=ALERTS_BUCKET,
-                prefix=ALERTS_PREFIX,
-                presign_mins=PRESIGN_MINS,
-                limit=None,  # set int to cap results
-            )
-            st.session_state["all_alerts"] = all_msgs
+            page = _load_alerts_page()
+            st.session_state["all_alerts"] = page["items"]
+            st.session_state["alerts_cursor"] = page["next_cursor"]
             st.session_state["latest_alert"] = None
-            if all_msgs:
-                st.success(f"Loaded {len(all_msgs)} message(s).")
+            if page["items"]:
+                st.success(f"Loaded {len(page['items'])} message(s).")
             else:
                 st.info("No messages found.")
         except Exception as e:
@@ -131,8 +334,8 @@ if st.session_state.get("latest_alert"):
     st.write(item["data"].get("alert", "—"))
     with st.expander("Raw JSON"):
         st.code(_pretty_json(item["data"]), language="json")
-    st.caption(f"Source: s3://{ALERTS_BUCKET}/{item['key']}")
-    st.link_button("Open (pre-signed)", item["presigned_url"])
+    st.caption(f"Source: s3://{ALERTS_BUCKET}/{item.get('segment') or item['key']}")
+    _presigned_link(item, "link_latest")
 
 elif st.session_state.get("all_alerts"):
     items = st.session_state["all_alerts"]
@@ -141,12 +344,74 @@ elif st.session_state.get("all_alerts"):
         for i, msg in enumerate(items, start=1):
             date_str, time_str = _fmt_dt(msg["ts"])
             with st.container(border=True):
-                st.markdown(f"**#{i} — {date_str} {time_str}**")
+                where = f" · {msg['data']['farm_id']}/{msg['data'].get('house_id', '')}" if msg["data"].get("farm_id") else ""
+                st.markdown(f"**#{i} — {date_str} {time_str}**{where}")
                 st.write(msg["data"].get("alert", "—"))
                 with st.expander("Raw JSON"):
                     st.code(_pretty_json(msg["data"]), language="json")
-                st.caption(f"Source: s3://{ALERTS_BUCKET}/{msg['key']}")
-                st.link_button("Open (pre-signed)", msg["presigned_url"])
+                st.caption(f"Source: s3://{ALERTS_BUCKET}/{msg.get('segment') or msg['key']}")
+                _presigned_link(msg, f"link_{i}")
+
+        if st.session_state.get("alerts_cursor"):
+            if st.button("Load more", use_container_width=True):
+                try:
+                    page = _load_alerts_page(st.session_state["alerts_cursor"])
+                    st.session_state["all_alerts"] = items + page["items"]
+                    st.session_state["alerts_cursor"] = page["next_cursor"]
+                    st.rerun()
+                except Exception as e:
+                    st.error(str(e))
+
+st.markdown("---")
+
+# ================== SECTION: TRENDS ==================
+st.subheader("Trends")
+st.caption("Trigger counts and sensor readings per minute/hour/day, from the rollups kept by the Lambda.")
+
+try:
+    trend_tenants = [f"{f}/{h}" for f, h in _cached_tenants()]
+except Exception:
+    trend_tenants = []
+t1, t2 = st.columns(2)
+with t1:
+    chosen_tenants = st.multiselect("Farm / house", options=trend_tenants, key="trend_tenants",
+                                    placeholder="All")
+    chosen_series = st.multiselect("Series", options=[k for k, _ in TRIGGER_MAP.values()] + [READINGS_KEY],
+                                   key="trend_series", placeholder="All")
+with t2:
+    today = datetime.now(timezone.utc).date()
+    trend_days = st.date_input("Period (UTC)", value=(today - timedelta(days=TRENDS_DAYS), today), key="trend_days")
+    r1, r2 = st.columns(2)
+    resolution = r1.selectbox("Resolution", options=["auto", *RESOLUTIONS], key="trend_resolution")
+    signal = r2.selectbox("Reading", options=["—", *SIGNALS], key="trend_signal")
+
+if st.button("Show trends", use_container_width=True):
+    days = trend_days if isinstance(trend_days, tuple) else (trend_days,)
+    if not days:
+        st.error("Pick a period.")
+    else:
+        since = datetime.combine(days[0], time.min, tzinfo=timezone.utc)
+        until = datetime.combine(days[-1], time.max, tzinfo=timezone.utc)
+        res = auto_resolution(since, until) if resolution == "auto" else resolution
+        try:
+            with st.spinner("Loading rollups…"):
+                points = _cached_trends(
+                    tuple(chosen_tenants or trend_tenants), res, since, until, tuple(chosen_series),
+                    None if signal == "—" else signal,
+                )
+            if not points:
+                st.info("No data for this period.")
+            else:
+                events, readings = _trend_frames(points)
+                st.caption(f"{res} resolution · {len(chosen_tenants or trend_tenants)} house(s)")
+                if not events.empty:
+                    st.markdown("**Events**")
+                    st.bar_chart(events)
+                if signal != "—" and not readings.empty:
+                    st.markdown(f"**{signal}** (min / mean / max)")
+                    st.line_chart(readings)
+        except Exception as e:
+            st.error(str(e))
 
 st.markdown("---")
 
@@ -160,55 +425,43 @@ recips_str = st.text_input(
     placeholder="maintenance@company.com, tech@company.com"
 )
 
-# Decide which message will be emailed (latest has priority; otherwise, first of all_alerts)
-selected_msg = None
+# Decide which message(s) will be emailed (latest has priority; otherwise, first of all_alerts,
+# or every loaded message as a single digest)
+loaded = st.session_state.get("all_alerts") or []
+as_digest = st.checkbox(
+    f"Send all {len(loaded)} loaded messages as one digest",
+    disabled=len(loaded) < 2 or bool(st.session_state.get("latest_alert")),
+)
+selected_msgs = []
 if st.session_state.get("latest_alert"):
-    selected_msg = st.session_state["latest_alert"]
-elif st.session_state.get("all_alerts"):
-    items = st.session_state["all_alerts"]
-    if items:
-        selected_msg = items[0]
+    selected_msgs = [st.session_state["latest_alert"]]
+elif loaded:
+    selected_msgs = loaded if as_digest else loaded[:1]
 
-send_disabled = selected_msg is None
+send_disabled = not selected_msgs
 if st.button("Send email", type="primary", use_container_width=True, disabled=send_disabled):
-    if selected_msg is None:
+    if not selected_msgs:
         st.error("Load a message first.")
     else:
         recipients = [r.strip() for r in recips_str.split(",") if r.strip()]
         if not recipients:
             st.error("Please enter at least one recipient email.")
         else:
-            data = selected_msg["data"]
-            url  = selected_msg["presigned_url"]
-            key  = selected_msg["key"]
-
-            subject = f"Caseiro 2º — Alert: {data.get('alert', '')[:60]}"
-            plain = (
-                f"Alert message:\n{data.get('alert', '—')}\n\n"
-                f"File: s3://{ALERTS_BUCKET}/{key}\n"
-                f"Link: {url}\n\n"
-                f"Full JSON:\n{_pretty_json(data)}\n"
-            )
-            html = f"""
-            <h2>Caseiro 2º — Alert</h2>
-            <p><b>Message:</b><br>{data.get('alert', '—')}</p>
-            <p><b>File:</b> s3://{ALERTS_BUCKET}/{key}</p>
-            <p><a href="{url}">Open object (pre-signed)</a></p>
-            <pre style="white-space:pre-wrap">{_pretty_json(data)}</pre>
-            """
-
             try:
-                send_email(
+                result = send_alert_digest(
                     aws_key=ALERTS_KEY,   # use the pair that has SES permission
                     aws_secret=ALERTS_SECRET,
                     region=SES_REGION,
                     sender=SES_SENDER,
                     recipients=recipients,
-                    subject=subject,
-                    html_body=html,
-                    text_body=plain,
+                    alerts=selected_msgs,
+                    bucket=ALERTS_BUCKET,
+                    urls=_presigner().urls(ALERTS_BUCKET, [m["key"] for m in selected_msgs if not m.get("segment")]),
                 )
-                st.success("Email sent to maintenance.")
-                st.toast("Email sent ✅")
+                if result["failed"]:
+                    st.warning(f"Sent to {result['sent']}; failed: " + ", ".join(f["email"] for f in result["failed"]))
+                else:
+                    st.success("Email sent to maintenance.")
+                    st.toast("Email sent ✅")
             except Exception as e:
                 st.error(f"Failed to send email: {e}")
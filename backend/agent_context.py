@@ -0,0 +1,247 @@
+# backend/agent_context.py
+"""
+Contexto das chamadas ao Agent do Bedrock.
+
+Sessões: uma por (granja, pavilhão, família de trigger), reutilizadas enquanto
+forem novas o bastante (idade, inatividade, nº de turnos). O Agent guarda o
+histórico da sessão, por isso cada turno só precisa do que é novo. O turno que
+esgota a sessão vai com endSession=True (fecho explícito, sem chamada extra);
+sessões inativas expiram sozinhas no Agent (idleSessionTTLInSeconds).
+
+Prompt compacto: em vez do .txt bruto, um resumo estruturado (linhas curtas
+"chave=valor") com o evento atual, as estatísticas do lote, as últimas leituras
+do pavilhão e as decisões anteriores que a sessão ainda não viu, cortado para
+caber em `budget_tokens` (estimativa de ~4 caracteres por token).
+"""
+import math
+import time
+import uuid
+import threading
+from collections import deque
+
+# trigger_key -> família (triggers da mesma família partilham a sessão do pavilhão)
+TRIGGER_FAMILIES = {
+    "ammonia": "air",
+    "high_humidity": "air",
+    "low_air_flow": "air",
+    "low_temperature": "temperature",
+    "high_temperature": "temperature",
+    "low_fan_velocity": "ventilation",
+    "high_fan_velocity": "ventilation",
+    "variable_fan_speed": "ventilation",
+    "variable_current": "power",
+}
+
+CHARS_PER_TOKEN = 4
+_SKIP_FIELDS = {"message", "trigger_key", "farm_id", "house_id", "generated_at", "source", "readings"}
+
+def trigger_family(trigger_key: str) -> str:
+    return TRIGGER_FAMILIES.get(trigger_key, trigger_key or "other")
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def _num(v: float) -> str:
+    return f"{v:.4g}"
+
+def _hhmm(ts: float) -> str:
+    return time.strftime("%H:%M", time.gmtime(ts))
+
+# ================== SESSÕES ==================
+class Lease:
+    """Uso exclusivo de uma sessão durante uma chamada."""
+
+    def __init__(self, key, session_id: str, end_session: bool, seen: int, pooled: bool):
+        self.key = key
+        self.session_id = session_id
+        self.end_session = end_session
+        self.seen = seen        # último item de histórico que a sessão já recebeu
+        self.pooled = pooled    # False = sessão avulsa (a do pavilhão estava ocupada)
+
+class SessionPool:
+    """
+    Sessões por (farm_id, house_id, família). Uma sessão só atende uma chamada
+    de cada vez (o Agent não aceita turnos simultâneos na mesma sessão); se
+    estiver ocupada, a chamada usa uma sessão avulsa, fechada no próprio turno.
+    """
+
+    def __init__(self, max_age_s: float = 1800, idle_s: float = 540, max_turns: int = 12, clock=time.time):
+        self.max_age_s = max_age_s
+        self.idle_s = idle_s
+        self.max_turns = max_turns
+        self.clock = clock
+        self._sessions: dict[tuple, dict] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, farm_id: str, house_id: str, family: str) -> Lease:
+        key = (farm_id, house_id, family)
+        now = self.clock()
+        with self._lock:
+            s = self._sessions.get(key)
+            if s is not None and (now - s["last_used"] > self.idle_s or now - s["created"] > self.max_age_s):
+                s = None  # expirou no Agent (inatividade) ou já é velha demais: começa outra
+            if s is None:
+                s = self._sessions[key] = {
+                    "id": str(uuid.uuid4()), "created": now, "last_used": now,
+                    "turns": 0, "seen": 0, "busy": False,
+                }
+            elif s["busy"]:
+                return Lease(key, str(uuid.uuid4()), True, 0, False)
+            s["busy"] = True
+            # último turno: atingiu o limite de turnos, ou a próxima chamada já chegaria
+            # depois de max_age_s (fecha agora em vez de a deixar pendurada até expirar)
+            last_turn = s["turns"] + 1 >= self.max_turns or now - s["created"] + self.idle_s > self.max_age_s
+            return Lease(key, s["id"], last_turn, s["seen"], True)
+
+    def release(self, lease: Lease, ok: bool, seen: int | None = None) -> None:
+        """Fim da chamada; com erro (ou no último turno) a sessão é descartada."""
+        if not lease.pooled:
+            return
+        with self._lock:
+            s = self._sessions.get(lease.key)
+            if s is None or s["id"] != lease.session_id:
+                return
+            if not ok or lease.end_session:
+                del self._sessions[lease.key]
+                return
+            s["busy"] = False
+            s["turns"] += 1
+            s["last_used"] = self.clock()
+            if seen is not None:
+                s["seen"] = max(s["seen"], seen)
+
+    def cancel(self, lease: Lease) -> None:
+        """Devolve a sessão sem a ter usado (ex.: resposta em cache): não conta turno."""
+        if not lease.pooled:
+            return
+        with self._lock:
+            s = self._sessions.get(lease.key)
+            if s is not None and s["id"] == lease.session_id:
+                s["busy"] = False
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+# ================== MEMÓRIA DO PAVILHÃO ==================
+class HouseContext:
+    """Últimas leituras por sinal e últimas decisões de cada pavilhão (em memória, por instância)."""
+
+    def __init__(self, max_history: int = 20):
+        self.max_history = max_history
+        self._readings: dict[tuple[str, str], dict[str, tuple[float, float]]] = {}
+        self._history: dict[tuple[str, str], deque] = {}
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def note_readings(self, farm_id: str, house_id: str, ts: float, readings: dict) -> None:
+        with self._lock:
+            last = self._readings.setdefault((farm_id, house_id), {})
+            for name, value in readings.items():
+                if name not in last or last[name][0] <= ts:
+                    last[name] = (ts, value)
+
+    def note_decision(self, farm_id: str, house_id: str, ts: float, trigger_key: str, action: str,
+                      rule: str | None = None, session_id: str | None = None) -> int:
+        """Guarda uma decisão (com a sessão do Agent que a tomou, se houver); devolve o nº de sequência."""
+        with self._lock:
+            self._seq += 1
+            items = self._history.setdefault((farm_id, house_id), deque(maxlen=self.max_history))
+            items.append({
+                "seq": self._seq, "ts": ts, "trigger_key": trigger_key, "action": action,
+                "rule": rule, "session_id": session_id,
+            })
+            return self._seq
+
+    def readings(self, farm_id: str, house_id: str) -> dict[str, tuple[float, float]]:
+        with self._lock:
+            return dict(self._readings.get((farm_id, house_id), {}))
+
+    def history(self, farm_id: str, house_id: str, after: int = 0, skip_session: str | None = None) -> list[dict]:
+        """
+        Decisões com seq > `after`, da mais nova para a mais antiga, sem as da
+        sessão `skip_session` (essas o Agent já tem no histórico da sessão).
+        """
+        with self._lock:
+            return [
+                h for h in reversed(self._history.get((farm_id, house_id), ()))
+                if h["seq"] > after and (skip_session is None or h["session_id"] != skip_session)
+            ]
+
+    def last_seq(self) -> int:
+        with self._lock:
+            return self._seq
+
+# ================== PROMPT ==================
+def build_prompt(
+    fields: dict,
+    readings: dict | None = None,
+    batch_stats: dict | None = None,
+    occurrences: int = 1,
+    recent_readings: dict | None = None,
+    history: list[dict] | None = None,
+    budget_tokens: int = 400,
+    max_history: int = 3,
+) -> str:
+    """
+    Prompt compacto. Ordem de prioridade (o que não couber no orçamento sai do fim):
+      1. cabeçalho: mensagem, trigger, pavilhão, hora
+      2. leituras do evento e estatísticas do lote (sinal=n/min/max/média/último)
+      3. ocorrências e campos extra do trigger (ex.: anomalias)
+      4. últimas leituras conhecidas do pavilhão (sinais que não vieram no evento)
+      5. até `max_history` decisões anteriores ainda não vistas pela sessão
+         (mais novas primeiro; só trigger e ação/regra, sem o texto da resposta)
+    """
+    budget = budget_tokens * CHARS_PER_TOKEN
+    ts = fields.get("generated_at", "")
+    lines = [
+        fields.get("message") or fields.get("trigger_key") or "sensor event",
+        f"trigger={fields.get('trigger_key', '')} farm={fields.get('farm_id', '')} "
+        f"house={fields.get('house_id', '')}" + (f" at={str(ts)[:16]}" if ts else ""),
+    ]
+    size = sum(len(ln) + 1 for ln in lines)
+
+    def add(line: str) -> bool:
+        nonlocal size
+        if size + len(line) + 1 > budget:
+            return False
+        lines.append(line)
+        size += len(line) + 1
+        return True
+
+    if readings:
+        add("now: " + " ".join(f"{k}={_num(v)}" for k, v in readings.items()))
+    for name, st in (batch_stats or {}).items():
+        add(f"{name}: n={st['n']} min={_num(st['min'])} max={_num(st['max'])} "
+            f"mean={_num(st['mean'])} last={_num(st['last'])}")
+    shown = set(readings or ()) | set(batch_stats or ())
+    if occurrences > 1:
+        add(f"occurrences={occurrences}")
+    for k, v in fields.items():
+        if k in _SKIP_FIELDS or k in shown:
+            continue
+        add(f"{k}={str(v)[:120]}")
+
+    others = [(name, ts_v) for name, ts_v in (recent_readings or {}).items() if name not in shown]
+    if others:
+        add("recent: " + " ".join(f"{name}={_num(v)}@{_hhmm(t)}" for name, (t, v) in sorted(others)))
+
+    for h in (history or ())[:max_history]:
+        what = h["action"] + (f"/{h['rule']}" if h.get("rule") else "")
+        if not add(f"prev {_hhmm(h['ts'])} {h['trigger_key']} {what}"):
+            break
+    return "\n".join(lines) + "\n"
+
+def column_stats(columns: dict) -> dict:
+    """{sinal: {n, min, max, mean, last}} de um lote .csb (NaN = sem leitura)."""
+    stats = {}
+    for name, col in columns.items():
+        if name == "ts":
+            continue
+        values = [v for v in col if v == v]
+        if values:
+            stats[name] = {
+                "n": len(values), "min": min(values), "max": max(values),
+                "mean": sum(values) / len(values), "last": values[-1],
+            }
+    return stats
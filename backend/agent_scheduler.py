@@ -0,0 +1,239 @@
+# backend/agent_scheduler.py
+"""
+Agendamento das chamadas ao Agent do Bedrock (por instância do Lambda).
+
+Quando muitos pavilhões disparam ao mesmo tempo, as chamadas não saem todas de
+uma vez: passam pelo AgentScheduler, que
+  - atende por faixas de severidade (critical > warning > info): uma vaga livre
+    vai sempre para a faixa mais alta com fila; cada faixa tem uma espera máxima
+    (o ruído, com espera curta, cai logo no alerta de modelo quando há carga)
+  - limita as chamadas em curso e os tokens de entrada por segundo (TokenBucket,
+    o mesmo do despacho de SMS)
+  - reage ao throttling do Bedrock: corta a concorrência pela metade e espera com
+    backoff exponencial; a cada chamada bem-sucedida a concorrência volta a subir
+    (AIMD, como o controlo de congestionamento do TCP)
+  - consulta um CircuitBreaker: com erros ou chamadas lentas acima do orçamento,
+    o disjuntor abre e as chamadas falham logo com AgentUnavailable, sem tocar no
+    Agent; passado `open_s`, uma chamada de teste decide se volta a fechar
+
+AgentUnavailable = use o alerta de modelo (fallback). Outros erros da chamada
+sobem como estão (e contam para o disjuntor).
+
+`clock` é injetado (benchmarks); as esperas usam threading.Condition.
+"""
+import time
+import random
+import threading
+from collections import Counter, deque
+from botocore.exceptions import ClientError
+from backend.sms_dispatcher import TokenBucket
+
+# ClientError e erros do event stream do invoke_agent (mesmo nome, com minúscula)
+THROTTLING_CODES = {
+    "Throttling", "ThrottlingException", "throttlingException",
+    "ServiceQuotaExceededException", "serviceQuotaExceededException", "TooManyRequestsException",
+}
+LANES = ("critical", "warning", "info")
+
+class AgentUnavailable(Exception):
+    """O Agent não vai ser chamado agora (disjuntor aberto, fila cheia ou throttling persistente)."""
+
+def is_throttling(error: Exception) -> bool:
+    return isinstance(error, ClientError) and error.response.get("Error", {}).get("Code") in THROTTLING_CODES
+
+class CircuitBreaker:
+    """
+    Janela deslizante das últimas `window` chamadas. Abre quando, com pelo menos
+    `min_calls`, a fração de erros passa de `max_error_rate` ou a de chamadas mais
+    lentas do que `latency_budget_s` passa de `max_slow_rate`. Aberto durante
+    `open_s`; depois deixa passar uma chamada de teste (meio-aberto): sucesso
+    fecha (janela limpa), falha reabre.
+    """
+
+    def __init__(
+        self,
+        window: int = 20,
+        min_calls: int = 5,
+        max_error_rate: float = 0.5,
+        latency_budget_s: float = 20.0,
+        max_slow_rate: float = 0.5,
+        open_s: float = 30.0,
+        clock=time.monotonic,
+    ):
+        self.min_calls = min_calls
+        self.max_error_rate = max_error_rate
+        self.latency_budget_s = latency_budget_s
+        self.max_slow_rate = max_slow_rate
+        self.open_s = open_s
+        self.clock = clock
+        self.state = "closed"
+        self.stats = Counter()
+        self._calls: deque = deque(maxlen=window)   # (erro, lenta)
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def blocked(self) -> bool:
+        """Aberto e ainda sem direito a chamada de teste (não reserva nada)."""
+        with self._lock:
+            return self.state == "open" and self.clock() - self._opened_at < self.open_s
+
+    def allow(self) -> bool:
+        """Reserva a chamada; no meio-aberto só passa uma de cada vez."""
+        with self._lock:
+            if self.state == "open":
+                if self.clock() - self._opened_at < self.open_s:
+                    return False
+                self.state = "half_open"
+            if self.state == "half_open":
+                if self._probing:
+                    return False
+                self._probing = True
+            return True
+
+    def record(self, ok: bool, latency_s: float) -> None:
+        slow = latency_s > self.latency_budget_s
+        with self._lock:
+            if self.state == "half_open":
+                self._probing = False
+                if ok and not slow:
+                    self.state = "closed"
+                    self._calls.clear()
+                    self.stats["closed"] += 1
+                else:
+                    self._open()
+                return
+            self._calls.append((not ok, slow))
+            n = len(self._calls)
+            if self.state == "closed" and n >= self.min_calls:
+                errors = sum(e for e, _ in self._calls) / n
+                slow_rate = sum(s for _, s in self._calls) / n
+                if errors > self.max_error_rate or slow_rate > self.max_slow_rate:
+                    self._open()
+
+    def _open(self) -> None:
+        self.state = "open"
+        self._opened_at = self.clock()
+        self.stats["opened"] += 1
+
+class AgentScheduler:
+    """
+    Uso:
+        answer = scheduler.run(lambda: stream_answer(prompt), severity="critical", tokens=120)
+    `fn` é repetida em caso de throttling, por isso deve poder começar do zero
+    (o SMS enviado a meio do stream já é idempotente).
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 4,
+        tokens_per_s: float = 1000.0,
+        token_burst: float = 2000.0,
+        max_wait_s: dict | None = None,
+        max_attempts: int = 4,
+        backoff_s: float = 0.5,
+        max_backoff_s: float = 8.0,
+        breaker: CircuitBreaker | None = None,
+        clock=time.monotonic,
+    ):
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)   # concorrência efetiva (cai com throttling)
+        self.max_wait_s = {"critical": 10.0, "warning": 4.0, "info": 1.0, **(max_wait_s or {})}
+        self.max_attempts = max_attempts
+        self.backoff_s = backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.breaker = breaker or CircuitBreaker(clock=clock)
+        self.clock = clock
+        self.stats = Counter()
+        self._tokens = TokenBucket(tokens_per_s, token_burst, clock())
+        self._queues = {lane: deque() for lane in LANES}
+        self._running = 0
+        self._not_before = 0.0
+        self._throttle_streak = 0
+        self._cond = threading.Condition()
+
+    def lane(self, severity: str) -> str:
+        return severity if severity in self._queues else "warning"
+
+    def running(self) -> int:
+        with self._cond:
+            return self._running
+
+    # ---------- vagas ----------
+    def _first_in_line(self, ticket, lane: str) -> bool:
+        for other in LANES:
+            if other == lane:
+                return self._queues[lane][0] is ticket
+            if self._queues[other]:
+                return False
+        return False
+
+    def _acquire(self, lane: str, tokens: float, deadline: float) -> bool:
+        ticket = object()
+        with self._cond:
+            self._queues[lane].append(ticket)
+            try:
+                while True:
+                    now = self.clock()
+                    if self._first_in_line(ticket, lane) and self._running < max(1, int(self.limit)):
+                        wait = max(self._not_before - now, self._tokens.wait_s(now, tokens))
+                        if wait <= 0:
+                            self._tokens.take(now, tokens)
+                            self._running += 1
+                            return True
+                    else:
+                        wait = deadline - now  # acorda com notify (vaga livre / fila andou)
+                    if now + wait > deadline or now >= deadline:
+                        return False
+                    self._cond.wait(timeout=max(wait, 0.001))
+            finally:
+                self._queues[lane].remove(ticket)
+                self._cond.notify_all()
+
+    def _release(self, ok: bool, throttled: bool) -> None:
+        with self._cond:
+            self._running -= 1
+            if throttled:
+                self._throttle_streak += 1
+                self.limit = max(1.0, self.limit / 2)
+                delay = min(self.max_backoff_s, self.backoff_s * 2 ** (self._throttle_streak - 1))
+                self._not_before = max(self._not_before, self.clock() + delay * random.uniform(0.5, 1.0))
+            elif ok:
+                self._throttle_streak = 0
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    # ---------- chamada ----------
+    def run(self, fn, severity: str = "warning", tokens: float = 0):
+        lane = self.lane(severity)
+        deadline = self.clock() + self.max_wait_s[lane]
+        for attempt in range(1, self.max_attempts + 1):
+            if self.breaker.blocked():
+                self.stats["short_circuited"] += 1
+                raise AgentUnavailable("circuit open")
+            if not self._acquire(lane, tokens, deadline):
+                self.stats[f"timed_out_{lane}"] += 1
+                raise AgentUnavailable(f"no slot within {self.max_wait_s[lane]}s ({lane})")
+            if not self.breaker.allow():
+                self._release(ok=False, throttled=False)
+                self.stats["short_circuited"] += 1
+                raise AgentUnavailable("circuit open")
+            self.stats[f"started_{lane}"] += 1
+            t0 = self.clock()
+            try:
+                result = fn()
+            except Exception as e:
+                throttled = is_throttling(e)
+                self.breaker.record(False, self.clock() - t0)
+                self._release(ok=False, throttled=throttled)
+                if not throttled:
+                    self.stats["errors"] += 1
+                    raise
+                self.stats["throttled"] += 1
+                if attempt == self.max_attempts:
+                    raise AgentUnavailable(f"throttled {attempt}x") from e
+                continue
+            self.breaker.record(True, self.clock() - t0)
+            self._release(ok=True, throttled=False)
+            self.stats["completed"] += 1
+            return result
@@ -1,13 +1,64 @@
 # backend/email_ses.py
+import json
+import time
+import threading
 import boto3
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# Limites do SES: 50 destinos por SendBulkTemplatedEmail; a taxa de envio conta
+# destinatários por segundo (get_send_quota -> MaxSendRate).
+MAX_DESTINATIONS_PER_CALL = 50
+SEND_WORKERS = 4
+MAX_ATTEMPTS = 4
+THROTTLING_CODES = {"Throttling", "ThrottlingException", "MaxSendingRateExceeded"}
+
+# Um único template para 1..N alertas (o resumo é só uma lista maior)
+DIGEST_TEMPLATE = "CaseiroAlertDigest"
+DIGEST_TEMPLATE_CONTENT = {
+    "SubjectPart": "Caseiro 2º — {{subject}}",
+    "TextPart": (
+        "{{#if name}}Hello {{name}},\n\n{{/if}}"
+        "{{count}} alert(s){{#if period}} — {{period}}{{/if}}\n\n"
+        "{{#each alerts}}"
+        "[{{generated_at}}] {{alert}}\n"
+        "File: s3://{{bucket}}/{{key}}\n"
+        "{{#if url}}Link: {{url}}\n{{/if}}\n"
+        "{{/each}}"
+    ),
+    "HtmlPart": (
+        "<h2>Caseiro 2º — {{count}} alert(s)</h2>"
+        "{{#if period}}<p>{{period}}</p>{{/if}}"
+        "{{#each alerts}}"
+        "<hr><p><b>{{generated_at}}</b><br>{{alert}}</p>"
+        "<p>File: s3://{{bucket}}/{{key}}"
+        "{{#if url}}<br><a href=\"{{url}}\">Open object (pre-signed)</a>{{/if}}</p>"
+        "{{/each}}"
+    ),
+}
+
+_clients = {}
+_clients_lock = threading.Lock()
+_templates_ready = set()
+_send_rates = {}
 
 def _ses(aws_key, aws_secret, region):
-    return boto3.client(
-        "ses",
-        aws_access_key_id=aws_key,
-        aws_secret_access_key=aws_secret,
-        region_name=region,
-    )
+    # um cliente por credencial/região, partilhado entre reruns e sessões do Streamlit
+    cache_key = (aws_key, aws_secret, region)
+    client = _clients.get(cache_key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(cache_key)
+            if client is None:
+                client = _clients[cache_key] = boto3.client(
+                    "ses",
+                    aws_access_key_id=aws_key,
+                    aws_secret_access_key=aws_secret,
+                    region_name=region,
+                    config=Config(max_pool_connections=SEND_WORKERS * 2, tcp_keepalive=True),
+                )
+    return client
 
 def send_email(aws_key, aws_secret, region, sender, recipients, subject, html_body, text_body):
     if not sender:
@@ -28,3 +79,159 @@ def send_email(aws_key, aws_secret, region, sender, recipients, subject, html_bo
             },
         },
     )
+
+# ================== ENVIO EM LOTE (templates) ==================
+class _RateLimiter:
+    """Reserva `n` destinatários na taxa do SES; bloqueia só o tempo necessário."""
+
+    def __init__(self, rate_per_s: float):
+        self.rate_per_s = rate_per_s
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, n: int) -> None:
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + n / self.rate_per_s
+        if start > now:
+            time.sleep(start - now)
+
+def ensure_template(ses, name: str = DIGEST_TEMPLATE, content: dict | None = None) -> None:
+    """
+    Cria o template no SES ou, se já existir, atualiza-o com `content` (uma vez
+    por processo), para que uma mudança em DIGEST_TEMPLATE_CONTENT chegue ao SES.
+    """
+    if name in _templates_ready:
+        return
+    template = {"TemplateName": name, **(DIGEST_TEMPLATE_CONTENT if content is None else content)}
+    try:
+        ses.create_template(Template=template)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "AlreadyExists":
+            raise RuntimeError(f"Failed to create SES template {name}: {e}")
+        try:
+            ses.update_template(Template=template)
+        except ClientError as e:
+            raise RuntimeError(f"Failed to update SES template {name}: {e}")
+    _templates_ready.add(name)
+
+def _send_rate(ses, cache_key) -> float:
+    rate = _send_rates.get(cache_key)
+    if rate is None:
+        try:
+            rate = float(ses.get_send_quota()["MaxSendRate"])
+        except (ClientError, KeyError):
+            rate = 1.0  # mínimo do sandbox
+        _send_rates[cache_key] = rate
+    return rate
+
+def send_bulk_templated(
+    aws_key,
+    aws_secret,
+    region,
+    sender,
+    recipients,
+    template: str,
+    data: dict,
+    per_recipient: dict | None = None,
+    max_rate_per_s: float | None = None,
+) -> dict:
+    """
+    Envia o template a cada destinatário (cada um recebe o seu próprio e-mail).
+    `data` é comum a todos; `per_recipient` = {email: {...}} substitui campos por
+    destinatário (ex.: {"name": "João"}). Os destinatários são divididos em blocos
+    de até 50 (e não mais que a taxa do SES), enviados em paralelo sob essa taxa,
+    com novas tentativas em caso de throttling.
+    Retorna {"sent": int, "failed": [{"email", "error"}], "message_ids": [...]}.
+    """
+    if not sender:
+        raise RuntimeError("SES_SENDER is not set.")
+    recipients = list(dict.fromkeys(r.strip() for r in (recipients or []) if r and r.strip()))
+    if not recipients:
+        raise RuntimeError("No recipients provided.")
+
+    ses = _ses(aws_key, aws_secret, region)
+    rate = max_rate_per_s or _send_rate(ses, (aws_key, region))
+    size = max(1, min(MAX_DESTINATIONS_PER_CALL, int(rate)))
+    chunks = [recipients[i:i + size] for i in range(0, len(recipients), size)]
+    limiter = _RateLimiter(rate)
+    per_recipient = per_recipient or {}
+    default_data = json.dumps(data, ensure_ascii=False, default=str)
+
+    def send_chunk(chunk):
+        destinations = [
+            {
+                "Destination": {"ToAddresses": [email]},
+                "ReplacementTemplateData": json.dumps(per_recipient.get(email, {}), ensure_ascii=False, default=str),
+            }
+            for email in chunk
+        ]
+        for attempt in range(MAX_ATTEMPTS):
+            limiter.acquire(len(chunk))
+            try:
+                resp = ses.send_bulk_templated_email(
+                    Source=sender,
+                    Template=template,
+                    DefaultTemplateData=default_data,
+                    Destinations=destinations,
+                )
+                return list(zip(chunk, resp.get("Status", [])))
+            except ClientError as e:
+                code = e.response.get("Error", {}).get("Code")
+                if code not in THROTTLING_CODES or attempt == MAX_ATTEMPTS - 1:
+                    return [(email, {"Status": code or "Failed", "Error": str(e)}) for email in chunk]
+                time.sleep(0.5 * 2 ** attempt)
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(SEND_WORKERS, len(chunks))) as pool:
+        results = [r for part in pool.map(send_chunk, chunks) for r in part]
+
+    ok = [(email, st) for email, st in results if st.get("Status") == "Success"]
+    return {
+        "sent": len(ok),
+        "failed": [{"email": email, "error": st.get("Error") or st.get("Status")} for email, st in results
+                   if st.get("Status") != "Success"],
+        "message_ids": [st.get("MessageId") for _, st in ok],
+    }
+
+def send_alert_digest(
+    aws_key,
+    aws_secret,
+    region,
+    sender,
+    recipients,
+    alerts: list[dict],
+    bucket: str,
+    urls: dict | None = None,
+    period: str = "",
+    per_recipient: dict | None = None,
+) -> dict:
+    """
+    Um e-mail (por destinatário) com 1..N alertas: items no formato do
+    get_alerts_page ({"key", "data"}), `urls` = {key: link pré-assinado}.
+    Serve para o envio manual do app e para resumos horários/diários.
+    """
+    if not alerts:
+        raise RuntimeError("No alerts to send.")
+    urls = urls or {}
+    rows = [
+        {
+            "generated_at": a["data"].get("generated_at", ""),
+            "alert": a["data"].get("alert", "—"),
+            "bucket": bucket,
+            "key": a["key"],
+            "url": urls.get(a["key"], ""),
+        }
+        for a in alerts
+    ]
+    subject = f"Alert: {rows[0]['alert'][:60]}" if len(rows) == 1 else f"{len(rows)} alerts"
+    if period:
+        subject += f" ({period})"
+    ensure_template(_ses(aws_key, aws_secret, region))
+    return send_bulk_templated(
+        aws_key, aws_secret, region, sender, recipients,
+        template=DIGEST_TEMPLATE,
+        data={"subject": subject, "count": len(rows), "period": period, "alerts": rows},
+        per_recipient=per_recipient,
+    )
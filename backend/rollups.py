@@ -0,0 +1,495 @@
+# backend/rollups.py
+"""
+Agregados (rollups) de triggers e leituras por pavilhão, trigger_key e intervalo
+de tempo, mantidos incrementalmente pelo Lambda. O gráfico de tendências do app
+lê meses de dados com 1 LIST + 1 GET por pavilhão, sem tocar nos triggers/alertas.
+
+Resoluções (UTC), cada uma num arquivo por pavilhão e período:
+    minute -> 1 arquivo por dia  (1440 posições)
+    hour   -> 1 arquivo por mês  (744 = 31 x 24; posição = horas desde o dia 1)
+    day    -> 1 arquivo por ano  (366)
+Por posição e trigger_key: nº de eventos (triggers) e, por sinal, n/min/max/soma
+das leituras (média = soma / n). Leituras de lotes .csb ficam sob READINGS_KEY.
+Os agregados combinam sem perda (somas, mínimos, máximos), por isso juntar
+pavilhões ou instâncias do Lambda é só somar arquivos.
+
+Layout no S3:
+    <base>_rollups/<resolução>/<shard>/<farm>/<house>/<período>/<versão invertida>.cru
+Cada gravação cria a versão seguinte com IfNoneMatch="*" (compare-and-swap: duas
+instâncias do Lambda não perdem as atualizações uma da outra); a versão mais nova
+é a primeira da listagem e as antigas são apagadas (ficam KEEP_VERSIONS).
+
+Formato .cru: b"CRU1" | uint32 len | cabeçalho JSON | zlib(colunas float64)
+O cabeçalho lista as séries ({trigger_key, signals}); cada série ocupa
+1 + 4 x len(signals) colunas de `slots` valores: eventos e, por sinal, n/min/max/soma.
+Posições sem leituras têm n = 0 e min/max = NaN.
+"""
+import sys
+import json
+import math
+import zlib
+import struct
+import threading
+from array import array
+from functools import lru_cache
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from backend.sensor_batch import SENSOR_COLUMNS
+from backend.tenancy import tenant_prefix
+
+MAGIC = b"CRU1"
+EXTENSION = ".cru"
+ROLLUPS_DIR = "_rollups/"
+READINGS_KEY = "readings"    # série das leituras (lotes .csb), com ou sem trigger
+RESOLUTIONS = ("minute", "hour", "day")
+SLOTS = {"minute": 1440, "hour": 31 * 24, "day": 366}
+SIGNALS = [c for c in SENSOR_COLUMNS if c != "ts"]   # campos numéricos dos .txt agregados
+KEEP_VERSIONS = 4
+MAX_ATTEMPTS = 5
+FETCH_WORKERS = 8
+
+_INV_BASE = 10**10
+_HEADER = struct.Struct("<4sI")
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def _s3(aws_key, aws_secret, region):
+    # um cliente por credencial/região, partilhado entre reruns e sessões do Streamlit
+    cache_key = (aws_key, aws_secret, region)
+    client = _clients.get(cache_key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(cache_key)
+            if client is None:
+                import boto3
+                client = _clients[cache_key] = boto3.client(
+                    "s3",
+                    aws_access_key_id=aws_key,
+                    aws_secret_access_key=aws_secret,
+                    region_name=region,
+                )
+    return client
+
+# ================== TEMPO -> (PERÍODO, POSIÇÃO) ==================
+@lru_cache(maxsize=4096)
+def _day(day_number: int) -> tuple[str, str, str, int, int]:
+    d = _EPOCH + timedelta(days=day_number)
+    return f"{d:%Y-%m-%d}", f"{d:%Y-%m}", f"{d:%Y}", d.day, d.timetuple().tm_yday
+
+def period_of(resolution: str, ts: float) -> tuple[str, int]:
+    """(período do arquivo, posição no arquivo) de um epoch em segundos (UTC)."""
+    day_number, secs = divmod(int(ts), 86400)
+    date, month, year, mday, yday = _day(day_number)
+    if resolution == "minute":
+        return date, secs // 60
+    if resolution == "hour":
+        return month, (mday - 1) * 24 + secs // 3600
+    if resolution == "day":
+        return year, yday - 1
+    raise ValueError(f"Unknown resolution: {resolution}")
+
+def _period_start(resolution: str, period: str) -> datetime:
+    fmt = {"minute": "%Y-%m-%d", "hour": "%Y-%m", "day": "%Y"}[resolution]
+    return datetime.strptime(period, fmt).replace(tzinfo=timezone.utc)
+
+def slot_time(resolution: str, period: str, slot: int) -> datetime:
+    step = {"minute": timedelta(minutes=1), "hour": timedelta(hours=1), "day": timedelta(days=1)}[resolution]
+    return _period_start(resolution, period) + slot * step
+
+def periods_between(resolution: str, start: datetime, end: datetime) -> list[str]:
+    """Períodos (arquivos) que cobrem [start, end]."""
+    periods = []
+    t = start.timestamp()
+    while t <= end.timestamp():
+        period, _ = period_of(resolution, t)
+        if not periods or periods[-1] != period:
+            periods.append(period)
+        t += 86400
+    last, _ = period_of(resolution, end.timestamp())
+    if not periods or periods[-1] != last:
+        periods.append(last)
+    return periods
+
+# ================== SÉRIES E ARQUIVOS ==================
+def _zeros(slots: int) -> array:
+    return array("d", bytes(8 * slots))
+
+def _nans(slots: int) -> array:
+    return array("d", [math.nan]) * slots
+
+class Series:
+    """Colunas de uma trigger_key num arquivo: eventos e [n, min, max, soma] por sinal."""
+
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.events = _zeros(slots)
+        self.signals: dict[str, list[array]] = {}
+        self.touched: set[int] | None = set()  # posições alteradas (None = desconhecido, ex.: lida do S3)
+
+    def _signal(self, name: str) -> list[array]:
+        cols = self.signals.get(name)
+        if cols is None:
+            cols = self.signals[name] = [_zeros(self.slots), _nans(self.slots), _nans(self.slots), _zeros(self.slots)]
+        return cols
+
+    def add_events(self, slot: int, count: float = 1) -> None:
+        self.events[slot] += count
+        if self.touched is not None:
+            self.touched.add(slot)
+
+    def add(self, slot: int, name: str, value: float) -> None:
+        n, lo, hi, total = self._signal(name)
+        n[slot] += 1
+        total[slot] += value
+        if not lo[slot] <= value:  # NaN também cai aqui
+            lo[slot] = value
+        if not hi[slot] >= value:
+            hi[slot] = value
+        if self.touched is not None:
+            self.touched.add(slot)
+
+    def merge(self, other: "Series") -> None:
+        slots = range(self.slots) if other.touched is None else sorted(other.touched)
+        for i in slots:
+            self.events[i] += other.events[i]
+        for name, (n2, lo2, hi2, sum2) in other.signals.items():
+            n, lo, hi, total = self._signal(name)
+            for i in slots:
+                if n2[i]:
+                    n[i] += n2[i]
+                    total[i] += sum2[i]
+                    if not lo[i] <= lo2[i]:
+                        lo[i] = lo2[i]
+                    if not hi[i] >= hi2[i]:
+                        hi[i] = hi2[i]
+        if self.touched is not None:
+            if other.touched is None:
+                self.touched = None
+            else:
+                self.touched |= other.touched
+
+    def columns(self) -> list[array]:
+        return [self.events] + [c for name in sorted(self.signals) for c in self.signals[name]]
+
+class Rollup:
+    """Um arquivo: um pavilhão, uma resolução, um período; {trigger_key: Series}."""
+
+    def __init__(self, resolution: str, period: str):
+        self.resolution = resolution
+        self.period = period
+        self.slots = SLOTS[resolution]
+        self.series: dict[str, Series] = {}
+
+    def series_for(self, trigger_key: str) -> Series:
+        s = self.series.get(trigger_key)
+        if s is None:
+            s = self.series[trigger_key] = Series(self.slots)
+        return s
+
+    def merge(self, other: "Rollup") -> None:
+        for key, s in other.series.items():
+            self.series_for(key).merge(s)
+
+    def copy(self) -> "Rollup":
+        return Rollup.decode(self.encode())
+
+    def encode(self) -> bytes:
+        header = {
+            "resolution": self.resolution,
+            "period": self.period,
+            "slots": self.slots,
+            "series": [{"trigger_key": k, "signals": sorted(s.signals)} for k, s in sorted(self.series.items())],
+        }
+        data = array("d")
+        for _, s in sorted(self.series.items()):
+            for col in s.columns():
+                data.extend(col)
+        if sys.byteorder != "little":
+            data.byteswap()
+        head = json.dumps(header, separators=(",", ":")).encode("utf-8")
+        return _HEADER.pack(MAGIC, len(head)) + head + zlib.compress(data.tobytes(), 6)
+
+    @classmethod
+    def decode(cls, body: bytes) -> "Rollup":
+        magic, head_len = _HEADER.unpack_from(body, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a rollup file (bad magic).")
+        header = json.loads(body[_HEADER.size:_HEADER.size + head_len].decode("utf-8"))
+        data = array("d")
+        data.frombytes(zlib.decompress(body[_HEADER.size + head_len:]))
+        if sys.byteorder != "little":
+            data.byteswap()
+
+        rollup = cls(header["resolution"], header["period"])
+        slots, pos = rollup.slots, 0
+
+        def take() -> array:
+            nonlocal pos
+            col = data[pos:pos + slots]
+            pos += slots
+            return col
+
+        for entry in header["series"]:
+            s = Series(slots)
+            s.touched = None
+            s.events = take()
+            for name in entry["signals"]:
+                s.signals[name] = [take(), take(), take(), take()]
+            rollup.series[entry["trigger_key"]] = s
+        return rollup
+
+    def points(self, trigger_keys=None, signal: str | None = None) -> list[dict]:
+        """Posições com dados: {"time", "trigger_key", "events", "n", "min", "max", "mean"}."""
+        out = []
+        for key, s in self.series.items():
+            if trigger_keys and key not in trigger_keys:
+                continue
+            cols = s.signals.get(signal) if signal else None
+            for i in range(self.slots):
+                n = cols[0][i] if cols else 0
+                if not s.events[i] and not n:
+                    continue
+                out.append({
+                    "time": slot_time(self.resolution, self.period, i),
+                    "trigger_key": key,
+                    "events": s.events[i],
+                    "n": n,
+                    "min": cols[1][i] if n else None,
+                    "max": cols[2][i] if n else None,
+                    "mean": cols[3][i] / n if n else None,
+                })
+        return out
+
+# ================== ACUMULAÇÃO (Lambda) ==================
+class RollupBuffer:
+    """
+    Deltas de uma invocação, por (resolução, farm, house, período). Thread-safe:
+    os records do lote somam no mesmo buffer e o handler grava tudo no fim.
+    """
+
+    def __init__(self, resolutions=RESOLUTIONS):
+        self.resolutions = tuple(resolutions)
+        self.files: dict[tuple[str, str, str, str], Rollup] = {}
+        self._lock = threading.Lock()
+
+    def _file(self, resolution: str, farm_id: str, house_id: str, period: str) -> Rollup:
+        key = (resolution, farm_id, house_id, period)
+        rollup = self.files.get(key)
+        if rollup is None:
+            rollup = self.files[key] = Rollup(resolution, period)
+        return rollup
+
+    def add_event(self, farm_id: str, house_id: str, trigger_key: str, ts: float, readings: dict | None = None) -> None:
+        """Um trigger (evento) e as leituras que vieram nele."""
+        with self._lock:
+            for res in self.resolutions:
+                period, slot = period_of(res, ts)
+                s = self._file(res, farm_id, house_id, period).series_for(trigger_key)
+                s.add_events(slot)
+                for name, value in (readings or {}).items():
+                    s.add(slot, name, value)
+
+    def add_columns(self, farm_id: str, house_id: str, columns: dict, trigger_key: str = READINGS_KEY) -> None:
+        """Leituras de um lote .csb ({"ts": [...], sinal: [...]}; NaN = sem leitura)."""
+        ts = columns["ts"]
+        names = [n for n in columns if n != "ts"]
+        with self._lock:
+            for res in self.resolutions:
+                where = [period_of(res, t) for t in ts]
+                series = {}
+                for period in {p for p, _ in where}:
+                    series[period] = self._file(res, farm_id, house_id, period).series_for(trigger_key)
+                for name in names:
+                    col = columns[name]
+                    for i, (period, slot) in enumerate(where):
+                        v = col[i]
+                        if v == v:
+                            series[period].add(slot, name, v)
+
+    def merge(self, other: "RollupBuffer") -> None:
+        with self._lock:
+            for (res, farm_id, house_id, period), rollup in other.files.items():
+                self._file(res, farm_id, house_id, period).merge(rollup)
+
+    def tenants(self) -> set[tuple[str, str]]:
+        return {(farm_id, house_id) for _, farm_id, house_id, _ in self.files}
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+def event_readings(fields: dict) -> dict:
+    """Leituras (SIGNALS) presentes nos campos de um trigger .txt."""
+    readings = {}
+    for name in SIGNALS:
+        try:
+            readings[name] = float(fields[name])
+        except (KeyError, ValueError):
+            pass
+    return readings
+
+def event_ts(fields: dict, default: float) -> float:
+    """generated_at/ts do trigger (ISO ou epoch); `default` se ausente ou inválido."""
+    value = fields.get("generated_at") or fields.get("ts")
+    if value is None:
+        return default
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return default
+
+# ================== ARMAZENAMENTO (S3) ==================
+def rollup_dir(base: str, resolution: str, farm_id: str, house_id: str, period: str) -> str:
+    return f"{base}{ROLLUPS_DIR}{resolution}/{tenant_prefix(farm_id, house_id)}{period}/"
+
+def _version_key(directory: str, version: int) -> str:
+    return f"{directory}{_INV_BASE - version:010d}{EXTENSION}"
+
+def _latest_key(s3, bucket: str, directory: str) -> tuple[int, str | None]:
+    resp = s3.list_objects_v2(Bucket=bucket, Prefix=directory, MaxKeys=1)
+    contents = resp.get("Contents") or []
+    if not contents:
+        return 0, None
+    key = contents[0]["Key"]
+    return _INV_BASE - int(key[len(directory):-len(EXTENSION)]), key
+
+def load_rollup(s3, bucket: str, directory: str) -> tuple[int, Rollup | None]:
+    """(versão, arquivo) mais recente do diretório; (0, None) se não existir."""
+    for attempt in range(2):
+        version, key = _latest_key(s3, bucket, directory)
+        if key is None:
+            return 0, None
+        try:
+            return version, Rollup.decode(s3.get_object(Bucket=bucket, Key=key)["Body"].read())
+        except ClientError as e:
+            # versão apagada entre o LIST e o GET por uma gravação mais nova: listar de novo
+            if e.response.get("Error", {}).get("Code") != "NoSuchKey" or attempt:
+                raise
+    return 0, None
+
+class RollupStore:
+    """
+    Grava os deltas de um RollupBuffer com compare-and-swap por versão. Guarda a
+    última versão gravada de cada arquivo: se ninguém mais gravou entretanto (o
+    caso comum numa instância quente), a atualização custa 1 LIST + 1 PUT.
+    """
+
+    def __init__(self, s3, bucket: str, base: str = "alerts/", cache_files: int = 256, workers: int = FETCH_WORKERS):
+        self.s3 = s3
+        self.bucket = bucket
+        self.base = base
+        self.cache_files = cache_files
+        self.workers = workers
+        self._cache: OrderedDict[str, tuple[int, Rollup]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cached(self, directory: str) -> tuple[int, Rollup] | None:
+        with self._lock:
+            return self._cache.get(directory)
+
+    def _remember(self, directory: str, version: int, rollup: Rollup) -> None:
+        with self._lock:
+            self._cache[directory] = (version, rollup)
+            self._cache.move_to_end(directory)
+            while len(self._cache) > self.cache_files:
+                self._cache.popitem(last=False)
+
+    def _write(self, item) -> list[str]:
+        (resolution, farm_id, house_id, period), delta = item
+        directory = rollup_dir(self.base, resolution, farm_id, house_id, period)
+        version, _ = _latest_key(self.s3, self.bucket, directory)
+        cached = self._cached(directory)
+        if cached is not None and cached[0] == version:
+            current = cached[1]
+        else:
+            version, current = load_rollup(self.s3, self.bucket, directory)
+
+        for _ in range(MAX_ATTEMPTS):
+            merged = current.copy() if current is not None else Rollup(resolution, period)
+            merged.merge(delta)
+            try:
+                self.s3.put_object(
+                    Bucket=self.bucket,
+                    Key=_version_key(directory, version + 1),
+                    Body=merged.encode(),
+                    ContentType="application/octet-stream",
+                    IfNoneMatch="*",
+                )
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") not in ("PreconditionFailed", "ConditionalRequestConflict"):
+                    raise
+                version, current = load_rollup(self.s3, self.bucket, directory)  # outra instância gravou antes
+                continue
+            self._remember(directory, version + 1, merged)
+            stale = version + 1 - KEEP_VERSIONS
+            return [_version_key(directory, stale)] if stale >= 1 else []
+        raise RuntimeError(f"Rollup {directory} still contended after {MAX_ATTEMPTS} attempts")
+
+    def flush(self, buffer: RollupBuffer) -> int:
+        """Grava todos os arquivos do buffer (em paralelo); devolve quantos foram gravados."""
+        items = list(buffer.files.items())
+        if not items:
+            return 0
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(items))) as pool:
+            stale = [k for part in pool.map(self._write, items) for k in part]
+        for i in range(0, len(stale), 1000):
+            self.s3.delete_objects(
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": k} for k in stale[i:i + 1000]], "Quiet": True},
+            )
+        return len(items)
+
+# ================== LEITURA (app) ==================
+def auto_resolution(start: datetime, end: datetime) -> str:
+    """minute até 2 dias, hour até ~2 meses, day acima disso."""
+    span = end - start
+    if span <= timedelta(days=2):
+        return "minute"
+    if span <= timedelta(days=62):
+        return "hour"
+    return "day"
+
+def get_trends(
+    aws_key,
+    aws_secret,
+    region,
+    bucket,
+    prefix,
+    tenants: list[tuple[str, str]],
+    resolution: str,
+    start: datetime,
+    end: datetime,
+    trigger_keys=None,
+    signal: str | None = None,
+) -> list[dict]:
+    """
+    Pontos de `resolution` em [start, end] somados sobre `tenants`, ordenados por
+    tempo: {"time", "trigger_key", "events", "n", "min", "max", "mean"}.
+    Um LIST + um GET por (pavilhão, período), em paralelo.
+    """
+    s3 = _s3(aws_key, aws_secret, region)
+    dirs = [
+        rollup_dir(prefix, resolution, farm_id, house_id, period)
+        for farm_id, house_id in tenants
+        for period in periods_between(resolution, start, end)
+    ]
+    if not dirs:
+        return []
+    with ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, len(dirs))) as pool:
+        loaded = [r for _, r in pool.map(lambda d: load_rollup(s3, bucket, d), dirs) if r is not None]
+
+    merged: dict[str, Rollup] = {}
+    for r in loaded:
+        merged.setdefault(r.period, Rollup(resolution, r.period)).merge(r)
+    points = [
+        p for r in merged.values() for p in r.points(trigger_keys, signal)
+        if start <= p["time"] <= end
+    ]
+    return sorted(points, key=lambda p: (p["time"], p["trigger_key"]))
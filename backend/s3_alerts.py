@@ -1,15 +1,70 @@
+import gzip
+import hmac
 import json
-import boto3
-from datetime import datetime
+import time
+import uuid
+import base64
+import hashlib
+import threading
+from itertools import islice
+from urllib.parse import quote
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
+from backend.tenancy import DEFAULT_FARM, DEFAULT_HOUSE, list_tenants, tenant_marker, tenant_prefix
+
+# Catálogo mantido pelo Lambda ao lado dos alertas:
+#   <prefix>_latest.json                                   -> último alerta completo (1 GET)
+#   <prefix>_index/YYYY-MM-DD/<trigger_key>/<ts inv>-<id>.jsonl
+#       1 parte por invocação/dia/trigger; 1 linha de metadados por alerta
+# Dia e trigger_key no caminho deixam os filtros de período/tipo virarem prefixos.
+# O mesmo catálogo existe no prefixo de cada pavilhão (<prefix><shard>/<farm>/<house>/),
+# para listar/filtrar por pavilhão sem ler o dos outros.
+# Feed ao vivo (só no prefixo global), por ordem de gravação:
+#   <prefix>_feed/YYYY-MM-DD/<ms da gravação>-<id>.jsonl
+#       as mesmas linhas da invocação; o polling continua com StartAfter na chave,
+#       por isso uma parte gravada mais tarde com alertas mais antigos também aparece
+# Dias fechados são compactados (compact_alerts, job agendado):
+#   <prefix><shard>/<farm>/<house>/_segments/YYYY-MM-DD/<ts inv>-<id>.jsonl.gz
+#       os .json do pavilhão/dia num só objeto; as partes do catálogo viram o índice de offsets
+LATEST_NAME = "_latest.json"
+INDEX_DIR = "_index/"
+SEGMENTS_DIR = "_segments/"
+FEED_DIR = "_feed/"
+FEED_LAG_MS = 60_000  # o cursor do feed recua isto: cobre partes com chave escolhida antes mas gravadas depois
+_INV_BASE = 10**13  # ms invertidos: as partes mais novas aparecem primeiro na listagem
+LATEST_MAX_ATTEMPTS = 5  # compare-and-swap do _latest.json contra outras invocações
+_CAS_CONFLICT = ("PreconditionFailed", "ConditionalRequestConflict", "NoSuchKey")
+
+# Compactação
+BLOCK_BYTES = 64 * 1024          # linhas JSON por bloco gzip (antes de comprimir)
+RANGE_GAP_BYTES = 64 * 1024      # blocos do mesmo segmento a menos disto saem no mesmo GET de faixa
+COMPACTED_SUFFIX = ".seg.jsonl"  # parte do catálogo já compactada (linhas com seg/off/len/line)
+LOCATION_FIELDS = ("seg", "off", "len", "line")
+
+# Leitura paginada
+PAGE_SIZE = 20
+FETCH_WORKERS = 8   # GETs simultâneos por página
+
+_clients = {}
+_clients_lock = threading.Lock()
 
 def _s3(aws_key, aws_secret, region):
-    return boto3.client(
-        "s3",
-        aws_access_key_id=aws_key,
-        aws_secret_access_key=aws_secret,
-        region_name=region,
-    )
+    # um cliente por credencial/região, partilhado entre reruns e sessões do Streamlit
+    cache_key = (aws_key, aws_secret, region)
+    client = _clients.get(cache_key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(cache_key)
+            if client is None:
+                import boto3  # só quando há cliente a criar (o Lambda usa os seus próprios)
+                client = _clients[cache_key] = boto3.client(
+                    "s3",
+                    aws_access_key_id=aws_key,
+                    aws_secret_access_key=aws_secret,
+                    region_name=region,
+                )
+    return client
 
 def _presigned(s3, bucket, key, minutes=30):
     return s3.generate_presigned_url(
@@ -18,20 +73,637 @@ def _presigned(s3, bucket, key, minutes=30):
         ExpiresIn=minutes * 60,
     )
 
+# ================== PRE-SIGNED URLS ==================
+def _sign(key, msg):
+    return hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
+
+class PresignCache:
+    """
+    URLs pré-assinadas (GET) geradas sob demanda e guardadas por sessão até
+    `margin_s` antes de expirarem. A chave SigV4 derivada (4 HMACs) é calculada
+    uma vez por dia e reutilizada, então assinar um lote custa 1 HMAC por URL.
+    """
+
+    def __init__(self, aws_key, aws_secret, region, minutes=30, margin_s=60, session_token=None):
+        if not aws_key or not aws_secret:
+            import boto3
+            creds = boto3.Session().get_credentials()
+            if creds is None:
+                raise RuntimeError("No AWS credentials available for pre-signing.")
+            creds = creds.get_frozen_credentials()
+            aws_key, aws_secret, session_token = creds.access_key, creds.secret_key, creds.token
+        self.aws_key = aws_key
+        self.aws_secret = aws_secret
+        self.session_token = session_token
+        self.region = region or "us-east-1"
+        self.expires_s = int(minutes * 60)
+        self.margin_s = margin_s
+        self._urls = {}
+        self._signing_key = (None, None)  # (YYYYMMDD, chave)
+        self._lock = threading.Lock()
+
+    def _derived_key(self, datestamp):
+        day, key = self._signing_key
+        if day != datestamp:
+            key = _sign(("AWS4" + self.aws_secret).encode("utf-8"), datestamp)
+            for part in (self.region, "s3", "aws4_request"):
+                key = _sign(key, part)
+            self._signing_key = (datestamp, key)
+        return key
+
+    def _presign(self, bucket, key, now):
+        amz_date = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime(now))
+        datestamp = amz_date[:8]
+        endpoint = "s3.amazonaws.com" if self.region == "us-east-1" else f"s3.{self.region}.amazonaws.com"
+        if "." in bucket:  # path-style: bucket com ponto quebra o certificado virtual-hosted
+            host = endpoint
+            path = f"/{quote(bucket, safe='')}/{quote(key, safe='/~')}"
+        else:
+            host = f"{bucket}.{endpoint}"
+            path = f"/{quote(key, safe='/~')}"
+        scope = f"{datestamp}/{self.region}/s3/aws4_request"
+        params = {
+            "X-Amz-Algorithm": "AWS4-HMAC-SHA256",
+            "X-Amz-Credential": f"{self.aws_key}/{scope}",
+            "X-Amz-Date": amz_date,
+            "X-Amz-Expires": str(self.expires_s),
+            "X-Amz-SignedHeaders": "host",
+        }
+        if self.session_token:
+            params["X-Amz-Security-Token"] = self.session_token
+        query = "&".join(f"{quote(k, safe='~')}={quote(v, safe='~')}" for k, v in sorted(params.items()))
+        canonical = f"GET\n{path}\n{query}\nhost:{host}\n\nhost\nUNSIGNED-PAYLOAD"
+        to_sign = "\n".join((
+            "AWS4-HMAC-SHA256", amz_date, scope,
+            hashlib.sha256(canonical.encode("utf-8")).hexdigest(),
+        ))
+        signature = hmac.new(self._derived_key(datestamp), to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+        return f"https://{host}{path}?{query}&X-Amz-Signature={signature}"
+
+    def url(self, bucket, key, now=None):
+        return self.urls(bucket, [key], now)[key]
+
+    def urls(self, bucket, keys, now=None):
+        """URLs para várias chaves de uma vez (reaproveita as ainda válidas)."""
+        now = time.time() if now is None else now
+        out = {}
+        with self._lock:
+            for key in keys:
+                cached = self._urls.get((bucket, key))
+                if cached and cached[1] - self.margin_s > now:
+                    out[key] = cached[0]
+                    continue
+                url = self._presign(bucket, key, now)
+                self._urls[(bucket, key)] = (url, now + self.expires_s)
+                out[key] = url
+        return out
+
 def _list_json(s3, bucket, prefix):
     paginator = s3.get_paginator("list_objects_v2")
     pages = paginator.paginate(Bucket=bucket, Prefix=prefix or "")
     objs = []
     for page in pages:
         for o in page.get("Contents", []) or []:
+            rel = o["Key"][len(prefix or ""):]
+            if any(part.startswith("_") for part in rel.split("/")):  # catálogo, não é alerta
+                continue
             if o["Key"].lower().endswith(".json"):
                 objs.append(o)
     objs.sort(key=lambda x: x["LastModified"], reverse=True)
     return objs
 
+def _parse_ts(value):
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+def _iso(dt):
+    """datetime (ou ISO já pronto) -> ISO UTC com "Z", comparável como string."""
+    if dt is None or isinstance(dt, str):
+        return dt
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+# ================== CATÁLOGO (escrito pelo Lambda) ==================
+def _trigger_from_source(payload):
+    # alertas antigos: triggers/<trigger_key>/YYYY/MM/DD/<ts>.txt
+    parts = ((payload.get("source") or {}).get("key") or "").split("/")
+    return parts[1] if len(parts) > 2 else None
+
+def index_entry(key, payload):
+    """Linha do catálogo para um alerta gravado em `key` (o payload só vai para o _latest.json)."""
+    return {
+        "key": key,
+        "ts": _iso(_parse_ts(payload["generated_at"])),
+        "trigger_key": payload.get("trigger_key") or _trigger_from_source(payload) or "unknown",
+        "farm_id": payload.get("farm_id") or DEFAULT_FARM,
+        "house_id": payload.get("house_id") or DEFAULT_HOUSE,
+        "preview": (payload.get("alert") or "")[:160],
+        "data": payload,
+    }
+
+def _index_lines(entries):
+    return "\n".join(
+        json.dumps({k: v for k, v in e.items() if k != "data"}, ensure_ascii=False, separators=(",", ":"))
+        for e in entries
+    )
+
+def _feed_key(prefix, ms, suffix=""):
+    day = datetime.fromtimestamp(ms / 1000, tz=timezone.utc).strftime("%Y-%m-%d")
+    return f"{prefix}{FEED_DIR}{day}/{ms:013d}{suffix}"
+
+def _feed_ms(part_key):
+    return int(part_key.rsplit("/", 1)[1][:13])
+
+def write_feed_part(s3, bucket, entries, prefix="alerts/"):
+    """Parte do feed com as entradas de uma invocação (chave = hora da gravação); devolve a chave."""
+    if not entries:
+        return None
+    key = _feed_key(prefix, int(time.time() * 1000), f"-{uuid.uuid4().hex[:8]}.jsonl")
+    entries = sorted(entries, key=lambda e: (e["ts"], e["key"]), reverse=True)
+    s3.put_object(Bucket=bucket, Key=key, Body=_index_lines(entries).encode("utf-8"),
+                  ContentType="application/x-ndjson; charset=utf-8")
+    return key
+
+def write_alert_index(s3, bucket, entries, prefix="alerts/", feed_key=None):
+    """
+    Publica as entradas de uma invocação: uma parte .jsonl por dia (escrita única,
+    sem corrida entre Lambdas) e atualiza o ponteiro _latest.json se houver algo
+    mais novo do que o atual. Com `feed_key` (parte do feed já gravada) o ponteiro
+    é sempre regravado com ela, para o ETag mudar mesmo quando os alertas desta
+    invocação são mais antigos do que o atual (o feed do app só lê com ETag novo).
+    """
+    if not entries:
+        return []
+    entries = sorted(entries, key=lambda e: (e["ts"], e["key"]), reverse=True)
+    groups = {}
+    for e in entries:
+        groups.setdefault((e["ts"][:10], e["trigger_key"]), []).append(e)
+
+    written = []
+    for (day, trigger_key), items in groups.items():
+        newest_ms = int(_parse_ts(items[0]["ts"]).timestamp() * 1000)
+        key = f"{prefix}{INDEX_DIR}{day}/{trigger_key}/{_INV_BASE - newest_ms:013d}-{uuid.uuid4().hex[:8]}.jsonl"
+        s3.put_object(Bucket=bucket, Key=key, Body=_index_lines(items).encode("utf-8"),
+                      ContentType="application/x-ndjson; charset=utf-8")
+        written.append(key)
+
+    # compare-and-swap: só grava sobre o ETag lido (ou se ainda não existir); se outra
+    # invocação mudou o ponteiro entretanto, relê e volta a comparar
+    newest = entries[0]
+    for _ in range(LATEST_MAX_ATTEMPTS):
+        current, etag = _read_latest(s3, bucket, prefix)
+        latest = newest if current is None or current.get("ts", "") <= newest["ts"] else current
+        if latest is not newest and not feed_key:
+            return written
+        if feed_key:
+            latest = {**latest, "feed": feed_key}
+        try:
+            s3.put_object(
+                Bucket=bucket,
+                Key=f"{prefix}{LATEST_NAME}",
+                Body=json.dumps(latest, ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+                ContentType="application/json; charset=utf-8",
+                **({"IfMatch": etag} if etag else {"IfNoneMatch": "*"}),
+            )
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in _CAS_CONFLICT:
+                raise
+            continue
+        return written
+    raise RuntimeError(f"{prefix}{LATEST_NAME} still contended after {LATEST_MAX_ATTEMPTS} attempts")
+
+def _is_missing(e: ClientError) -> bool:
+    return e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404")
+
+def _read_latest(s3, bucket, prefix):
+    """(entrada, ETag) do _latest.json; (None, None) se não existir. Outros erros sobem."""
+    try:
+        obj = s3.get_object(Bucket=bucket, Key=f"{prefix}{LATEST_NAME}")
+    except ClientError as e:
+        if _is_missing(e):
+            return None, None
+        raise
+    return json.loads(obj["Body"].read()), obj.get("ETag")
+
+_marked_tenants = set()
+
+def write_tenant_indexes(s3, bucket, entries, prefix="alerts/", workers=FETCH_WORKERS):
+    """
+    Catálogo global + um catálogo por pavilhão, gravados em paralelo, e o
+    marcador do pavilhão (1ª vez que este processo o vê) para list_tenants.
+    A parte do feed vai antes: quando o _latest.json global muda, já está listável.
+    """
+    groups = {}
+    for e in entries:
+        groups.setdefault((e["farm_id"], e["house_id"]), []).append(e)
+    feed_key = write_feed_part(s3, bucket, entries, prefix)
+    jobs = [(prefix, entries, feed_key)] + [(f"{prefix}{tenant_prefix(*t)}", items, None) for t, items in groups.items()]
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(jobs)))) as pool:
+        written = pool.map(lambda job: write_alert_index(s3, bucket, job[1], job[0], job[2]), jobs)
+        mark_tenants(s3, bucket, groups, prefix, workers)
+        written = [k for part in written for k in part]
+    return written
+
+def mark_tenants(s3, bucket, tenants, prefix="alerts/", workers=FETCH_WORKERS):
+    """Marcadores de list_tenants dos pavilhões que este processo ainda não marcou."""
+    new_tenants = [t for t in tenants if (bucket, prefix, t) not in _marked_tenants]
+    if not new_tenants:
+        return
+    with ThreadPoolExecutor(max_workers=min(workers, len(new_tenants))) as pool:
+        list(pool.map(lambda t: s3.put_object(Bucket=bucket, Key=tenant_marker(prefix, *t), Body=b""), new_tenants))
+    _marked_tenants.update((bucket, prefix, t) for t in new_tenants)
+
+def _index_days(s3, bucket, prefix):
+    """Partições diárias do catálogo, da mais recente para a mais antiga."""
+    paginator = s3.get_paginator("list_objects_v2")
+    days = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix}{INDEX_DIR}", Delimiter="/"):
+        days.extend(p["Prefix"] for p in page.get("CommonPrefixes", []) or [])
+    return sorted(days, reverse=True)
+
+def _read_lines(s3, bucket, key):
+    raw = s3.get_object(Bucket=bucket, Key=key)["Body"].read().decode("utf-8")
+    return [json.loads(line) for line in raw.splitlines() if line.strip()]
+
+def _part_newest(part_key):
+    """ISO (limite superior, ms) do alerta mais novo de uma parte, a partir do nome."""
+    inv = int(part_key.rsplit("/", 1)[1].split("-", 1)[0])
+    ms = _INV_BASE - inv
+    return _iso(datetime.fromtimestamp(ms / 1000, tz=timezone.utc))[:-4] + "999Z"
+
+def _iter_index(s3, bucket, prefix, since=None, until=None, trigger_keys=None, days=None):
+    """
+    Metadados do catálogo, dos mais novos para os mais antigos. Só lê os dias
+    dentro de [since, until] e, com trigger_keys, só os prefixos desses triggers.
+    As partes são lidas em paralelo, em blocos, e só o necessário para a página.
+    """
+    paginator = s3.get_paginator("list_objects_v2")
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+        for day_prefix in (days if days is not None else _index_days(s3, bucket, prefix)):
+            day = day_prefix[-11:-1]
+            if until and day > until[:10]:
+                continue
+            if since and day < since[:10]:
+                break
+            prefixes = [f"{day_prefix}{tk}/" for tk in trigger_keys] if trigger_keys else [day_prefix]
+            parts = []
+            for pfx in prefixes:
+                for page in paginator.paginate(Bucket=bucket, Prefix=pfx):
+                    parts.extend(o["Key"] for o in page.get("Contents", []) or [])
+            # nome da parte = ms invertido do alerta mais novo dela -> ordem = mais nova primeiro
+            parts.sort(key=lambda k: k.rsplit("/", 1)[1])
+            if since:
+                # partes cujo alerta mais novo é anterior a `since` não têm nada a ler
+                parts = [k for k in parts if _part_newest(k) >= since]
+
+            pending = []
+            for i in range(0, len(parts), FETCH_WORKERS):
+                chunk = parts[i:i + FETCH_WORKERS]
+                for lines in pool.map(lambda k: _read_lines(s3, bucket, k), chunk):
+                    pending.extend(
+                        e for e in lines
+                        if (not since or e["ts"] >= since) and (not until or e["ts"] <= until)
+                    )
+                pending.sort(key=lambda e: (e["ts"], e["key"]), reverse=True)
+                # o que é mais novo que a próxima parte já está na ordem final
+                rest = parts[i + FETCH_WORKERS:i + FETCH_WORKERS + 1]
+                bound = _part_newest(rest[0]) if rest else ""
+                ready = 0
+                while ready < len(pending) and pending[ready]["ts"] > bound:
+                    ready += 1
+                yield from pending[:ready]
+                pending = pending[ready:]
+
+def _iter_listing(s3, bucket, prefix, since=None, until=None):
+    """Bucket sem catálogo: listagem completa, metadados só do LastModified."""
+    for o in _list_json(s3, bucket, prefix):
+        ts = _iso(o["LastModified"])
+        if (since and ts < since) or (until and ts > until):
+            continue
+        yield {"key": o["Key"], "ts": ts, "trigger_key": None}
+
+def iter_alert_entries(s3, bucket, prefix="alerts/", since=None, until=None, trigger_keys=None):
+    """Metadados dos alertas (sem corpo), do mais novo para o mais antigo, sob demanda."""
+    since, until = _iso(since), _iso(until)
+    days = _index_days(s3, bucket, prefix)
+    if days:
+        yield from _iter_index(s3, bucket, prefix, since, until, trigger_keys, days)
+        return
+    for e in _iter_listing(s3, bucket, prefix, since, until):
+        yield e
+
+def rebuild_alert_index(aws_key, aws_secret, region, bucket, prefix="alerts/"):
+    """Gera o catálogo a partir dos alertas já existentes (buckets anteriores ao índice)."""
+    s3 = _s3(aws_key, aws_secret, region)
+    entries = []
+    for o in _list_json(s3, bucket, prefix):
+        try:
+            payload = json.loads(s3.get_object(Bucket=bucket, Key=o["Key"])["Body"].read().decode("utf-8"))
+        except Exception:
+            continue
+        if not payload.get("generated_at"):
+            payload["generated_at"] = _iso(o["LastModified"])
+        entries.append(index_entry(o["Key"], payload))
+    return write_alert_index(s3, bucket, entries, prefix)
+
+# ================== COMPACTAÇÃO (job agendado) ==================
+# Segmento = blocos gzip concatenados, cada um com até BLOCK_BYTES de linhas JSON
+# (os payloads completos, do mais novo para o mais antigo). O arquivo inteiro é um
+# .jsonl.gz comum (zcat lê) e cada bloco descomprime sozinho, por isso um alerta
+# sai com um GET de faixa só do seu bloco. O índice de offsets é o próprio
+# catálogo: as partes do dia/trigger viram uma só, com seg/off/len/line por linha.
+def build_segment(payloads, block_bytes=BLOCK_BYTES):
+    """(bytes do segmento, [(off, len, line)] de cada payload, na mesma ordem)."""
+    body = bytearray()
+    locations = []
+    lines = []
+
+    def close_block():
+        member = gzip.compress(("\n".join(lines) + "\n").encode("utf-8"), mtime=0)
+        locations.extend((len(body), len(member), i) for i in range(len(lines)))
+        body.extend(member)
+        lines.clear()
+
+    size = 0
+    for payload in payloads:
+        line = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+        if lines and size + len(line) > block_bytes:
+            close_block()
+            size = 0
+        lines.append(line)
+        size += len(line) + 1
+    if lines:
+        close_block()
+    return bytes(body), locations
+
+def _get_json(s3, bucket, key):
+    try:
+        return json.loads(s3.get_object(Bucket=bucket, Key=key)["Body"].read().decode("utf-8"))
+    except (ClientError, ValueError):
+        return None  # sumiu ou está corrompido: a entrada fica como está (solta)
+
+def _delete_keys(s3, bucket, keys):
+    keys = list(keys)
+    for i in range(0, len(keys), 1000):
+        s3.delete_objects(Bucket=bucket, Delete={"Objects": [{"Key": k} for k in keys[i:i + 1000]], "Quiet": True})
+    return len(keys)
+
+def _day_parts(s3, bucket, prefix, day):
+    """{trigger_key: [chaves das partes]} de um dia do catálogo."""
+    day_prefix = f"{prefix}{INDEX_DIR}{day}/"
+    parts = {}
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=day_prefix):
+        for o in page.get("Contents", []) or []:
+            parts.setdefault(o["Key"][len(day_prefix):].split("/", 1)[0], []).append(o["Key"])
+    return parts
+
+def _is_compacted(parts):
+    return all(len(keys) == 1 and keys[0].endswith(COMPACTED_SUFFIX) for keys in parts.values())
+
+def compact_catalog(s3, bucket, prefix, day, known=None, workers=FETCH_WORKERS):
+    """
+    Compacta um dia do catálogo em `prefix`: os alertas ainda soltos (de todos os
+    triggers) vão para um segmento novo do dia e as partes de cada trigger_key
+    são trocadas por uma só. `known` = {chave do alerta: localização} já gravada
+    noutro catálogo (o global reaproveita os segmentos dos pavilhões).
+    Devolve {chave do alerta: localização} de tudo o que ficou compactado.
+    Ordem: segmento -> partes novas -> apaga as antigas; se parar a meio, a
+    próxima execução junta as partes de novo (linhas repetidas saem pela chave).
+    """
+    known = known or {}
+    parts = _day_parts(s3, bucket, prefix, day)
+    by_trigger = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for trigger_key, part_keys in parts.items():
+            entries = by_trigger[trigger_key] = {}
+            for lines in pool.map(lambda k: _read_lines(s3, bucket, k), part_keys):
+                for e in lines:
+                    current = entries.get(e["key"])
+                    if current is None or ("seg" in e and "seg" not in current):
+                        entries[e["key"]] = e
+        loose = []
+        for entries in by_trigger.values():
+            for e in entries.values():
+                if "seg" not in e and e["key"] in known:
+                    e.update(known[e["key"]])
+                elif "seg" not in e:
+                    loose.append(e)
+        loose.sort(key=lambda e: (e["ts"], e["key"]), reverse=True)
+        fetched = [(e, p) for e, p in zip(loose, pool.map(lambda e: _get_json(s3, bucket, e["key"]), loose)) if p]
+
+    if fetched:
+        body, locations = build_segment([p for _, p in fetched])
+        newest_ms = int(_parse_ts(fetched[0][0]["ts"]).timestamp() * 1000)
+        seg_key = f"{prefix}{SEGMENTS_DIR}{day}/{_INV_BASE - newest_ms:013d}-{uuid.uuid4().hex[:8]}.jsonl.gz"
+        s3.put_object(Bucket=bucket, Key=seg_key, Body=body, ContentType="application/gzip")
+        for (e, _), (off, length, line) in zip(fetched, locations):
+            e.update(seg=seg_key, off=off, len=length, line=line)
+
+    located = {}
+    stale = []
+    for trigger_key, entries in sorted(by_trigger.items()):
+        items = sorted(entries.values(), key=lambda e: (e["ts"], e["key"]), reverse=True)
+        located.update({e["key"]: {f: e[f] for f in LOCATION_FIELDS} for e in items if "seg" in e})
+        part_keys = parts[trigger_key]
+        if len(part_keys) == 1 and part_keys[0].endswith(COMPACTED_SUFFIX) and all("seg" in e for e in items):
+            continue  # já compactado
+        newest_ms = int(_parse_ts(items[0]["ts"]).timestamp() * 1000)
+        part_key = (f"{prefix}{INDEX_DIR}{day}/{trigger_key}/"
+                    f"{_INV_BASE - newest_ms:013d}-{uuid.uuid4().hex[:8]}{COMPACTED_SUFFIX}")
+        s3.put_object(
+            Bucket=bucket, Key=part_key,
+            Body="\n".join(json.dumps(e, ensure_ascii=False, separators=(",", ":")) for e in items).encode("utf-8"),
+            ContentType="application/x-ndjson; charset=utf-8",
+        )
+        stale.extend(part_keys)
+    _delete_keys(s3, bucket, stale)
+    return located
+
+def compact_day(s3, bucket, prefix, day, keep=(), workers=FETCH_WORKERS):
+    """
+    Compacta um dia: primeiro o catálogo de cada pavilhão (segmentos por pavilhão),
+    depois o global (aponta para os mesmos segmentos) e, com os dois reescritos,
+    apaga os .json soltos (menos os de `keep`: os dos _latest.json, ver _pointed_keys).
+    Devolve {"alerts": n, "deleted": n} ou None se o dia já estava compactado.
+    """
+    parts = _day_parts(s3, bucket, prefix, day)
+    if not parts or _is_compacted(parts):
+        return None
+    part_keys = [k for keys in parts.values() for k in keys]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        entries = [e for lines in pool.map(lambda k: _read_lines(s3, bucket, k), part_keys) for e in lines]
+    tenants = sorted({(e.get("farm_id") or DEFAULT_FARM, e.get("house_id") or DEFAULT_HOUSE) for e in entries})
+    known = {}
+    for farm_id, house_id in tenants:
+        known.update(compact_catalog(s3, bucket, f"{prefix}{tenant_prefix(farm_id, house_id)}", day, None, workers))
+    known.update(compact_catalog(s3, bucket, prefix, day, known, workers))
+    deleted = _delete_keys(s3, bucket, (k for k in known if k not in keep))
+    return {"alerts": len(known), "deleted": deleted}
+
+def _pointed_keys(s3, bucket, prefix, workers=FETCH_WORKERS):
+    """
+    Alertas para onde apontam o _latest.json global e o de cada pavilhão: ficam
+    fora da limpeza (um pavilhão parado há dias ainda aponta para um .json do dia
+    compactado). Um erro na leitura sobe: sem saber o que manter, não se apaga nada.
+    """
+    prefixes = [prefix] + [f"{prefix}{tenant_prefix(*t)}" for t in list_tenants(s3, bucket, prefix)]
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(prefixes)))) as pool:
+        pointers = list(pool.map(lambda p: _read_latest(s3, bucket, p)[0], prefixes))
+    return {e["key"] for e in pointers if e and e.get("key")}
+
+def _prune_feed(s3, bucket, prefix, last_day):
+    """Apaga as partes do feed gravadas até `last_day` (o feed ao vivo só lê as recentes)."""
+    paginator = s3.get_paginator("list_objects_v2")
+    stale = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix}{FEED_DIR}", Delimiter="/"):
+        for p in page.get("CommonPrefixes", []) or []:
+            if p["Prefix"][-11:-1] <= last_day:
+                for day_page in paginator.paginate(Bucket=bucket, Prefix=p["Prefix"]):
+                    stale.extend(o["Key"] for o in day_page.get("Contents", []) or [])
+    return _delete_keys(s3, bucket, stale)
+
+def compact_alerts(s3, bucket, prefix="alerts/", min_age_days=2, lookback_days=7, since=None, now=None,
+                   workers=FETCH_WORKERS):
+    """
+    Job agendado: compacta os dias com pelo menos `min_age_days` (já fechados;
+    o Lambda ainda pode gravar eventos atrasados de ontem) dos últimos
+    `lookback_days`, ou desde `since` ("YYYY-MM-DD", para o histórico antigo).
+    Dias já compactados custam 1 LIST. Alertas que chegarem depois a um dia
+    compactado ficam soltos até a próxima passagem por esse dia. As partes do
+    feed desses dias são apagadas.
+    """
+    today = (now or datetime.now(timezone.utc)).date()
+    last = (today - timedelta(days=min_age_days)).isoformat()
+    first = since or (today - timedelta(days=min_age_days + lookback_days - 1)).isoformat()
+    keep = _pointed_keys(s3, bucket, prefix, workers)
+    result = {"days": 0, "alerts": 0, "deleted": 0}
+    for day_prefix in sorted(_index_days(s3, bucket, prefix)):
+        day = day_prefix[-11:-1]
+        if not first <= day <= last:
+            continue
+        done = compact_day(s3, bucket, prefix, day, keep, workers)
+        if done:
+            result["days"] += 1
+            result["alerts"] += done["alerts"]
+            result["deleted"] += done["deleted"]
+    result["feed_deleted"] = _prune_feed(s3, bucket, prefix, last)
+    return result
+
+# ================== LEITURA ==================
+def _from_entry(s3, bucket, entry, presign_mins):
+    return {
+        "key": entry["key"],
+        "data": entry["data"],
+        "presigned_url": _presigned(s3, bucket, entry["key"], presign_mins),
+        "ts": _parse_ts(entry["ts"]),
+    }
+
+def _load_item(s3, bucket, entry):
+    try:
+        raw = s3.get_object(Bucket=bucket, Key=entry["key"])["Body"].read()
+        data = json.loads(raw.decode("utf-8"))
+    except Exception as e:
+        data = {"parse_error": str(e)}
+    return {"key": entry["key"], "data": data, "ts": _parse_ts(entry["ts"])}
+
+def _read_ranges(s3, bucket, entries, pool):
+    """
+    Blocos dos segmentos usados por `entries`: {(seg, off): [linhas] | erro}.
+    Blocos próximos do mesmo segmento saem no mesmo GET de faixa (Range).
+    """
+    blocks = {}
+    for e in entries:
+        blocks.setdefault(e["seg"], set()).add((e["off"], e["len"]))
+    ranges = []
+    for seg, items in blocks.items():
+        start = end = None
+        for off, length in sorted(items):
+            if start is not None and off - end <= RANGE_GAP_BYTES:
+                end = max(end, off + length)
+                continue
+            if start is not None:
+                ranges.append((seg, start, end))
+            start, end = off, off + length
+        ranges.append((seg, start, end))
+
+    def fetch(r):
+        seg, start, end = r
+        wanted = [(off, length) for off, length in blocks[seg] if start <= off < end]
+        try:
+            raw = s3.get_object(Bucket=bucket, Key=seg, Range=f"bytes={start}-{end - 1}")["Body"].read()
+        except Exception as e:
+            return {(seg, off): e for off, _ in wanted}
+        out = {}
+        for off, length in wanted:
+            try:
+                out[(seg, off)] = gzip.decompress(raw[off - start:off - start + length]).decode("utf-8").splitlines()
+            except Exception as e:
+                out[(seg, off)] = e
+        return out
+
+    found = {}
+    for part in pool.map(fetch, ranges):
+        found.update(part)
+    return found
+
+def _load_items(s3, bucket, entries):
+    """
+    Corpos de uma lista de entradas do catálogo, na mesma ordem: alertas soltos
+    com 1 GET cada; compactados com 1 GET de faixa por grupo de blocos.
+    Itens compactados trazem "segment" (o .json original já não existe).
+    """
+    loose = [e for e in entries if "seg" not in e]
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+        blocks = _read_ranges(s3, bucket, [e for e in entries if "seg" in e], pool)
+        bodies = dict(zip((e["key"] for e in loose), pool.map(lambda e: _load_item(s3, bucket, e), loose)))
+    items = []
+    for e in entries:
+        if "seg" not in e:
+            items.append(bodies[e["key"]])
+            continue
+        block = blocks.get((e["seg"], e["off"]))
+        try:
+            if isinstance(block, Exception):
+                raise block
+            data = json.loads(block[e["line"]])
+        except Exception as exc:
+            data = {"parse_error": str(exc)}
+        items.append({"key": e["key"], "data": data, "ts": _parse_ts(e["ts"]), "segment": e["seg"]})
+    return items
+
+def _encode_cursor(entry):
+    raw = json.dumps([entry["ts"], entry["key"]]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+def _decode_cursor(cursor):
+    ts, key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    return ts, key
+
+def alerts_version(aws_key, aws_secret, region, bucket, prefix="alerts/"):
+    """
+    Sinal barato de mudança (1 HEAD): ETag do _latest.json, que o Lambda
+    reescreve a cada alerta novo. "" quando o bucket ainda não tem catálogo.
+    """
+    s3 = _s3(aws_key, aws_secret, region)
+    try:
+        return s3.head_object(Bucket=bucket, Key=f"{prefix}{LATEST_NAME}").get("ETag", "")
+    except ClientError:
+        return ""
+
+def get_tenants(aws_key, aws_secret, region, bucket, prefix="alerts/"):
+    """Pavilhões conhecidos (com alertas ou leituras): [(farm_id, house_id)]."""
+    return list_tenants(_s3(aws_key, aws_secret, region), bucket, prefix)
+
 def get_latest_alert(aws_key, aws_secret, region, bucket, prefix="alerts/", presign_mins=30):
-    """Busca o alerta JSON mais recente do bucket."""
+    """Busca o alerta JSON mais recente do bucket (1 GET no ponteiro _latest.json)."""
     s3 = _s3(aws_key, aws_secret, region)
+    try:
+        entry = json.loads(s3.get_object(Bucket=bucket, Key=f"{prefix}{LATEST_NAME}")["Body"].read())
+        return _from_entry(s3, bucket, entry, presign_mins)
+    except ClientError:
+        pass
+
+    # bucket sem catálogo: listagem completa
     objs = _list_json(s3, bucket, prefix)
     if not objs:
         raise RuntimeError("No JSON messages found.")
@@ -46,24 +718,127 @@ def get_latest_alert(aws_key, aws_secret, region, bucket, prefix="alerts/", pres
         "ts": o["LastModified"],
     }
 
-def get_all_alerts(aws_key, aws_secret, region, bucket, prefix="alerts/", presign_mins=30, limit=None):
-    """Lista todos os alertas JSON, ordenados do mais recente pro mais antigo."""
+def get_alerts_page(
+    aws_key,
+    aws_secret,
+    region,
+    bucket,
+    prefix="alerts/",
+    page_size=PAGE_SIZE,
+    cursor=None,
+    since=None,
+    until=None,
+    trigger_keys=None,
+    tenants=None,
+):
+    """
+    Uma página de alertas, do mais recente pro mais antigo.
+    Só os corpos desta página são baixados (em paralelo) e parseados; os itens
+    não trazem URL pré-assinada (use PresignCache quando o usuário pedir).
+    Com `tenants` ([(farm_id, house_id)]) lê o catálogo de cada pavilhão em
+    paralelo e junta os resultados.
+    Retorna {"items": [...], "next_cursor": str | None}; passe next_cursor
+    na chamada seguinte para continuar de onde parou.
+    """
     s3 = _s3(aws_key, aws_secret, region)
-    objs = _list_json(s3, bucket, prefix)
-    if limit:
-        objs = objs[:limit]
+    after = _decode_cursor(cursor) if cursor else None
+    if after:
+        until = min(_iso(until), after[0]) if until else after[0]
+
+    def head(pfx):
+        entries = (
+            e for e in iter_alert_entries(s3, bucket, pfx, since, until, trigger_keys)
+            if not after or (e["ts"], e["key"]) < after
+        )
+        return list(islice(entries, page_size + 1))
+
+    if tenants:
+        # as page_size+1 primeiras da união estão entre as page_size+1 primeiras de cada pavilhão
+        with ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, len(tenants))) as pool:
+            heads = pool.map(head, [f"{prefix}{tenant_prefix(f, h)}" for f, h in tenants])
+            page = sorted((e for part in heads for e in part), key=lambda e: (e["ts"], e["key"]), reverse=True)
+        page = page[:page_size + 1]
+    else:
+        page = head(prefix)
+    has_more = len(page) > page_size
+    page = page[:page_size]
+    return {"items": _load_items(s3, bucket, page), "next_cursor": _encode_cursor(page[-1]) if has_more else None}
+
+def _encode_feed_cursor(start_after, seen):
+    raw = json.dumps({"after": start_after, "seen": sorted(seen)}).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+def _decode_feed_cursor(cursor):
+    try:
+        c = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except ValueError:
+        return None
+    return c if isinstance(c, dict) else None  # cursor antigo ([ts, key]): recomeça
+
+def _feed_parts(s3, bucket, prefix, start_after):
+    paginator = s3.get_paginator("list_objects_v2")
+    return [
+        o["Key"]
+        for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix}{FEED_DIR}", StartAfter=start_after)
+        for o in page.get("Contents", []) or []
+    ]
+
+def get_alerts_after(aws_key, aws_secret, region, bucket, prefix="alerts/", after=None, limit=PAGE_SIZE):
+    """
+    Alertas gravados depois do cursor `after` (polling incremental do feed).
+    Sem cursor, devolve só os `limit` mais recentes. O cursor anda sobre as
+    chaves das partes de _feed/ (ordem de gravação, StartAfter), não sobre o
+    `ts` dos alertas: uma parte gravada depois por um Lambda mais lento, com
+    alertas mais antigos, ainda aparece. O cursor recua FEED_LAG_MS e guarda as
+    partes já lidas nessa folga. O custo cresce com as partes novas, não com o
+    histórico. Retorna {"items": [...mais novo primeiro], "after": cursor}.
+    """
+    s3 = _s3(aws_key, aws_secret, region)
+    cursor = _decode_feed_cursor(after) if after else None
+    if cursor is None:
+        start = _feed_key(prefix, int(time.time() * 1000) - FEED_LAG_MS)
+        fresh = list(islice(iter_alert_entries(s3, bucket, prefix), limit))
+        parts = _feed_parts(s3, bucket, prefix, start)  # já cobertas pelos mais recentes acima
+    else:
+        start = cursor["after"]
+        seen = set(cursor.get("seen", ()))
+        parts = _feed_parts(s3, bucket, prefix, start)
+        new_parts = [k for k in parts if k not in seen]
+        with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+            lines = [e for part in pool.map(lambda k: _read_lines(s3, bucket, k), new_parts) for e in part]
+        fresh = sorted({e["key"]: e for e in lines}.values(), key=lambda e: (e["ts"], e["key"]), reverse=True)
+        fresh = fresh[:limit]
+    if parts:
+        start = max(start, _feed_key(prefix, max(_feed_ms(k) for k in parts) - FEED_LAG_MS))
+    seen = [k for k in parts if k > start]
+    return {"items": _load_items(s3, bucket, fresh), "after": _encode_feed_cursor(start, seen)}
+
+def get_all_alerts(aws_key, aws_secret, region, bucket, prefix="alerts/", presign_mins=30, limit=None, *,
+                   presigner=None):
+    """
+    Lista todos os alertas JSON, ordenados do mais recente pro mais antigo, com
+    "presigned_url" (válida por `presign_mins`; 0/None = sem URL). Com `presigner`
+    (o PresignCache da sessão) as URLs saem dele, reaproveitando as já assinadas.
+    Alertas compactados não têm objeto próprio: ficam com presigned_url None.
+    """
     results = []
-    for o in objs:
-        key = o["Key"]
-        try:
-            raw = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
-            data = json.loads(raw.decode("utf-8"))
-        except Exception as e:
-            data = {"parse_error": str(e)}
-        results.append({
-            "key": key,
-            "data": data,
-            "presigned_url": _presigned(s3, bucket, key, presign_mins),
-            "ts": o["LastModified"],
-        })
+    cursor = None
+    while True:
+        size = min(PAGE_SIZE * 5, limit - len(results)) if limit else PAGE_SIZE * 5
+        page = get_alerts_page(aws_key, aws_secret, region, bucket, prefix, page_size=size, cursor=cursor)
+        results.extend(page["items"])
+        cursor = page["next_cursor"]
+        if not cursor or (limit and len(results) >= limit):
+            break
+
+    keys = [r["key"] for r in results if "segment" not in r]
+    if presigner is not None:
+        urls = presigner.urls(bucket, keys) if keys else {}
+    elif presign_mins:
+        s3 = _s3(aws_key, aws_secret, region)
+        urls = {k: _presigned(s3, bucket, k, presign_mins) for k in keys}
+    else:
+        return results
+    for r in results:
+        r["presigned_url"] = urls.get(r["key"])
     return results
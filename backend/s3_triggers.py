@@ -1,7 +1,12 @@
 # backend/s3_triggers.py
-import boto3
+import time
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from botocore.exceptions import ClientError
+from backend.sensor_batch import CONTENT_TYPE, EXTENSION, encode_batch
+from backend.tenancy import DEFAULT_FARM, DEFAULT_HOUSE, normalize_id, tenant_prefix
 
 # Labels exibidos no dropdown do app
 TRIGGER_LABELS = [
@@ -29,13 +34,211 @@ TRIGGER_MAP = {
     "trigger variable current": ("variable_current", "sensor detected variable current"),
 }
 
+# ================== REGRAS LOCAIS (antes do Agent) ==================
+# Cada regra decide localmente, em microssegundos, o que fazer com um evento:
+#   "drop"     -> ignora (ex.: oscilação isolada)
+#   "alert"    -> alerta direto com a mensagem do template, sem chamar o Agent
+#   "escalate" -> segue para o Agent (também é o padrão quando nenhuma regra casa)
+#
+# Campos:
+#   triggers    : trigger_keys a que a regra se aplica
+#   when        : [(leitura, op, limiar_entrada, limiar_saida)]  op ">=" ou "<=" (histerese);
+#                 com a condição inativa a regra é ignorada (não descarta o trigger)
+#   with_recent : trigger_keys que têm de ter ocorrido no mesmo pavilhão nos últimos window_s
+#   persist_s   : a condição tem de durar isto antes de agir; até lá o evento é descartado
+#   window_s    : intervalo máximo entre eventos do mesmo episódio (padrão 600s)
+# Depois de agir, a regra fica "armada" e descarta repetições até o episódio terminar.
+RULES = [
+    {
+        "name": "ammonia_critical",
+        "triggers": {"ammonia"},
+        "when": [("ammonia_ppm", ">=", 25.0, 20.0)],
+        "action": "alert",
+        "message": "Amônia crítica no pavilhão {house_id}: {ammonia_ppm} ppm. Abrir ventilação e verificar a cama.",
+    },
+    {
+        "name": "heat_with_low_air_flow",
+        "triggers": {"high_temperature"},
+        "with_recent": {"low_air_flow"},
+        "action": "alert",
+        "message": "Temperatura alta com fluxo de ar baixo no pavilhão {house_id}. Verificar ventiladores e nebulização.",
+    },
+    {
+        "name": "fan_velocity_blip",
+        "triggers": {"low_fan_velocity", "high_fan_velocity", "variable_fan_speed"},
+        "persist_s": 120,
+        "action": "escalate",
+    },
+]
+
+# Alertas de modelo para quando o Agent não responde (disjuntor aberto, fila cheia
+# ou throttling persistente): o SMS sai na mesma, com as leituras do evento.
+FALLBACK_MESSAGES = {
+    "ammonia": "Amônia alta no pavilhão {house_id}. Abrir ventilação e verificar a cama.",
+    "high_temperature": "Temperatura alta no pavilhão {house_id}. Verificar ventiladores e nebulização.",
+    "low_temperature": "Temperatura baixa no pavilhão {house_id}. Verificar aquecedores e cortinas.",
+    "high_humidity": "Umidade alta no pavilhão {house_id}. Verificar ventilação e bebedouros.",
+    "low_air_flow": "Fluxo de ar baixo no pavilhão {house_id}. Verificar ventiladores e entradas de ar.",
+    "low_fan_velocity": "Ventiladores lentos no pavilhão {house_id}. Verificar motores e correias.",
+    "high_fan_velocity": "Ventiladores acima do normal no pavilhão {house_id}. Verificar o controlador.",
+    "variable_fan_speed": "Velocidade dos ventiladores instável no pavilhão {house_id}. Verificar o controlador.",
+    "variable_current": "Corrente elétrica instável no pavilhão {house_id}. Verificar o quadro e os motores.",
+}
+FALLBACK_DEFAULT = "Alerta {trigger_key} no pavilhão {house_id}. Verificar o pavilhão."
+FALLBACK_NOTE = "(Alerta automático: análise do Agent indisponível.)"
+
+_DEFAULT_WINDOW_S = 600
+
+class _Fmt(dict):
+    def __missing__(self, key):
+        return "?"
+
+class RuleEngine:
+    """
+    Avalia RULES sobre eventos de trigger:
+      {"ts": float, "trigger_key": str, "farm_id": str, "house_id": str, "readings": {nome: float}}
+    Guarda estado por pavilhão (histerese, persistência, últimos triggers vistos).
+    """
+
+    def __init__(self, rules: list[dict] | None = None):
+        self.rules = RULES if rules is None else rules
+        self.stats = Counter()
+        self._episodes: dict[tuple, dict] = {}
+        self._active: dict[tuple, bool] = {}
+        self._last_seen: dict[tuple, float] = {}
+
+    def evaluate(self, event: dict) -> dict:
+        return self.evaluate_batch([event])[0]
+
+    def evaluate_batch(self, events: list[dict]) -> list[dict]:
+        """
+        Decide um lote de eventos (em ordem de ts). Os limiares são comparados
+        por coluna de leituras de uma só vez; só a histerese é sequencial.
+        """
+        order = sorted(range(len(events)), key=lambda i: events[i].get("ts", 0.0))
+        columns: dict[str, list] = {}
+        for i in order:
+            for name, value in (events[i].get("readings") or {}).items():
+                columns.setdefault(name, [None] * len(events))[i] = value
+
+        masks = {}
+        for rule in self.rules:
+            for reading, op, enter, leave in rule.get("when", ()):
+                col = columns.get(reading, [None] * len(events))
+                if op == ">=":
+                    masks[(rule["name"], reading)] = (
+                        [v is not None and v >= enter for v in col],
+                        [v is not None and v < leave for v in col],
+                    )
+                else:
+                    masks[(rule["name"], reading)] = (
+                        [v is not None and v <= enter for v in col],
+                        [v is not None and v > leave for v in col],
+                    )
+
+        decisions: list[dict] = [{}] * len(events)
+        for i in order:
+            decisions[i] = self._decide(events[i], i, masks)
+            self.stats[decisions[i]["action"]] += 1
+        return decisions
+
+    def _decide(self, event: dict, i: int, masks: dict) -> dict:
+        ts = event.get("ts", 0.0)
+        trigger_key = event.get("trigger_key", "")
+        house = (event.get("farm_id", "default"), event.get("house_id", "default"))
+        decision = {"action": "escalate", "rule": None, "message": None}
+
+        for rule in self.rules:
+            if trigger_key not in rule["triggers"]:
+                continue
+            window_s = rule.get("window_s", _DEFAULT_WINDOW_S)
+            state_key = (*house, rule["name"])
+
+            if rule.get("with_recent"):
+                recent = [self._last_seen.get((*house, k)) for k in rule["with_recent"]]
+                if not any(t is not None and ts - t <= window_s for t in recent):
+                    continue
+
+            if rule.get("when"):
+                readings = event.get("readings") or {}
+                if any(reading not in readings for reading, *_ in rule["when"]):
+                    continue
+                active = self._active.get(state_key, False)
+                if active and any(masks[(rule["name"], r)][1][i] for r, *_ in rule["when"]):
+                    active = False
+                elif not active and all(masks[(rule["name"], r)][0][i] for r, *_ in rule["when"]):
+                    active = True
+                self._active[state_key] = active
+                if not active:
+                    # abaixo do limiar a regra não se aplica: o trigger segue para a próxima regra
+                    # (ou para o Agent), nunca é descartado só por isso
+                    self._episodes.pop(state_key, None)
+                    continue
+
+            episode = self._episodes.get(state_key)
+            if episode is None or ts - episode["last"] > window_s:
+                episode = {"since": ts, "last": ts, "fired": False}
+            episode["last"] = ts
+            self._episodes[state_key] = episode
+
+            if episode["fired"] or ts - episode["since"] < rule.get("persist_s", 0):
+                decision = {"action": "drop", "rule": rule["name"], "message": None}
+            else:
+                episode["fired"] = True
+                message = None
+                if rule["action"] == "alert":
+                    fields = {**event, **(event.get("readings") or {})}
+                    message = rule["message"].format_map(_Fmt(fields))
+                decision = {"action": rule["action"], "rule": rule["name"], "message": message}
+            break
+
+        self._last_seen[(*house, trigger_key)] = ts
+        return decision
+
+def fallback_message(fields: dict, readings: dict | None = None) -> str:
+    """Alerta de modelo do trigger, com as leituras do evento (se houver)."""
+    template = FALLBACK_MESSAGES.get(fields.get("trigger_key", ""), FALLBACK_DEFAULT)
+    lines = [template.format_map(_Fmt(fields))]
+    if readings:
+        lines.append("Leituras: " + ", ".join(f"{k}={v:g}" for k, v in readings.items()))
+    lines.append(FALLBACK_NOTE)
+    return " ".join(lines)
+
+def replay(events: list[dict], rules: list[dict] | None = None) -> dict:
+    """
+    Reexecuta um log de eventos no motor de regras e mede quantas chamadas
+    ao Agent seriam evitadas.
+    """
+    engine = RuleEngine(rules)
+    engine.evaluate_batch(events)
+    total = sum(engine.stats.values())
+    avoided = total - engine.stats["escalate"]
+    return {
+        "events": total,
+        "by_action": dict(engine.stats),
+        "agent_calls": engine.stats["escalate"],
+        "avoided_fraction": avoided / total if total else 0.0,
+    }
+
+_clients = {}
+_clients_lock = threading.Lock()
+
 def _s3(aws_key, aws_secret, region):
-    return boto3.client(
-        "s3",
-        aws_access_key_id=aws_key,
-        aws_secret_access_key=aws_secret,
-        region_name=region,
-    )
+    # um cliente por credencial/região, partilhado entre reruns e sessões do Streamlit
+    cache_key = (aws_key, aws_secret, region)
+    client = _clients.get(cache_key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(cache_key)
+            if client is None:
+                import boto3  # importado aqui: o Lambda importa este módulo mas não usa o cliente
+                client = _clients[cache_key] = boto3.client(
+                    "s3",
+                    aws_access_key_id=aws_key,
+                    aws_secret_access_key=aws_secret,
+                    region_name=region,
+                )
+    return client
 
 def _now_iso() -> str:
     # Ex.: 2025-09-20T20:21:35.414962Z
@@ -48,36 +251,192 @@ def send_trigger_txt(
     bucket: str,
     trigger_label: str,
     prefix: str = "triggers/",
+    readings: dict | None = None,
+    farm_id: str = DEFAULT_FARM,
+    house_id: str = DEFAULT_HOUSE,
 ) -> dict:
     """
     Envia um trigger como .txt para S3 no formato:
-      triggers/<trigger_key>/YYYY/MM/DD/<timestamp>.txt
+      triggers/<shard>/<farm_id>/<house_id>/<trigger_key>/YYYY/MM/DD/<timestamp>.txt
+    (ver backend/tenancy.py para o shard). Com `readings` ({"ts": [...], "temperature": [...], ...}) o objeto passa a ser
+    um lote binário .csb (ver backend/sensor_batch.py) com as leituras que
+    originaram o trigger, na mesma chave.
     """
     if trigger_label not in TRIGGER_MAP:
         raise RuntimeError(f"Unknown trigger label: {trigger_label}")
     trigger_key, base_msg = TRIGGER_MAP[trigger_label]
+    farm_id = normalize_id(farm_id, DEFAULT_FARM)
+    house_id = normalize_id(house_id, DEFAULT_HOUSE)
 
     ts = _now_iso()
     dt = datetime.now(timezone.utc)
+    base = f"{prefix}{tenant_prefix(farm_id, house_id)}{trigger_key}/{dt:%Y/%m/%d}/{ts}"
 
     # conteúdo do .txt
     content = (
         f"{base_msg}\n"
         f"generated_at={ts}\n"
         f"trigger_key={trigger_key}\n"
+        f"farm_id={farm_id}\n"
+        f"house_id={house_id}\n"
         f"source=Caseiro-UI\n"
     )
 
-    # chave S3
-    key = f"{prefix}{trigger_key}/{dt:%Y/%m/%d}/{ts}.txt"
+    if readings:
+        meta = {
+            "message": base_msg, "generated_at": ts, "trigger_key": trigger_key,
+            "farm_id": farm_id, "house_id": house_id, "source": "Caseiro-UI",
+        }
+        key = f"{base}{EXTENSION}"
+        body, content_type = encode_batch(readings, meta), CONTENT_TYPE
+        content += f"readings={len(readings['ts'])}\n"
+    else:
+        key = f"{base}.txt"
+        body, content_type = content.encode("utf-8"), "text/plain; charset=utf-8"
+
+    s3 = _s3(aws_key, aws_secret, region)
+    try:
+        s3.put_object(Bucket=bucket, Key=key, Body=body, ContentType=content_type)
+    except ClientError as e:
+        raise RuntimeError(f"Failed to PUT object: {e}")
+
+    return {
+        "s3_key": key, "content": content, "timestamp": ts, "trigger_key": trigger_key,
+        "farm_id": farm_id, "house_id": house_id,
+    }
+
+def send_sensor_batch(
+    aws_key,
+    aws_secret,
+    region: str,
+    bucket: str,
+    readings: dict,
+    source: str = "sensor-gateway",
+    trigger_key: str | None = None,
+    prefix: str = "sensors/",
+    farm_id: str = DEFAULT_FARM,
+    house_id: str = DEFAULT_HOUSE,
+) -> dict:
+    """
+    API de ingestão: grava muitas leituras num único objeto .csb em
+      sensors/<shard>/<farm_id>/<house_id>/YYYY/MM/DD/<timestamp>.csb
+    `readings` = {"ts": [...], "temperature": [...], "humidity": [...], ...}.
+    Sem trigger_key, o Lambda só ingere as leituras (não chama o Agent).
+    """
+    farm_id = normalize_id(farm_id, DEFAULT_FARM)
+    house_id = normalize_id(house_id, DEFAULT_HOUSE)
+    ts = _now_iso()
+    dt = datetime.now(timezone.utc)
+    meta = {"generated_at": ts, "source": source, "farm_id": farm_id, "house_id": house_id}
+    if trigger_key:
+        meta["trigger_key"] = trigger_key
+
+    key = f"{prefix}{tenant_prefix(farm_id, house_id)}{dt:%Y/%m/%d}/{ts}{EXTENSION}"
+    s3 = _s3(aws_key, aws_secret, region)
+    try:
+        s3.put_object(Bucket=bucket, Key=key, Body=encode_batch(readings, meta), ContentType=CONTENT_TYPE)
+    except ClientError as e:
+        raise RuntimeError(f"Failed to PUT object: {e}")
+
+    return {"s3_key": key, "timestamp": ts, "rows": len(readings["ts"])}
+
+# ================== MENSAGENS RELACIONADAS ==================
+# Layout (escrito por put_related_message):
+#   <tipo>/<trigger_key>/<ms invertidos>-<timestamp>.txt   (mais novo primeiro na listagem)
+#   <tipo>/<trigger_key>/_latest.txt                       (cópia da mais recente)
+# A leitura só confia no _latest.txt se um LIST com MaxKeys=1 (a chave invertida
+# mais nova) apontar para a mesma mensagem; a hora da mensagem sai da própria
+# chave, nunca do LastModified do ponteiro. Prefixos sem ponteiro ou com ponteiro
+# desatualizado (ex.: escritos diretamente pelo produtor externo) caem na
+# varredura completa, e a leitura nunca cria o ponteiro.
+# Um prefixo com ponteiro deve ser escrito só por put_related_message: um .txt
+# com outro nome não passa à frente das chaves invertidas no LIST.
+LATEST_NAME = "_latest.txt"
+_INV_BASE = 10**13
+
+def put_related_message(
+    aws_key,
+    aws_secret,
+    region: str,
+    bucket: str,
+    trigger_key: str,
+    content: str,
+    kind: str = "messages",
+) -> dict:
+    """Grava uma mensagem relacionada ao trigger e atualiza o ponteiro _latest.txt."""
+    dt = datetime.now(timezone.utc)
+    ts = _now_iso()
+    inv = _INV_BASE - int(dt.timestamp() * 1000)
+    pfx = f"{kind}/{trigger_key}/"
+    key = f"{pfx}{inv:013d}-{ts}.txt"
+    body = content.encode("utf-8")
 
     s3 = _s3(aws_key, aws_secret, region)
     try:
-        s3.put_object(Bucket=bucket, Key=key, Body=content.encode("utf-8"))
+        s3.put_object(Bucket=bucket, Key=key, Body=body, ContentType="text/plain; charset=utf-8")
+        s3.put_object(
+            Bucket=bucket, Key=pfx + LATEST_NAME, Body=body,
+            ContentType="text/plain; charset=utf-8", Metadata={"source-key": key},
+        )
     except ClientError as e:
         raise RuntimeError(f"Failed to PUT object: {e}")
+    return {"s3_key": key, "timestamp": ts}
+
+def _scan_newest(s3, bucket: str, pfx: str) -> tuple[datetime, str] | None:
+    # caminho antigo: lista tudo e compara LastModified
+    latest = None
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=pfx):
+        for o in (page.get("Contents") or []):
+            key = o.get("Key") or ""
+            if not key.lower().endswith(".txt") or key == pfx + LATEST_NAME:
+                continue
+            lm = o.get("LastModified")
+            if latest is None or (lm and lm > latest[0]):
+                latest = (lm, key)
+    return latest
 
-    return {"s3_key": key, "content": content, "timestamp": ts, "trigger_key": trigger_key}
+def _inverted_time(key: str) -> datetime | None:
+    """Hora de gravação codificada na chave de put_related_message (None se não for desse layout)."""
+    inv, sep, _ = key.rpartition("/")[2].partition("-")
+    if not sep or len(inv) != 13 or not inv.isdigit():
+        return None
+    return datetime.fromtimestamp((_INV_BASE - int(inv)) / 1000, timezone.utc)
+
+def _from_pointer(s3, bucket: str, pfx: str) -> dict | None:
+    """A mensagem do _latest.txt, se ele ainda apontar para a chave invertida mais nova."""
+    try:
+        obj = s3.get_object(Bucket=bucket, Key=pfx + LATEST_NAME)
+    except ClientError:
+        return None
+    source = (obj.get("Metadata") or {}).get("source-key", "")
+    ts = _inverted_time(source)
+    if ts is None:
+        return None
+    first = s3.list_objects_v2(Bucket=bucket, Prefix=pfx, MaxKeys=1).get("Contents") or []
+    if not first or first[0]["Key"] != source:
+        return None  # outra mensagem mais nova (ou ponteiro de uma escrita concorrente que perdeu)
+    return {
+        "s3_key": source,
+        "content": obj["Body"].read().decode("utf-8", errors="replace"),
+        "last_modified": ts,
+    }
+
+def _newest_in_prefix(s3, bucket: str, pfx: str) -> dict | None:
+    """Mensagem mais recente de um prefixo: {"s3_key", "content", "last_modified"} ou None."""
+    found = _from_pointer(s3, bucket, pfx)
+    if found is not None:
+        return found
+
+    newest = _scan_newest(s3, bucket, pfx)
+    if newest is None:
+        return None
+    lm, key = newest
+    try:
+        body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+    except ClientError:
+        return None
+    return {"s3_key": key, "content": body.decode("utf-8", errors="replace"), "last_modified": lm}
 
 def get_related_message(
     aws_key,
@@ -86,41 +445,39 @@ def get_related_message(
     bucket: str,
     trigger_key: str,
     search_prefixes: list[str] | None = None,
+    newer_than: str | datetime | None = None,
+    wait_s: float = 0.0,
+    poll_s: float = 1.0,
 ) -> dict | None:
     """
     Procura o .txt mais recente relacionado ao trigger.
-    Por padrão, busca em:
+    Por padrão, busca (em paralelo) em:
       - messages/<trigger_key>/
       - info/<trigger_key>/
+    Com `newer_than` só aceita mensagens gravadas depois desse instante; com
+    `wait_s` > 0 repete a busca (intervalo poll_s, dobrando até 5s) até achar
+    ou esgotar o tempo.
     Retorna { "s3_key": str, "content": str }  ou  None.
     """
     if search_prefixes is None:
         search_prefixes = [f"messages/{trigger_key}/", f"info/{trigger_key}/"]
+    if isinstance(newer_than, str):
+        newer_than = datetime.fromisoformat(newer_than.replace("Z", "+00:00"))
+    if newer_than is not None:
+        newer_than = newer_than.replace(microsecond=0)  # LastModified do S3 tem resolução de segundos
 
     s3 = _s3(aws_key, aws_secret, region)
-
-    latest_time: datetime | None = None
-    latest_key: str | None = None
-
-    for pfx in search_prefixes:
-        paginator = s3.get_paginator("list_objects_v2")
-        pages = paginator.paginate(Bucket=bucket, Prefix=pfx)
-        for page in pages:
-            for o in (page.get("Contents") or []):
-                key = o.get("Key")
-                if not key or not key.lower().endswith(".txt"):
-                    continue
-                lm = o.get("LastModified")
-                if latest_time is None or (lm and lm > latest_time):
-                    latest_time = lm
-                    latest_key = key
-
-    if not latest_key:
-        return None
-
-    try:
-        obj = s3.get_object(Bucket=bucket, Key=latest_key)
-        body = obj["Body"].read()
-        return {"s3_key": latest_key, "content": body.decode("utf-8", errors="replace")}
-    except ClientError:
-        return None
+    deadline = time.monotonic() + wait_s
+    with ThreadPoolExecutor(max_workers=len(search_prefixes) or 1) as pool:
+        while True:
+            found = [r for r in pool.map(lambda p: _newest_in_prefix(s3, bucket, p), search_prefixes) if r]
+            if newer_than is not None:
+                found = [r for r in found if r["last_modified"] and r["last_modified"] >= newer_than]
+            if found:
+                best = max(found, key=lambda r: r["last_modified"])
+                return {"s3_key": best["s3_key"], "content": best["content"]}
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            time.sleep(min(poll_s, remaining))
+            poll_s = min(poll_s * 2, 5.0)
@@ -0,0 +1,156 @@
+# backend/sensor_batch.py
+"""
+Formato binário colunar para lotes de leituras de sensores (.csb).
+
+Layout (little-endian):
+  b"CSB1" | uint16 n_cols | uint32 n_rows | uint32 meta_len | meta (JSON utf-8)
+  n_cols x (uint8 name_len | name)
+  padding até múltiplo de 8
+  n_cols colunas de n_rows float64 (NaN = sem leitura), na ordem dos nomes
+
+A coluna "ts" (epoch em segundos) é obrigatória. O decode devolve memoryviews
+sobre o próprio buffer, sem copiar as colunas.
+"""
+import sys
+import json
+import math
+import struct
+from array import array
+
+MAGIC = b"CSB1"
+EXTENSION = ".csb"
+CONTENT_TYPE = "application/vnd.caseiro.sensor-batch"
+
+# Colunas conhecidas (outras são aceitas, mas estas são as do aviário)
+SENSOR_COLUMNS = [
+    "ts",
+    "temperature",
+    "humidity",
+    "ammonia_ppm",
+    "current",
+    "frequency",
+    "fan_velocity",
+]
+
+_HEADER = struct.Struct("<4sHII")
+
+def encode_batch(columns: dict, meta: dict | None = None) -> bytes:
+    """
+    columns: {"ts": [...], "temperature": [...], ...}  todas com o mesmo tamanho.
+    meta: dados do lote (trigger_key, farm_id, house_id, source, message...).
+    """
+    if "ts" not in columns:
+        raise ValueError("Sensor batch needs a 'ts' column.")
+    names = ["ts"] + [n for n in columns if n != "ts"]
+    n_rows = len(columns["ts"])
+    for n in names:
+        if len(columns[n]) != n_rows:
+            raise ValueError(f"Column '{n}' has {len(columns[n])} rows, expected {n_rows}.")
+
+    meta_bytes = json.dumps(meta or {}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    head = bytearray(_HEADER.pack(MAGIC, len(names), n_rows, len(meta_bytes)))
+    head += meta_bytes
+    for n in names:
+        raw = n.encode("utf-8")
+        head += struct.pack("<B", len(raw)) + raw
+    head += b"\0" * (-len(head) % 8)
+
+    for n in names:
+        col = array("d", (math.nan if v is None else float(v) for v in columns[n]))
+        if sys.byteorder != "little":
+            col.byteswap()
+        head += col.tobytes()
+    return bytes(head)
+
+def is_sensor_batch(body: bytes) -> bool:
+    return body[:4] == MAGIC
+
+def decode_batch(body: bytes) -> tuple[dict, dict]:
+    """
+    Devolve (meta, {nome: sequência de float}). As colunas são memoryviews sobre
+    `body` (zero-copy) em máquinas little-endian.
+    """
+    view = memoryview(body)
+    if len(view) < _HEADER.size:
+        raise ValueError(f"Sensor batch truncated: {len(view)} bytes, header needs {_HEADER.size}.")
+    magic, n_cols, n_rows, meta_len = _HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a sensor batch (bad magic).")
+    pos = _HEADER.size
+    if pos + meta_len > len(view):
+        raise ValueError(f"Sensor batch truncated inside meta ({meta_len} bytes declared).")
+    meta = json.loads(bytes(view[pos:pos + meta_len]).decode("utf-8")) if meta_len else {}
+    pos += meta_len
+
+    names = []
+    for _ in range(n_cols):
+        if pos >= len(view) or pos + 1 + view[pos] > len(view):
+            raise ValueError(f"Sensor batch truncated inside column names ({len(names)} of {n_cols} read).")
+        size = view[pos]
+        names.append(bytes(view[pos + 1:pos + 1 + size]).decode("utf-8"))
+        pos += 1 + size
+    pos += -pos % 8
+    if "ts" not in names:
+        raise ValueError("Sensor batch has no 'ts' column.")
+
+    # todas as colunas têm n_rows valores: o corpo tem de ter exatamente esse tamanho
+    width = 8 * n_rows
+    if len(view) - pos != n_cols * width:
+        raise ValueError(
+            f"Sensor batch columns hold {len(view) - pos} bytes, header says "
+            f"{n_cols} x {n_rows} rows = {n_cols * width}."
+        )
+
+    columns = {}
+    for n in names:
+        chunk = view[pos:pos + width]
+        if sys.byteorder == "little":
+            columns[n] = chunk.cast("d")
+        else:
+            col = array("d", bytes(chunk))
+            col.byteswap()
+            columns[n] = col
+        pos += width
+    return meta, columns
+
+def batch_rows(meta: dict, columns: dict) -> list[dict]:
+    """Um evento por linha, no formato do RuleEngine (só leituras presentes)."""
+    names = [n for n in columns if n != "ts"]
+    ts = columns["ts"]
+    events = []
+    for i in range(len(ts)):
+        readings = {}
+        for n in names:
+            v = columns[n][i]
+            if v == v:  # NaN = sem leitura
+                readings[n] = v
+        events.append({
+            "ts": ts[i],
+            "trigger_key": meta.get("trigger_key", ""),
+            "farm_id": meta.get("farm_id", "default"),
+            "house_id": meta.get("house_id", "default"),
+            "readings": readings,
+        })
+    return events
+
+def summarize_batch(meta: dict, columns: dict) -> str:
+    """
+    Resumo em texto no mesmo estilo dos .txt de trigger (1ª linha = mensagem,
+    depois "chave=valor"); por coluna: "nome=último (n min max média)".
+    """
+    lines = [meta.get("message") or "sensor batch"]
+    for k, v in meta.items():
+        if k != "message":
+            lines.append(f"{k}={v}")
+    lines.append(f"readings={len(columns['ts'])}")
+    for n, col in columns.items():
+        if n == "ts":
+            continue
+        values = [v for v in col if v == v]
+        if not values:
+            continue
+        lines.append(
+            f"{n}={values[-1]:.2f} (n={len(values)} min={min(values):.2f} "
+            f"max={max(values):.2f} mean={sum(values) / len(values):.2f})"
+        )
+    return "\n".join(lines) + "\n"
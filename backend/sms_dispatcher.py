@@ -0,0 +1,369 @@
+# backend/sms_dispatcher.py
+"""
+Despacho de SMS com limites de quota.
+
+Os alertas não são publicados um a um: entram numa fila por destino e saem
+pelo SmsDispatcher, que
+  - limita o envio com token buckets (um por destino + um para a conta SNS)
+  - junta vários alertas pendentes do mesmo destino num único SMS de resumo
+  - encaminha por severidade / trigger_key para vários destinatários
+  - repete com backoff exponencial quando o SNS devolve throttling ou falha a
+    ligação (e quando a reclamação da chave falha)
+  - não reenvia alertas cuja chave de idempotência já foi reclamada (`claim`)
+  - entrega a `spill` o que não sair (sobras da quota no fim do `drain`, falhas
+    do SNS) para ser reenviado mais tarde, em vez de o perder com a instância
+
+`publish(phone_number, message)` é injetado (SNS real no Lambda, substituto
+local nos benchmarks), assim como o relógio e o sleep.
+
+Limite: os token buckets vivem na memória de cada instância. Várias instâncias
+do Lambda em paralelo (e o sms_retry_handler) gastam cada uma a sua quota, por
+isso juntas podem passar da quota da conta e da de cada destino; o bench_sms só
+prova a quota de uma instância. Com N instâncias em simultâneo, configure
+SMS_ACCOUNT_TPS e SMS_DEST_PER_HOUR como a quota real dividida por N (ou limite
+a concorrência reservada da função). O SNS devolve throttling acima da quota da
+conta, e isso cai no backoff; a quota por destino não tem essa proteção.
+"""
+import time
+import random
+import logging
+import threading
+from collections import Counter, deque
+from botocore.exceptions import BotoCoreError, ClientError
+
+logger = logging.getLogger(__name__)
+
+THROTTLING_CODES = {"Throttling", "ThrottlingException", "ThrottledException", "TooManyRequestsException"}
+
+class TokenBucket:
+    """`rate` fichas por segundo, no máximo `burst` acumuladas; `n` = fichas por pedido."""
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def available(self, now: float, n: float = 1) -> bool:
+        self._refill(now)
+        return self.tokens >= min(n, self.burst) - 1e-9
+
+    def take(self, now: float, n: float = 1) -> None:
+        self._refill(now)
+        self.tokens -= n
+
+    def give_back(self, n: float = 1) -> None:
+        """Devolve fichas reservadas que acabaram por não ser usadas."""
+        self.tokens = min(self.burst, self.tokens + n)
+
+    def wait_s(self, now: float, n: float = 1) -> float:
+        """Tempo até haver `n` fichas (no máximo `burst`: um pedido maior passa com o balde cheio)."""
+        if self.available(now, n):
+            return 0.0
+        return (min(n, self.burst) - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+class SmsDispatcher:
+    """
+    Fila de SMS por destino. Uso:
+        d.submit("texto", trigger_key="ammonia", severity="critical")
+        d.pump()          # envia o que já pode sair
+        d.drain(2.0)      # envia tudo o que couber na quota em até 2s
+    routes: [{"severity": {...}, "triggers": {...}, "farms": {...}, "to": [...]}]; campos ausentes
+    casam com tudo. Sem nenhuma rota aplicável, o alerta vai para `default_to`.
+    Alertas "critical" não esperam a janela de resumo, mas respeitam a quota: sem
+    fichas, juntam-se ao resumo seguinte do destino.
+    claim(chave) -> bool é chamado uma vez por (alerta, destino) com
+    idempotency_key, logo antes do primeiro envio; False = já enviado por outra
+    tentativa, o alerta sai da fila sem SMS. Se o alerta acabar descartado sem
+    SMS, unclaim(chave) desfaz a reclamação (uma nova tentativa volta a enviá-lo).
+    spill(destino, itens) guarda fora da instância os alertas que não saíram (o
+    `claimed` vai junto); `requeue` devolve-os à fila. Sem `spill`, as sobras
+    ficam em memória e as falhas são descartadas.
+    """
+
+    def __init__(
+        self,
+        publish,
+        routes: list[dict] | None = None,
+        default_to: list[str] | tuple = (),
+        dest_rate_per_s: float = 1 / 60,
+        dest_burst: float = 3,
+        account_rate_per_s: float = 20.0,
+        digest_window_s: float = 60.0,
+        max_chars: int = 1600,
+        max_attempts: int = 5,
+        backoff_s: float = 1.0,
+        claim=None,
+        spill=None,
+        unclaim=None,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self.publish = publish
+        self.routes = routes or []
+        self.default_to = list(default_to)
+        self.dest_rate_per_s = dest_rate_per_s
+        self.dest_burst = dest_burst
+        self.digest_window_s = digest_window_s
+        self.max_chars = max_chars
+        self.max_attempts = max_attempts
+        self.backoff_s = backoff_s
+        self.claim = claim
+        self.spill = spill
+        self.unclaim = unclaim
+        self.clock = clock
+        self.sleep = sleep
+        self.stats = Counter()
+        self._account = TokenBucket(account_rate_per_s, 1, clock())  # sem rajada: nunca passa de N/s
+        self._buckets: dict[str, TokenBucket] = {}
+        self._queues: dict[str, deque] = {}
+        self._not_before: dict[str, float] = {}
+        self._attempts: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    # ---------- entrada ----------
+    def route(self, trigger_key: str = "", severity: str = "warning", farm_id: str = "") -> list[str]:
+        to: list[str] = []
+        for r in self.routes:
+            if "severity" in r and severity not in r["severity"]:
+                continue
+            if "triggers" in r and trigger_key not in r["triggers"]:
+                continue
+            if "farms" in r and farm_id not in r["farms"]:
+                continue
+            to.extend(n for n in r["to"] if n not in to)
+        return to or list(self.default_to)
+
+    def submit(
+        self,
+        message: str,
+        trigger_key: str = "",
+        severity: str = "warning",
+        idempotency_key: str | None = None,
+        **fields,
+    ) -> list[str]:
+        """Enfileira o alerta para cada destino da rota; devolve os destinos."""
+        now = self.clock()
+        destinations = self.route(trigger_key, severity, fields.get("farm_id", ""))
+        with self._lock:
+            for dest in destinations:
+                item = {
+                    "message": message, "trigger_key": trigger_key, "severity": severity,
+                    "queued_at": now, "idempotency_key": idempotency_key, "claimed": False, **fields,
+                }
+                self._queues.setdefault(dest, deque()).append(item)
+                self.stats["queued"] += 1
+        return destinations
+
+    def requeue(self, dest: str, items: list[dict]) -> None:
+        """Devolve à fila de `dest` alertas guardados por `spill` (contam para a janela a partir de agora)."""
+        now = self.clock()
+        with self._lock:
+            queue = self._queues.setdefault(dest, deque())
+            for item in items:
+                queue.append({**item, "queued_at": now})
+                self.stats["requeued"] += 1
+
+    def _claimed(self, dest: str, items: list[dict]) -> list[dict]:
+        """Reclama as chaves ainda não reclamadas; descarta os alertas já enviados antes."""
+        keep = []
+        for item in items:
+            if self.claim is not None and item["idempotency_key"] and not item["claimed"]:
+                if not self.claim(f"{item['idempotency_key']}|{dest}"):
+                    with self._lock:
+                        self.stats["duplicates"] += 1
+                    continue
+                item["claimed"] = True
+            keep.append(item)
+        return keep
+
+    def pending(self) -> int:
+        with self._lock:
+            return sum(len(q) for q in self._queues.values())
+
+    # ---------- saída ----------
+    def _bucket(self, dest: str, now: float) -> TokenBucket:
+        bucket = self._buckets.get(dest)
+        if bucket is None:
+            bucket = self._buckets[dest] = TokenBucket(self.dest_rate_per_s, self.dest_burst, now)
+        return bucket
+
+    def _ready_in(self, dest: str, now: float, force: bool) -> float:
+        """Segundos até o destino poder enviar (0 = já); inf = só quando entrar algo novo."""
+        queue = self._queues.get(dest)
+        if not queue:
+            return float("inf")
+        critical = any(i["severity"] == "critical" for i in queue)
+        wait = max(self._not_before.get(dest, 0.0) - now, 0.0)
+        if not (force or critical):
+            wait = max(wait, queue[0]["queued_at"] + self.digest_window_s - now)
+        wait = max(wait, self._bucket(dest, now).wait_s(now))
+        return max(wait, self._account.wait_s(now))
+
+    def format_digest(self, items: list[dict]) -> str:
+        """Um alerta sai tal como veio; vários viram um resumo com uma linha por alerta."""
+        if len(items) == 1:
+            return items[0]["message"][:self.max_chars]
+        lines = [f"Caseiro: {len(items)} alertas"]
+        size = len(lines[0])
+        for n, item in enumerate(items):
+            text = " ".join(item["message"].split())
+            line = f"- [{item['trigger_key'] or '?'}] {text[:200]}"
+            more = f"(+{len(items) - n} alertas)"
+            if size + 1 + len(line) > self.max_chars - len(more) - 1:
+                lines.append(more)
+                break
+            lines.append(line)
+            size += 1 + len(line)
+        return "\n".join(lines)[:self.max_chars]
+
+    # Só a escolha do que sai (fila, fichas, backoff) é feita sob o lock; claim,
+    # publish e spill são chamadas de rede e correm fora dele, para que submit()
+    # das outras threads não espere por cada SMS.
+    def _take(self, dest: str, force: bool) -> list[dict] | None:
+        """Sob o lock: se o destino está pronto, tira-lhe os alertas e reserva as fichas."""
+        now = self.clock()
+        if self._ready_in(dest, now, force) > 0:
+            return None
+        self._account.take(now)
+        self._bucket(dest, now).take(now)
+        return list(self._queues.pop(dest))
+
+    def _failed(self, dest: str, items: list[dict], reason, retry: bool) -> None:
+        """
+        Envio falhou: com `retry` (e tentativas de sobra) os alertas voltam para a
+        frente da fila com backoff; senão vão para `spill` ou, sem ele, são
+        descartados e as chaves reclamadas são libertadas.
+        """
+        with self._lock:
+            attempts = self._attempts.get(dest, 0) + 1
+            if retry and attempts < self.max_attempts:
+                # junta-se ao que entrar entretanto
+                self._queues[dest] = deque(items + list(self._queues.get(dest, ())))
+                self._attempts[dest] = attempts
+                delay = self.backoff_s * 2 ** (attempts - 1)
+                self._not_before[dest] = self.clock() + delay * random.uniform(0.5, 1.0)
+                return
+            self._attempts.pop(dest, None)
+        if self.spill is not None and self._spill(dest, items):
+            logger.warning("SMS para %s falhou (%s); %d alerta(s) guardado(s) para reenvio", dest, reason, len(items))
+            return
+        logger.error("SMS para %s falhou (%s); %d alerta(s) descartado(s)", dest, reason, len(items))
+        with self._lock:
+            self.stats["failed"] += len(items)
+        for item in items:
+            if self.unclaim is not None and item["claimed"]:
+                try:
+                    self.unclaim(f"{item['idempotency_key']}|{dest}")
+                except Exception:
+                    logger.exception("Falha ao libertar a chave de idempotência de um SMS para %s", dest)
+
+    def _send(self, dest: str, items: list[dict]) -> bool:
+        """Fora do lock: reclama as chaves e publica os alertas tirados por _take."""
+        try:
+            items = self._claimed(dest, items)
+        except Exception as e:
+            # os já reclamados levam claimed=True: não voltam a ser reclamados
+            logger.exception("Falha ao reclamar SMS para %s", dest)
+            self._failed(dest, items, type(e).__name__, retry=True)
+            return False
+        if not items:
+            with self._lock:  # todos já enviados por outra tentativa: as fichas não foram usadas
+                self._account.give_back()
+                self._bucket(dest, self.clock()).give_back()
+            return False
+        try:
+            self.publish(dest, self.format_digest(items))
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            throttled = code in THROTTLING_CODES
+            if throttled:
+                with self._lock:
+                    self.stats["throttled"] += 1
+            self._failed(dest, items, code, retry=throttled)
+            return False
+        except BotoCoreError as e:
+            # ligação/timeout: o SNS pode nem ter recebido o pedido
+            self._failed(dest, items, type(e).__name__, retry=True)
+            return False
+        with self._lock:
+            self._attempts.pop(dest, None)
+            self._not_before.pop(dest, None)
+            self.stats["sent"] += 1
+            self.stats["alerts_sent"] += len(items)
+            if len(items) > 1:
+                self.stats["digests"] += 1
+        return True
+
+    def _spill(self, dest: str, items: list[dict]) -> bool:
+        try:
+            self.spill(dest, items)
+        except Exception:
+            logger.exception("Falha ao guardar %d alerta(s) SMS de %s para reenvio", len(items), dest)
+            return False
+        with self._lock:
+            self.stats["spilled"] += len(items)
+        return True
+
+    def spill_pending(self) -> int:
+        """Entrega a `spill` tudo o que está na fila; o que não for aceite volta para a fila."""
+        if self.spill is None:
+            return 0
+        with self._lock:
+            taken = {dest: list(self._queues.pop(dest)) for dest in list(self._queues)}
+        spilled = 0
+        for dest, items in taken.items():
+            if not items:
+                continue
+            if self._spill(dest, items):
+                spilled += len(items)
+                continue
+            with self._lock:
+                self._queues[dest] = deque(items + list(self._queues.get(dest, ())))
+        with self._lock:
+            for dest, items in taken.items():
+                if items and dest not in self._queues:
+                    self._attempts.pop(dest, None)
+                    self._not_before.pop(dest, None)
+        return spilled
+
+    def pump(self, force: bool = False) -> int:
+        """Envia os destinos prontos (sem esperar); devolve quantos SMS saíram."""
+        sent = 0
+        with self._lock:
+            dests = list(self._queues)
+        for dest in dests:
+            with self._lock:
+                items = self._take(dest, force)
+            if items:
+                sent += self._send(dest, items)
+        return sent
+
+    def next_ready_in(self, force: bool = False) -> float:
+        with self._lock:
+            now = self.clock()
+            return min((self._ready_in(d, now, force) for d in self._queues), default=float("inf"))
+
+    def drain(self, max_wait_s: float = 0.0) -> int:
+        """
+        Envia tudo o que estiver na fila, ignorando a janela de resumo e esperando
+        pela quota até `max_wait_s`. O que não couber vai para `spill` (ou, sem
+        ele, fica na fila para a próxima chamada).
+        """
+        deadline = self.clock() + max_wait_s
+        sent = 0
+        while True:
+            sent += self.pump(force=True)
+            wait = self.next_ready_in(force=True)
+            if wait == float("inf") or self.clock() + wait > deadline:
+                break
+            self.sleep(wait)
+        self.spill_pending()
+        if self.pending():
+            logger.warning("%d alerta(s) SMS à espera de quota", self.pending())
+        return sent
@@ -0,0 +1,55 @@
+# backend/tenancy.py
+"""
+Granja (farm_id) e pavilhão (house_id) como partição de primeira classe.
+
+Os objetos de cada pavilhão ficam sob um prefixo com um shard de hash à frente,
+para espalhar a carga pelos prefixos do S3 (limites de pedidos por prefixo):
+    <base>/<shard>/<farm_id>/<house_id>/...
+O shard depende só de (farm_id, house_id), então qualquer componente calcula o
+mesmo caminho sem consultar nada.
+"""
+import re
+import hashlib
+
+DEFAULT_FARM = "default"
+DEFAULT_HOUSE = "default"
+SHARD_HEX_DIGITS = 2          # 256 prefixos
+TENANTS_DIR = "_tenants/"     # marcadores <base>_tenants/<farm_id>/<house_id> (listagem de pavilhões)
+
+_ID_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]{0,63}$")
+
+def normalize_id(value, default: str) -> str:
+    value = (value or "").strip() or default
+    if not _ID_RE.match(value):
+        raise ValueError(f"Invalid farm/house id: {value!r} (use letters, digits, '_', '-', '.').")
+    return value
+
+def tenant_of(fields: dict) -> tuple[str, str]:
+    """(farm_id, house_id) de um trigger/meta/payload; "default" quando ausente."""
+    return (
+        normalize_id(fields.get("farm_id"), DEFAULT_FARM),
+        normalize_id(fields.get("house_id"), DEFAULT_HOUSE),
+    )
+
+def shard(farm_id: str, house_id: str) -> str:
+    digest = hashlib.md5(f"{farm_id}/{house_id}".encode("utf-8")).hexdigest()
+    return digest[:SHARD_HEX_DIGITS]
+
+def tenant_prefix(farm_id: str, house_id: str) -> str:
+    """Parte relativa do caminho: "<shard>/<farm_id>/<house_id>/"."""
+    return f"{shard(farm_id, house_id)}/{farm_id}/{house_id}/"
+
+def tenant_marker(base: str, farm_id: str, house_id: str) -> str:
+    return f"{base}{TENANTS_DIR}{farm_id}/{house_id}"
+
+def list_tenants(s3, bucket: str, base: str) -> list[tuple[str, str]]:
+    """Pavilhões conhecidos (pelos marcadores gravados pelo Lambda), 1 LIST por 1000."""
+    paginator = s3.get_paginator("list_objects_v2")
+    tenants = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"{base}{TENANTS_DIR}"):
+        for o in page.get("Contents", []) or []:
+            rel = o["Key"][len(base) + len(TENANTS_DIR):]
+            farm_id, _, house_id = rel.partition("/")
+            if farm_id and house_id:
+                tenants.append((farm_id, house_id))
+    return sorted(tenants)
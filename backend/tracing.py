@@ -0,0 +1,86 @@
+# backend/tracing.py
+"""
+Spans e contadores leves por invocação, emitidos como uma única linha JSON no
+Embedded Metric Format (EMF) do CloudWatch: o CloudWatch extrai as métricas da
+própria linha de log, sem chamadas PutMetricData no caminho crítico.
+
+    trace = Trace()
+    with trace.span("s3_read"):
+        ...
+    trace.count("agent_chunks", 12)
+    print(trace.to_emf("Caseiro/Pipeline", {"Function": "caseiro"}))
+
+Vários records da mesma invocação (em threads) registam no mesmo Trace; cada
+métrica vira uma lista de valores (o EMF aceita até 100 por métrica).
+"""
+import json
+import time
+import random
+import threading
+from contextlib import contextmanager
+
+EMF_MAX_VALUES = 100
+
+class Trace:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.values: dict[str, list[float]] = {}
+        self.units: dict[str, str] = {}
+        self.properties: dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, value: float, unit: str = "Count") -> None:
+        with self._lock:
+            self.values.setdefault(name, []).append(value)
+            self.units[name] = unit
+
+    def count(self, name: str, value: float = 1) -> None:
+        self.record(name, value, "Count")
+
+    def timing(self, name: str, ms: float) -> None:
+        self.record(name, round(ms, 3), "Milliseconds")
+
+    @contextmanager
+    def span(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timing(f"{name}_ms", (time.perf_counter() - t0) * 1000)
+
+    def set(self, key: str, value) -> None:
+        """Propriedade sem métrica (aparece no log, pesquisável no Logs Insights)."""
+        self.properties[key] = value
+
+    def summary(self) -> dict:
+        """{métrica: total} (útil para benchmarks e para o retorno do handler)."""
+        with self._lock:
+            return {name: round(sum(v), 3) for name, v in self.values.items()}
+
+    def to_emf(self, namespace: str, dimensions: dict[str, str]) -> str:
+        with self._lock:
+            metrics = {name: v[:EMF_MAX_VALUES] for name, v in self.values.items()}
+            units = dict(self.units)
+        doc = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": namespace,
+                    "Dimensions": [list(dimensions)],
+                    "Metrics": [{"Name": n, "Unit": units[n]} for n in metrics],
+                }],
+            },
+            **dimensions,
+            **self.properties,
+            **{n: (v[0] if len(v) == 1 else v) for n, v in metrics.items()},
+        }
+        return json.dumps(doc, ensure_ascii=False, separators=(",", ":"), default=str)
+
+class NullTrace(Trace):
+    """Trace que não guarda nada (process_object chamado fora do handler)."""
+
+    def record(self, name: str, value: float, unit: str = "Count") -> None:
+        pass
+
+def sampled(rate: float) -> bool:
+    return rate >= 1 or (rate > 0 and random.random() < rate)
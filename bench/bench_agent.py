@@ -0,0 +1,114 @@
+# bench/bench_agent.py
+"""
+Tempestade de alarmes contra um Agent local (bench/fakes.FakeBedrockAgent) que
+devolve ThrottlingException acima de N streams simultâneos e pode falhar de vez.
+Compara chamadas diretas (como antes do scheduler: todas de uma vez, throttling =
+erro) com o AgentScheduler (faixas de severidade, AIMD, disjuntor + fallback).
+
+Por faixa: respondidos pelo Agent, alertas de modelo (fallback), erros e
+p50/p95 do tempo até haver texto para o SMS.
+
+    python -m bench.bench_agent                       # tempestade
+    python -m bench.bench_agent --events 120 --agent-limit 3 --outage
+"""
+import sys
+import time
+import random
+import argparse
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from backend.agent_scheduler import AgentScheduler, AgentUnavailable, CircuitBreaker
+from bench.bench_pipeline import percentile
+from bench.fakes import FakeBedrockAgent
+
+LANE_MIX = (("critical", 0.2), ("warning", 0.5), ("info", 0.3))
+
+def storm(n: int, seed: int = 3) -> list[str]:
+    rng = random.Random(seed)
+    lanes, weights = zip(*LANE_MIX)
+    return rng.choices(lanes, weights, k=n)
+
+def _ask(agent: FakeBedrockAgent, lane: str) -> str:
+    resp = agent.invoke_agent(agentId="A", agentAliasId="B", sessionId=lane, inputText=f"{lane} event")
+    return "".join(e["chunk"]["bytes"].decode("utf-8") for e in resp["completion"])
+
+def run(lanes: list[str], agent: FakeBedrockAgent, scheduler: AgentScheduler | None, workers: int) -> dict:
+    outcome = defaultdict(Counter)
+    latency = defaultdict(list)
+    lock = threading.Lock()
+
+    def handle(lane):
+        t0 = time.perf_counter()
+        try:
+            if scheduler is None:
+                _ask(agent, lane)
+            else:
+                scheduler.run(lambda: _ask(agent, lane), lane, tokens=50)
+            result = "agent"
+        except AgentUnavailable:
+            result = "fallback"
+        except Exception:
+            result = "error"
+        with lock:
+            outcome[lane][result] += 1
+            if result != "error":
+                latency[lane].append((time.perf_counter() - t0) * 1000)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(handle, lanes))
+    result = {"elapsed_s": round(time.perf_counter() - t0, 2), "lanes": {}}
+    for lane, _ in LANE_MIX:
+        values = latency[lane]
+        result["lanes"][lane] = {
+            **{k: outcome[lane][k] for k in ("agent", "fallback", "error")},
+            "p50_ms": round(percentile(values, 50), 1) if values else None,
+            "p95_ms": round(percentile(values, 95), 1) if values else None,
+        }
+    result["agent_calls"] = agent.calls["InvokeAgent"]
+    result["throttled"] = agent.calls["Throttled"]
+    result["peak_in_flight"] = agent.peak_in_flight
+    if scheduler is not None:
+        result["breaker_opened"] = scheduler.breaker.stats["opened"]
+    return result
+
+def report(label: str, result: dict) -> None:
+    print(f"\n{label}: {result['elapsed_s']} s, agent calls={result['agent_calls']} "
+          f"throttled={result['throttled']} peak in flight={result['peak_in_flight']}"
+          + (f" breaker opened={result['breaker_opened']}" if "breaker_opened" in result else ""))
+    print(f"  {'lane':9} {'agent':>6} {'fallback':>9} {'error':>6} {'p50 ms':>9} {'p95 ms':>9}")
+    for lane, r in result["lanes"].items():
+        p50 = "-" if r["p50_ms"] is None else f"{r['p50_ms']:.1f}"
+        p95 = "-" if r["p95_ms"] is None else f"{r['p95_ms']:.1f}"
+        print(f"  {lane:9} {r['agent']:>6} {r['fallback']:>9} {r['error']:>6} {p50:>9} {p95:>9}")
+
+def main(argv: list[str]) -> None:
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    p.add_argument("--events", type=int, default=60, help="alarmes simultâneos")
+    p.add_argument("--workers", type=int, default=32, help="records processados em paralelo")
+    p.add_argument("--agent-limit", type=int, default=4, help="streams simultâneos antes do throttling")
+    p.add_argument("--agent-first-ms", type=float, default=150.0)
+    p.add_argument("--agent-chunk-ms", type=float, default=10.0)
+    p.add_argument("--concurrency", type=int, default=8, help="concorrência inicial do scheduler")
+    p.add_argument("--outage", action="store_true", help="Agent a falhar sempre (disjuntor)")
+    args = p.parse_args(argv)
+
+    def agent():
+        return FakeBedrockAgent(
+            first_chunk_s=args.agent_first_ms / 1000, chunk_s=args.agent_chunk_ms / 1000,
+            max_concurrent=args.agent_limit, error_rate=1.0 if args.outage else 0.0,
+        )
+
+    lanes = storm(args.events)
+    print(f"{args.events} alarms: " + ", ".join(f"{lane}={lanes.count(lane)}" for lane, _ in LANE_MIX))
+    report("direct", run(lanes, agent(), None, args.workers))
+    scheduler = AgentScheduler(
+        max_concurrency=args.concurrency, tokens_per_s=1e6, token_burst=1e6,
+        max_wait_s={"critical": 10, "warning": 4, "info": 1}, backoff_s=0.1,
+        breaker=CircuitBreaker(latency_budget_s=5, open_s=30),
+    )
+    report("scheduled", run(lanes, agent(), scheduler, args.workers))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
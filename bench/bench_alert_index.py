@@ -0,0 +1,61 @@
+# bench/bench_alert_index.py
+"""
+Compara get_latest_alert / get_all_alerts com e sem o catálogo (_latest.json +
+_index/) num S3 local com N alertas.
+
+    python -m bench.bench_alert_index [n_alertas] [latência_ms]
+"""
+import sys
+import json
+import time
+from datetime import datetime, timedelta, timezone
+from backend import s3_alerts
+from bench.fakes import FakeS3
+
+BUCKET = "alertas-caseiro"
+PREFIX = "alerts/"
+
+def populate(s3: FakeS3, n: int, per_invocation: int = 25) -> None:
+    t0 = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    batch = []
+    for i in range(n):
+        ts = (t0 + timedelta(seconds=90 * i)).isoformat().replace("+00:00", "Z")
+        key = f"{PREFIX}{ts}.json"
+        payload = {"generated_at": ts, "source": {"key": f"triggers/x/{ts}.txt"}, "alert": f"alerta {i}"}
+        s3.put_object(Bucket=BUCKET, Key=key, Body=json.dumps(payload).encode("utf-8"))
+        batch.append(s3_alerts.index_entry(key, payload))
+        if len(batch) == per_invocation:
+            s3_alerts.write_alert_index(s3, BUCKET, batch, PREFIX)
+            batch = []
+    s3_alerts.write_alert_index(s3, BUCKET, batch, PREFIX)
+
+def measure(s3: FakeS3, label: str, fn) -> None:
+    s3.calls.clear()
+    t0 = time.perf_counter()
+    out = fn()
+    ms = (time.perf_counter() - t0) * 1000
+    calls = {k: v for k, v in s3.calls.items() if k != "Presign"}
+    n = len(out) if isinstance(out, list) else 1
+    print(f"{label:<28} {ms:9.1f} ms  results={n:<5} calls={calls}")
+
+def main(argv: list[str]) -> None:
+    n = int(argv[0]) if argv else 100_000
+    latency_ms = float(argv[1]) if len(argv) > 1 else 0.0
+
+    indexed = FakeS3()
+    print(f"populating {n} alerts...")
+    populate(indexed, n)
+    indexed.latency_s = latency_ms / 1000
+
+    legacy = FakeS3(latency_s=latency_ms / 1000)
+    legacy._objects = {k: v for k, v in indexed._objects.items() if "/_" not in k[1]}
+    legacy._keys = {BUCKET: [k for k in indexed._keys[BUCKET] if "/_" not in k]}
+
+    args = dict(aws_key=None, aws_secret=None, region="us-east-1", bucket=BUCKET, prefix=PREFIX)
+    for label, s3 in (("legacy (full listing)", legacy), ("indexed", indexed)):
+        s3_alerts._s3 = lambda *a, s3=s3: s3
+        measure(s3, f"latest  / {label}", lambda: s3_alerts.get_latest_alert(**args))
+        measure(s3, f"all[50] / {label}", lambda: s3_alerts.get_all_alerts(**args, limit=50))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
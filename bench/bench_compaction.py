@@ -0,0 +1,98 @@
+# bench/bench_compaction.py
+"""
+Histórico de alertas antes e depois da compactação (compact_alerts) num S3
+local: nº de objetos e bytes no bucket, pedidos e tempo para percorrer o
+histórico inteiro (páginas de 100) e uma página filtrada por pavilhão.
+
+    python -m bench.bench_compaction [dias] [alertas_por_dia] [latência_ms]
+"""
+import sys
+import json
+import time
+from datetime import datetime, timedelta, timezone
+from backend import s3_alerts
+from backend.tenancy import tenant_prefix
+from bench.fakes import FakeS3
+
+BUCKET = "alertas-caseiro"
+PREFIX = "alerts/"
+HOUSES = [("farm-1", f"house-{i}") for i in range(4)] + [("farm-2", "house-0")]
+TRIGGERS = ["ammonia", "high_temperature", "low_air_flow", "variable_fan_speed"]
+PER_INVOCATION = 10
+
+def populate(s3: FakeS3, days: int, per_day: int) -> datetime:
+    """Alertas gravados como o Lambda grava (1 .json por alerta + catálogos por invocação)."""
+    t0 = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    step = 86400 / per_day
+    batch = []
+    for i in range(days * per_day):
+        ts = (t0 + timedelta(seconds=step * i)).isoformat().replace("+00:00", "Z")
+        farm_id, house_id = HOUSES[i % len(HOUSES)]
+        trigger_key = TRIGGERS[(i // len(HOUSES)) % len(TRIGGERS)]
+        key = f"{PREFIX}{tenant_prefix(farm_id, house_id)}{i:08d}.json"
+        payload = {
+            "generated_at": ts, "trigger_key": trigger_key, "farm_id": farm_id, "house_id": house_id,
+            "source": {"bucket": "aviario-metrics", "key": f"triggers/{trigger_key}/{i:08d}.txt"},
+            "decision": {"action": "escalate", "rule": None}, "metrics": {"chunks": 5},
+            "alert": f"ALERTA {i}: {trigger_key} em {house_id}. " + "Verificar ventilação e equipamentos. " * 10,
+        }
+        s3.put_object(Bucket=BUCKET, Key=key, Body=json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+        batch.append(s3_alerts.index_entry(key, payload))
+        if len(batch) == PER_INVOCATION:
+            s3_alerts.write_tenant_indexes(s3, BUCKET, batch, PREFIX)
+            batch = []
+    if batch:
+        s3_alerts.write_tenant_indexes(s3, BUCKET, batch, PREFIX)
+    return t0 + timedelta(days=days)
+
+def storage(s3: FakeS3) -> str:
+    keys = s3._keys.get(BUCKET, [])
+    size = sum(len(s3._objects[(BUCKET, k)][0]) for k in keys)
+    return f"objects={len(keys)} bytes={size}"
+
+def measure(s3: FakeS3, label: str, fn) -> None:
+    s3.calls.clear()
+    t0 = time.perf_counter()
+    n = fn()
+    ms = (time.perf_counter() - t0) * 1000
+    calls = {k: v for k, v in s3.calls.items() if k != "Presign"}
+    print(f"{label:<30} {ms:9.1f} ms  results={n:<6} requests={sum(calls.values()):<6} {calls}")
+
+def walk_history(args: dict) -> int:
+    n, cursor = 0, None
+    while True:
+        page = s3_alerts.get_alerts_page(**args, page_size=100, cursor=cursor)
+        n += len(page["items"])
+        assert not any("parse_error" in item["data"] for item in page["items"])
+        cursor = page["next_cursor"]
+        if not cursor:
+            return n
+
+def main(argv: list[str]) -> None:
+    days = int(argv[0]) if argv else 14
+    per_day = int(argv[1]) if len(argv) > 1 else 200
+    latency_ms = float(argv[2]) if len(argv) > 2 else 5.0
+
+    s3 = FakeS3()
+    print(f"populating {days} days x {per_day} alerts...")
+    end = populate(s3, days, per_day)
+    s3_alerts._s3 = lambda *a: s3
+    s3.latency_s = latency_ms / 1000
+    args = dict(aws_key=None, aws_secret=None, region="us-east-1", bucket=BUCKET, prefix=PREFIX)
+    tenant = [HOUSES[0]]
+
+    def run(label):
+        print(f"\n{label}: {storage(s3)}")
+        measure(s3, "history (all pages)", lambda: walk_history(args))
+        measure(s3, "page / 1 house", lambda: len(s3_alerts.get_alerts_page(**args, tenants=tenant)["items"]))
+
+    run("loose .json")
+    s3.calls.clear()
+    t0 = time.perf_counter()
+    result = s3_alerts.compact_alerts(s3, BUCKET, PREFIX, min_age_days=0, since="2000-01-01", now=end)
+    ms = (time.perf_counter() - t0) * 1000
+    print(f"\ncompaction: {result} in {ms:.0f} ms, requests={dict(s3.calls)}")
+    run("compacted")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
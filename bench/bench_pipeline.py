@@ -0,0 +1,291 @@
+# bench/bench_pipeline.py
+"""
+Replay de um fluxo de triggers pelo lambda_handler completo, contra S3/SNS/Bedrock
+locais (bench/fakes.py) com latência injetada. Mostra p50/p95/p99 por etapa,
+invocações/s, chamadas ao Agent evitadas e o pico de memória, e falha (exit 1)
+se piorar em relação a uma baseline gravada.
+
+    python -m bench.bench_pipeline                                  # fluxo sintético
+    python -m bench.bench_pipeline --log eventos.jsonl              # log gravado (formato do bench_rules)
+    python -m bench.bench_pipeline --save-baseline bench/baseline_pipeline.json
+    python -m bench.bench_pipeline --baseline bench/baseline_pipeline.json
+
+Etapas medidas: "handler" (uma invocação), "record" (handler / records),
+"s3.get", "s3.put", "sns.publish" e "agent" (stream completo), medidas de fora;
+e as etapas "span.*" que o próprio handler emite em EMF (backend/tracing.py).
+"""
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import importlib
+import contextlib
+import io
+import resource
+import threading
+from collections import defaultdict
+from backend.s3_triggers import TRIGGER_MAP
+from bench.fakes import FakeBedrockAgent, FakeS3, FakeSNS, FakeSQS
+
+TRIGGER_BUCKET = "aviario-metrics"
+
+# Métricas comparadas com a baseline: (nome, "max" = maior é pior / "min" = menor é pior, tolerância própria)
+# As contagens são determinísticas (tolerância 0); tempos usam --tolerance.
+REGRESSION_CHECKS = [
+    ("failed_records", "max", 0.0),
+    ("agent_calls", "max", 0.0),
+    ("s3_calls_per_invocation", "max", 0.0),
+    ("agent_input_tokens_per_call", "max", None),
+    ("p95_handler_ms", "max", None),
+    ("p95_record_ms", "max", None),
+    ("invocations_per_s", "min", None),
+]
+
+# ================== FLUXO DE TRIGGERS ==================
+def synthetic_stream(n: int, houses: int = 6, repeat: float = 0.5, seed: int = 3) -> list[dict]:
+    """
+    `n` triggers dos nove tipos do TRIGGER_MAP por `houses` pavilhões; com
+    probabilidade `repeat` um pavilhão repete o último trigger (rajadas).
+    """
+    rnd = random.Random(seed)
+    kinds = [k for k, _ in TRIGGER_MAP.values()]
+    last: dict[int, str] = {}
+    events = []
+    for i in range(n):
+        house = rnd.randrange(houses)
+        kind = last[house] if house in last and rnd.random() < repeat else rnd.choice(kinds)
+        last[house] = kind
+        ev = {
+            "ts": float(i), "trigger_key": kind,
+            "farm_id": f"farm-{house % 2}", "house_id": f"house-{house}", "readings": {},
+        }
+        if kind == "ammonia":
+            ev["readings"]["ammonia_ppm"] = round(rnd.uniform(15, 35), 1)
+        events.append(ev)
+    return events
+
+def _trigger_txt(ev: dict) -> str:
+    message = dict(TRIGGER_MAP.values()).get(ev["trigger_key"], ev["trigger_key"])
+    lines = [
+        message,
+        f"generated_at={ev.get('ts', 0)}",
+        f"trigger_key={ev['trigger_key']}",
+        f"farm_id={ev.get('farm_id', 'default')}",
+        f"house_id={ev.get('house_id', 'default')}",
+        "source=bench",
+    ]
+    lines += [f"{k}={v}" for k, v in (ev.get("readings") or {}).items()]
+    return "\n".join(lines) + "\n"
+
+# ================== MEDIÇÃO ==================
+class StageTimer:
+    def __init__(self):
+        self.samples: dict[str, list[float]] = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, ms: float) -> None:
+        with self._lock:
+            self.samples[stage].append(ms)
+
+    def wrap(self, client, stages: dict):
+        return _Timed(client, self, stages)
+
+class _Timed:
+    """Proxy que cronometra os métodos listados em `stages` ({método: etapa})."""
+
+    def __init__(self, client, timer: StageTimer, stages: dict):
+        self._client = client
+        self._timer = timer
+        self._stages = stages
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        stage = self._stages.get(name)
+        if stage is None:
+            return attr
+
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            out = attr(*args, **kwargs)
+            if isinstance(out, dict) and "completion" in out:
+                # stream: a etapa só termina quando o último pedaço é consumido
+                out = {**out, "completion": self._drain_timed(out["completion"], stage, t0)}
+            else:
+                self._timer.add(stage, (time.perf_counter() - t0) * 1000)
+            return out
+        return timed
+
+    def _drain_timed(self, stream, stage, t0):
+        yield from stream
+        self._timer.add(stage, (time.perf_counter() - t0) * 1000)
+
+def _add_emf(timer: StageTimer, text: str) -> None:
+    """Junta os tempos (*_ms) das linhas EMF do handler como etapas "span.<nome>"."""
+    for line in text.splitlines():
+        if not line.startswith('{"_aws"'):
+            continue
+        doc = json.loads(line)
+        for metric in doc["_aws"]["CloudWatchMetrics"][0]["Metrics"]:
+            if metric["Unit"] != "Milliseconds":
+                continue
+            values = doc[metric["Name"]]
+            for v in values if isinstance(values, list) else [values]:
+                timer.add(f"span.{metric['Name'][:-3]}", v)
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+# ================== EXECUÇÃO ==================
+def run(events: list[dict], args) -> dict:
+    import lambda_handler as lh
+    lh = importlib.reload(lh)  # estado limpo: regras, dedup, cache, fila de SMS
+    lh.SMS_DRAIN_WAIT_S = args.sms_wait
+    lh.METRICS_SAMPLE_RATE = 1.0  # todas as invocações emitem EMF (capturado abaixo)
+    logging.disable(logging.WARNING)  # o handler loga cada record em INFO
+
+    timer = StageTimer()
+    s3 = FakeS3()
+    sns = FakeSNS(account_tps=1e9, latency_s=args.sns_ms / 1000)
+    sqs = FakeSQS()
+    agent = FakeBedrockAgent(first_chunk_s=args.agent_first_ms / 1000, chunk_s=args.agent_chunk_ms / 1000)
+    lh._clients[("s3", "")] = timer.wrap(s3, {"get_object": "s3.get", "put_object": "s3.put"})
+    lh._clients[("sns", "")] = timer.wrap(sns, {"publish": "sns.publish"})
+    lh._clients[("sqs", "")] = sqs
+    lh._clients[("bedrock-agent-runtime", lh.AGENT_REGION)] = timer.wrap(agent, {"invoke_agent": "agent"})
+
+    records = []
+    for i, ev in enumerate(events):
+        key = f"triggers/bench/{ev['trigger_key']}/{i:07d}.txt"
+        s3.put_object(Bucket=TRIGGER_BUCKET, Key=key, Body=_trigger_txt(ev))
+        records.append({"s3": {"bucket": {"name": TRIGGER_BUCKET}, "object": {"key": key}}})
+    s3.calls.clear()
+    s3.latency_s = args.s3_ms / 1000
+
+    batches = [records[i:i + args.batch] for i in range(0, len(records), args.batch)]
+    interval = 1 / args.rate if args.rate > 0 else 0.0
+    failures = 0
+    t_start = time.perf_counter()
+    for n, batch in enumerate(batches):
+        if interval:
+            delay = t_start + n * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        emf = io.StringIO()
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(emf):
+            out = lh.lambda_handler({"Records": batch}, None)
+        ms = (time.perf_counter() - t0) * 1000
+        _add_emf(timer, emf.getvalue())
+        timer.add("handler", ms)
+        timer.add("record", ms / len(batch))
+        failures += len(out.get("batchItemFailures", []))
+    elapsed = time.perf_counter() - t_start
+
+    s3_calls = sum(v for k, v in s3.calls.items() if k != "Presign")
+    result = {
+        "triggers": len(events),
+        "invocations": len(batches),
+        "failed_records": failures,
+        "elapsed_s": round(elapsed, 3),
+        "invocations_per_s": round(len(batches) / elapsed, 2),
+        "records_per_s": round(len(events) / elapsed, 2),
+        "agent_calls": agent.calls["InvokeAgent"],
+        "agent_calls_avoided": round(1 - agent.calls["InvokeAgent"] / max(len(events), 1), 4),
+        "agent_input_tokens_per_call": round(agent.input_chars / 4 / max(agent.calls["InvokeAgent"], 1), 1),
+        "agent_sessions": len(agent.sessions),
+        "agent_sessions_ended": agent.ended_sessions,
+        "sms_sent": len(sns.sent),
+        "sms_pending": lh._sms_dispatcher.pending(),
+        "sms_spilled": lh._sms_dispatcher.stats["spilled"],
+        "s3_calls_per_invocation": round(s3_calls / len(batches), 2),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "stages": {},
+    }
+    for stage, values in sorted(timer.samples.items()):
+        result["stages"][stage] = {
+            "n": len(values),
+            "p50": round(percentile(values, 50), 2),
+            "p95": round(percentile(values, 95), 2),
+            "p99": round(percentile(values, 99), 2),
+        }
+    result["p95_handler_ms"] = result["stages"].get("handler", {}).get("p95", 0.0)
+    result["p95_record_ms"] = result["stages"].get("record", {}).get("p95", 0.0)
+    return result
+
+def check_regressions(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    problems = []
+    for name, direction, own_tol in REGRESSION_CHECKS:
+        if name not in baseline:
+            continue
+        tol = tolerance if own_tol is None else own_tol
+        base, now = baseline[name], result[name]
+        if direction == "max" and now > base * (1 + tol) + 1e-9:
+            problems.append(f"{name}: {now} > {base} (+{tol:.0%})")
+        if direction == "min" and now < base * (1 - tol) - 1e-9:
+            problems.append(f"{name}: {now} < {base} (-{tol:.0%})")
+    return problems
+
+def report(result: dict) -> None:
+    for k, v in result.items():
+        if k != "stages":
+            print(f"{k:26} {v}")
+    print(f"\n{'stage':18} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for stage, s in result["stages"].items():
+        print(f"{stage:18} {s['n']:>6} {s['p50']:>9.2f} {s['p95']:>9.2f} {s['p99']:>9.2f}")
+
+def main(argv: list[str]) -> None:
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    p.add_argument("--log", help="eventos JSON, um por linha (ts, trigger_key, farm_id, house_id, readings)")
+    p.add_argument("--triggers", type=int, default=400, help="tamanho do fluxo sintético")
+    p.add_argument("--houses", type=int, default=6)
+    p.add_argument("--repeat", type=float, default=0.5, help="probabilidade de repetir o último trigger do pavilhão")
+    p.add_argument("--batch", type=int, default=10, help="records por invocação")
+    p.add_argument("--rate", type=float, default=0.0, help="invocações por segundo (0 = o mais rápido possível)")
+    p.add_argument("--s3-ms", type=float, default=5.0)
+    p.add_argument("--sns-ms", type=float, default=20.0)
+    p.add_argument("--agent-first-ms", type=float, default=150.0)
+    p.add_argument("--agent-chunk-ms", type=float, default=10.0)
+    p.add_argument("--sms-wait", type=float, default=0.0, help="SMS_DRAIN_WAIT_S durante o replay")
+    p.add_argument("--baseline", help="falha se alguma métrica piorar em relação a este JSON")
+    p.add_argument("--tolerance", type=float, default=0.25, help="folga relativa para as métricas de tempo")
+    p.add_argument("--save-baseline", help="grava o resultado como baseline")
+    p.add_argument("--json", action="store_true", help="imprime o resultado em JSON")
+    args = p.parse_args(argv)
+
+    if args.log:
+        with open(args.log, encoding="utf-8") as f:
+            events = [json.loads(line) for line in f if line.strip()]
+    else:
+        events = synthetic_stream(args.triggers, args.houses, args.repeat)
+
+    result = run(events, args)
+    scenario = {k: v for k, v in vars(args).items() if k not in ("baseline", "tolerance", "save_baseline", "json")}
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        report(result)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump({"scenario": scenario, **{k: v for k, v in result.items() if k != "stages"}}, f, indent=2)
+            f.write("\n")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("scenario", scenario) != scenario:
+            print(f"\nbaseline was recorded with a different scenario: {baseline['scenario']}")
+            sys.exit(2)
+        problems = check_regressions(result, baseline, args.tolerance)
+        if problems:
+            print("\nREGRESSION:\n  " + "\n  ".join(problems))
+            sys.exit(1)
+        print("\nno regressions vs baseline")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
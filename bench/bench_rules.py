@@ -0,0 +1,81 @@
+# bench/bench_rules.py
+"""
+Reexecuta um log de triggers no motor de regras e mostra a fração de chamadas
+ao Agent evitadas. Confere também casos fixos de histerese (exit 1 se falharem).
+
+    python -m bench.bench_rules                 # log sintético
+    python -m bench.bench_rules eventos.jsonl   # um evento JSON por linha
+"""
+import sys
+import json
+import time
+import random
+from backend.s3_triggers import TRIGGER_MAP, RuleEngine, replay
+
+def synthetic_log(houses: int = 4, hours: int = 24, seed: int = 7) -> list[dict]:
+    """Rajadas de triggers por pavilhão, com leituras de amônia quando aplicável."""
+    rnd = random.Random(seed)
+    keys = [k for k, _ in TRIGGER_MAP.values()]
+    events = []
+    t0 = 1_750_000_000.0
+    for house in range(houses):
+        t = t0
+        while t < t0 + hours * 3600:
+            key = rnd.choice(keys)
+            burst = rnd.randint(1, 12)
+            for _ in range(burst):
+                ev = {"ts": t, "trigger_key": key, "farm_id": "farm-1", "house_id": f"house-{house}", "readings": {}}
+                if key == "ammonia":
+                    ev["readings"]["ammonia_ppm"] = rnd.uniform(15, 35)
+                events.append(ev)
+                t += rnd.uniform(2, 30)
+            t += rnd.expovariate(1 / 900)
+    return events
+
+# (ppm de amônia no mesmo pavilhão, decisão esperada): limiar 25 na subida, 20 na descida
+AMMONIA_CASES = [
+    (22.0, "escalate"),  # abaixo do limiar: o trigger do equipamento segue para o Agent
+    (24.9, "escalate"),  # na faixa de histerese a subir: ainda não é crítico
+    (30.0, "alert"),     # cruzou 25: alerta direto
+    (28.0, "drop"),      # mesmo episódio: repetição
+    (22.0, "drop"),      # na faixa a descer: o episódio continua
+    (18.0, "escalate"),  # abaixo de 20: episódio terminou, volta a ir para o Agent
+    (26.0, "alert"),     # novo episódio
+]
+
+def check_cases() -> list[str]:
+    engine = RuleEngine()
+    problems = []
+    for i, (ppm, expected) in enumerate(AMMONIA_CASES):
+        ev = {"ts": 60.0 * i, "trigger_key": "ammonia", "farm_id": "farm-1", "house_id": "house-0",
+              "readings": {"ammonia_ppm": ppm}}
+        got = engine.evaluate(ev)["action"]
+        if got != expected:
+            problems.append(f"ammonia {ppm} ppm (#{i}): {got}, expected {expected}")
+    return problems
+
+def main(argv: list[str]) -> None:
+    if argv:
+        with open(argv[0], encoding="utf-8") as f:
+            events = [json.loads(line) for line in f if line.strip()]
+    else:
+        events = synthetic_log()
+
+    t0 = time.perf_counter()
+    result = replay(events)
+    elapsed = time.perf_counter() - t0
+
+    print(f"events           : {result['events']}")
+    print(f"by action        : {result['by_action']}")
+    print(f"agent calls      : {result['agent_calls']}")
+    print(f"avoided fraction : {result['avoided_fraction']:.1%}")
+    print(f"engine time      : {elapsed * 1e6 / max(result['events'], 1):.1f} µs/event")
+
+    problems = check_cases()
+    print(f"hysteresis cases : {'ok' if not problems else 'FAILED'}")
+    for p in problems:
+        print(f"  {p}")
+    sys.exit(1 if problems else 0)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
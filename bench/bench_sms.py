@@ -0,0 +1,94 @@
+# bench/bench_sms.py
+"""
+Teste de carga do SmsDispatcher contra o FakeSNS, em tempo simulado: rajadas de
+alertas para vários caseiros, e verificação de que a quota da conta e a de cada
+destino nunca são excedidas.
+
+    python -m bench.bench_sms [n_alertas] [destinos]
+"""
+import sys
+import random
+from collections import Counter, deque
+from backend.sms_dispatcher import SmsDispatcher
+from bench.fakes import FakeClock, FakeSNS
+
+ACCOUNT_TPS = 20
+DEST_PER_HOUR = 20
+DEST_BURST = 3
+
+def max_in_window(times: list[float], window_s: float) -> int:
+    best, q = 0, deque()
+    for t in sorted(times):
+        q.append(t)
+        while t - q[0] >= window_s:
+            q.popleft()
+        best = max(best, len(q))
+    return best
+
+def run(n: int, destinations: int, sns_tps: float, seed: int = 11) -> dict:
+    rnd = random.Random(seed)
+    clock = FakeClock()
+    sns = FakeSNS(clock=clock, account_tps=sns_tps, dest_per_hour=DEST_PER_HOUR + DEST_BURST)
+    numbers = [f"+3519100{i:05d}" for i in range(destinations)]
+    supervisor = "+351919999999"
+    # cada caseiro recebe os triggers do seu pavilhão; o supervisor recebe também os críticos
+    routes = [{"severity": {"critical"}, "to": [supervisor]}]
+    routes += [{"triggers": {f"house-{i}"}, "to": [number]} for i, number in enumerate(numbers)]
+    dispatcher = SmsDispatcher(
+        publish=lambda to, msg: sns.publish(PhoneNumber=to, Message=msg),
+        routes=routes,
+        dest_rate_per_s=DEST_PER_HOUR / 3600,
+        dest_burst=DEST_BURST,
+        account_rate_per_s=ACCOUNT_TPS,
+        digest_window_s=30,
+        clock=clock,
+        sleep=clock.sleep,
+    )
+
+    submitted = deliveries = 0
+    while submitted < n:
+        # rajada de alertas (mesmo instante) para um subconjunto de pavilhões
+        for _ in range(min(rnd.randint(1, 60), n - submitted)):
+            severity = "critical" if rnd.random() < 0.02 else "warning"
+            house = f"house-{rnd.randrange(destinations)}"
+            deliveries += len(dispatcher.submit(f"alerta {submitted}", trigger_key=house, severity=severity))
+            submitted += 1
+        dispatcher.pump()
+        clock.sleep(rnd.expovariate(1 / 5))
+    while dispatcher.pending():
+        dispatcher.drain(3600)
+
+    by_dest = Counter(d for _, d, _ in sns.sent)
+    worst_dest = max(
+        (max_in_window([t for t, d, _ in sns.sent if d == dest], 3600) for dest in by_dest), default=0
+    )
+    return {
+        "alerts": n,
+        "deliveries": deliveries,
+        "sms_sent": len(sns.sent),
+        "digests": dispatcher.stats["digests"],
+        "alerts_delivered": dispatcher.stats["alerts_sent"],
+        "throttled": sns.calls["Throttled"],
+        "failed": dispatcher.stats["failed"],
+        "max_per_second": max_in_window([t for t, _, _ in sns.sent], 1.0),
+        "max_per_dest_hour": worst_dest,
+        "simulated_min": round(clock() / 60, 1),
+    }
+
+def main(argv: list[str]) -> None:
+    n = int(argv[0]) if argv else 5000
+    destinations = int(argv[1]) if len(argv) > 1 else 50
+    ok = True
+    for label, sns_tps in (("quota SNS = limite do dispatcher", ACCOUNT_TPS), ("quota SNS real menor (10/s)", 10)):
+        r = run(n, destinations, sns_tps)
+        print(f"{label}:")
+        for k, v in r.items():
+            print(f"  {k:18} {v}")
+        within = r["max_per_second"] <= sns_tps and r["max_per_dest_hour"] <= DEST_PER_HOUR + DEST_BURST
+        delivered = r["alerts_delivered"] + r["failed"] == r["deliveries"]
+        print(f"  quota respeitada: {'sim' if within else 'NÃO'}; todos entregues ou contados: {'sim' if delivered else 'NÃO'}")
+        ok = ok and within and delivered
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
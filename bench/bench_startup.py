@@ -0,0 +1,114 @@
+# bench/bench_startup.py
+"""
+Custo de arranque a frio do lambda_handler, medido em processos Python novos
+(como um ambiente de execução novo do Lambda):
+
+    import   -> `import lambda_handler` (fase Init); já inclui botocore.exceptions
+                (~10 ms), que o handler e o backend importam no topo para os
+                `except ClientError`
+    clients  -> criação dos clientes S3, SNS e Bedrock Agent Runtime (1ª invocação;
+                inclui o import de botocore.session/client e dos dados de serviço,
+                esses sim preguiçosos)
+    init     -> import + clients
+
+Falha (exit 1) se a mediana passar do orçamento, ou se algum módulo pesado que só
+deve ser importado sob demanda (EAGER_FORBIDDEN) já estiver carregado depois do import.
+
+    python -m bench.bench_startup
+    python -m bench.bench_startup --runs 10 --import-budget-ms 120 --init-budget-ms 400
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+from bench.bench_pipeline import percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Orçamentos (mediana, ms). Medidos num runtime x86_64 comum com folga de ~1.5x;
+# ajuste com --import-budget-ms / --init-budget-ms para máquinas mais lentas.
+IMPORT_BUDGET_MS = 150
+INIT_BUDGET_MS = 350
+
+# Não podem estar em sys.modules logo após `import lambda_handler`
+EAGER_FORBIDDEN = ("boto3", "botocore.session", "botocore.client", "s3transfer", "numpy")
+
+_CHILD = r"""
+import sys, json, time
+t0 = time.perf_counter()
+import lambda_handler as lh
+t1 = time.perf_counter()
+eager = [m for m in EAGER if m in sys.modules]
+lh.get_client("s3")
+lh.get_client("sns")
+lh.get_client("bedrock-agent-runtime", lh.AGENT_REGION)
+t2 = time.perf_counter()
+print(json.dumps({
+    "import_ms": (t1 - t0) * 1000,
+    "clients_ms": (t2 - t1) * 1000,
+    "eager": eager,
+    "modules": len(sys.modules),
+}))
+"""
+
+def measure_once() -> dict:
+    env = {
+        **os.environ,
+        "AWS_ACCESS_KEY_ID": "bench", "AWS_SECRET_ACCESS_KEY": "bench",
+        "AWS_DEFAULT_REGION": "us-east-1", "AWS_REGION": "us-east-1",
+    }
+    code = f"EAGER = {EAGER_FORBIDDEN!r}\n{_CHILD}"
+    out = subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+    )
+    sample = json.loads(out.stdout.strip().splitlines()[-1])
+    sample["init_ms"] = sample["import_ms"] + sample["clients_ms"]
+    return sample
+
+def run(runs: int) -> dict:
+    measure_once()  # aquece o cache de bytecode / disco; não entra na conta
+    samples = [measure_once() for _ in range(runs)]
+    result = {"runs": runs, "eager_imports": sorted({m for s in samples for m in s["eager"]})}
+    for name in ("import_ms", "clients_ms", "init_ms"):
+        values = [s[name] for s in samples]
+        result[name] = {
+            "p50": round(percentile(values, 50), 1),
+            "p95": round(percentile(values, 95), 1),
+            "max": round(max(values), 1),
+        }
+    result["modules_loaded"] = samples[-1]["modules"]
+    return result
+
+def main(argv: list[str]) -> None:
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    p.add_argument("--runs", type=int, default=7)
+    p.add_argument("--import-budget-ms", type=float, default=IMPORT_BUDGET_MS)
+    p.add_argument("--init-budget-ms", type=float, default=INIT_BUDGET_MS)
+    p.add_argument("--json", action="store_true", help="imprime o resultado em JSON")
+    args = p.parse_args(argv)
+
+    result = run(args.runs)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print(f"{'phase':12} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}")
+        for name in ("import_ms", "clients_ms", "init_ms"):
+            r = result[name]
+            print(f"{name[:-3]:12} {r['p50']:>9.1f} {r['p95']:>9.1f} {r['max']:>9.1f}")
+        print(f"\nmodules loaded after init: {result['modules_loaded']}")
+
+    problems = []
+    if result["eager_imports"]:
+        problems.append(f"imported eagerly by lambda_handler: {', '.join(result['eager_imports'])}")
+    if result["import_ms"]["p50"] > args.import_budget_ms:
+        problems.append(f"import: {result['import_ms']['p50']} ms > budget {args.import_budget_ms} ms")
+    if result["init_ms"]["p50"] > args.init_budget_ms:
+        problems.append(f"init: {result['init_ms']['p50']} ms > budget {args.init_budget_ms} ms")
+    if problems:
+        print("\nOVER BUDGET:\n  " + "\n  ".join(problems))
+        sys.exit(1)
+    print("\nwithin startup budget")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
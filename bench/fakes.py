@@ -0,0 +1,266 @@
+# bench/fakes.py
+"""
+Substitutos locais (em memória) dos serviços AWS usados pelo pipeline, só para
+benchmarks. Contam as chamadas por operação e podem injetar latência.
+"""
+import io
+import time
+import random
+import bisect
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+from botocore.exceptions import ClientError
+
+class FakeS3:
+    """S3 mínimo: get/put (IfMatch/IfNoneMatch)/delete/list_objects_v2 (paginado, com Delimiter) e presign."""
+
+    def __init__(self, latency_s: float = 0.0, page_size: int = 1000):
+        self.latency_s = latency_s
+        self.page_size = page_size
+        self.calls = Counter()
+        self._objects: dict[tuple[str, str], tuple[bytes, datetime]] = {}
+        self._keys: dict[str, list[str]] = {}
+        self._metadata: dict[tuple[str, str], dict] = {}
+        self._lock = threading.Lock()
+
+    def _tick(self, op: str) -> None:
+        self.calls[op] += 1
+        if self.latency_s:
+            time.sleep(self.latency_s)
+
+    def put_object(self, Bucket, Key, Body=b"", Metadata=None, IfNoneMatch=None, IfMatch=None, **kwargs):
+        self._tick("PutObject")
+        if isinstance(Body, str):
+            Body = Body.encode("utf-8")
+        with self._lock:
+            keys = self._keys.setdefault(Bucket, [])
+            current = self._objects.get((Bucket, Key))
+            if IfMatch is not None and current is None:
+                raise ClientError({"Error": {"Code": "NoSuchKey", "Message": Key}}, "PutObject")
+            if IfMatch is not None and IfMatch != f'"{hash(current[0]) & 0xffffffff:08x}"':
+                raise ClientError({"Error": {"Code": "PreconditionFailed", "Message": Key}}, "PutObject")
+            if current is None:
+                bisect.insort(keys, Key)
+            elif IfNoneMatch == "*":
+                raise ClientError({"Error": {"Code": "PreconditionFailed", "Message": Key}}, "PutObject")
+            self._objects[(Bucket, Key)] = (bytes(Body), datetime.now(timezone.utc))
+            self._metadata[(Bucket, Key)] = dict(Metadata or {})
+        return {"ETag": f'"{hash(Body) & 0xffffffff:08x}"'}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        self._tick("GetObject")
+        item = self._objects.get((Bucket, Key))
+        if item is None:
+            raise ClientError({"Error": {"Code": "NoSuchKey", "Message": Key}}, "GetObject")
+        body, modified = item
+        if Range:
+            start, _, end = Range.removeprefix("bytes=").partition("-")
+            body = body[int(start):int(end) + 1 if end else None]
+        return {
+            "Body": io.BytesIO(body), "LastModified": modified, "ContentLength": len(body),
+            "Metadata": self._metadata.get((Bucket, Key), {}), "ETag": f'"{hash(item[0]) & 0xffffffff:08x}"',
+        }
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._tick("HeadObject")
+        item = self._objects.get((Bucket, Key))
+        if item is None:
+            raise ClientError({"Error": {"Code": "404", "Message": Key}}, "HeadObject")
+        return {"LastModified": item[1], "ContentLength": len(item[0]), "ETag": f'"{hash(item[0]) & 0xffffffff:08x}"'}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._tick("DeleteObject")
+        with self._lock:
+            if self._objects.pop((Bucket, Key), None) is not None:
+                self._keys[Bucket].remove(Key)
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self._tick("DeleteObjects")
+        with self._lock:
+            for obj in Delete.get("Objects", []):
+                if self._objects.pop((Bucket, obj["Key"]), None) is not None:
+                    self._keys[Bucket].remove(obj["Key"])
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix="", Delimiter=None, StartAfter=None,
+                        ContinuationToken=None, MaxKeys=None, **kwargs):
+        self._tick("ListObjectsV2")
+        keys = self._keys.get(Bucket, [])
+        start_key = ContinuationToken or StartAfter or ""
+        i = bisect.bisect_left(keys, Prefix)
+        if start_key:
+            i = max(i, bisect.bisect_right(keys, start_key))
+        limit = min(MaxKeys or self.page_size, self.page_size)
+        contents, prefixes, last = [], [], None
+        while i < len(keys) and len(contents) + len(prefixes) < limit:
+            key = keys[i]
+            if not key.startswith(Prefix):
+                break
+            if Delimiter and Delimiter in key[len(Prefix):]:
+                common = key[:len(Prefix) + key[len(Prefix):].index(Delimiter) + 1]
+                prefixes.append({"Prefix": common})
+                last = common + "￿"
+                i = bisect.bisect_left(keys, last)
+                continue
+            body, modified = self._objects[(Bucket, key)]
+            contents.append({"Key": key, "LastModified": modified, "Size": len(body)})
+            last = key
+            i += 1
+        truncated = i < len(keys) and keys[i].startswith(Prefix)
+        resp = {"Contents": contents, "CommonPrefixes": prefixes, "KeyCount": len(contents), "IsTruncated": truncated}
+        if truncated:
+            resp["NextContinuationToken"] = last
+        return resp
+
+    def get_paginator(self, name):
+        assert name == "list_objects_v2"
+        return _Paginator(self.list_objects_v2)
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn=3600):
+        self.calls["Presign"] += 1
+        return f"https://{Params['Bucket']}.s3.local/{Params['Key']}?X-Amz-Expires={ExpiresIn}"
+
+class _Paginator:
+    def __init__(self, op):
+        self.op = op
+
+    def paginate(self, **kwargs):
+        token = None
+        while True:
+            page = self.op(**kwargs, **({"ContinuationToken": token} if token else {}))
+            yield page
+            if not page.get("IsTruncated"):
+                return
+            token = page["NextContinuationToken"]
+
+class FakeClock:
+    """Relógio simulado: sleep() avança o tempo sem esperar."""
+
+    def __init__(self, start: float = 0.0):
+        self.t = start
+
+    def __call__(self) -> float:
+        return self.t
+
+    def sleep(self, dt: float) -> None:
+        self.t += max(dt, 0.0)
+
+class FakeSNS:
+    """
+    SNS mínimo para SMS: publish(PhoneNumber=...) com quota de conta (msgs/s) e,
+    opcionalmente, por destino (msgs/hora). Acima da quota devolve Throttling,
+    como o SNS real. `sent` guarda (t, destino, mensagem) dos aceites.
+    """
+
+    def __init__(self, clock=time.monotonic, account_tps: float = 20, dest_per_hour: float | None = None,
+                 latency_s: float = 0.0):
+        self.clock = clock
+        self.account_tps = account_tps
+        self.dest_per_hour = dest_per_hour
+        self.latency_s = latency_s
+        self.calls = Counter()
+        self.sent: list[tuple[float, str, str]] = []
+        self._lock = threading.Lock()
+
+    def _throttle(self, what: str):
+        self.calls["Throttled"] += 1
+        return ClientError({"Error": {"Code": "Throttling", "Message": f"Rate exceeded ({what})"}}, "Publish")
+
+    def publish(self, PhoneNumber=None, Message="", **kwargs):
+        self.calls["Publish"] += 1
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        now = self.clock()
+        with self._lock:
+            last_second = sum(1 for t, _, _ in self.sent[-int(self.account_tps) - 1:] if now - t < 1.0)
+            if last_second >= self.account_tps:
+                raise self._throttle("account")
+            if self.dest_per_hour is not None:
+                last_hour = sum(1 for t, d, _ in self.sent if d == PhoneNumber and now - t < 3600)
+                if last_hour >= self.dest_per_hour:
+                    raise self._throttle(PhoneNumber)
+            self.sent.append((now, PhoneNumber, Message))
+        return {"MessageId": f"fake-{len(self.sent)}"}
+
+class FakeSQS:
+    """SQS mínimo: send_message guarda (fila, corpo, atraso); `received()` devolve os records do Lambda."""
+
+    def __init__(self, latency_s: float = 0.0):
+        self.latency_s = latency_s
+        self.calls = Counter()
+        self.messages: list[tuple[str, str, int]] = []
+        self._lock = threading.Lock()
+
+    def send_message(self, QueueUrl, MessageBody, DelaySeconds=0, **kwargs):
+        self.calls["SendMessage"] += 1
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        with self._lock:
+            self.messages.append((QueueUrl, MessageBody, DelaySeconds))
+            return {"MessageId": f"fake-{len(self.messages)}"}
+
+    def received(self) -> list[dict]:
+        """Esvazia a fila no formato de evento SQS -> Lambda ({"Records": [...]})."""
+        with self._lock:
+            messages, self.messages = self.messages, []
+        return [{"messageId": f"msg-{i}", "body": body} for i, (_, body, _) in enumerate(messages)]
+
+class FakeBedrockAgent:
+    """
+    bedrock-agent-runtime mínimo: invoke_agent devolve um stream "completion" com
+    a resposta em pedaços. `first_chunk_s` simula o tempo até o 1º pedaço e
+    `chunk_s` o intervalo entre pedaços. Conta os caracteres de entrada e as
+    sessões usadas/fechadas (endSession).
+    Falhas injetadas: ThrottlingException acima de `max_concurrent` streams em
+    curso ou com probabilidade `throttle_rate`; DependencyFailedException com
+    probabilidade `error_rate` (mude os atributos a meio para simular uma queda).
+    """
+
+    def __init__(self, first_chunk_s: float = 0.0, chunk_s: float = 0.0, answer_chars: int = 400,
+                 chunk_chars: int = 80, max_concurrent: int | None = None, throttle_rate: float = 0.0,
+                 error_rate: float = 0.0, seed: int = 7):
+        self.first_chunk_s = first_chunk_s
+        self.chunk_s = chunk_s
+        self.answer_chars = answer_chars
+        self.chunk_chars = chunk_chars
+        self.max_concurrent = max_concurrent
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.input_chars = 0
+        self.sessions: set[str] = set()
+        self.ended_sessions = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _stream(self, text: str):
+        try:
+            for i in range(0, len(text), self.chunk_chars):
+                time.sleep(self.first_chunk_s if i == 0 else self.chunk_s)
+                yield {"chunk": {"bytes": text[i:i + self.chunk_chars].encode("utf-8")}}
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def invoke_agent(self, agentId=None, agentAliasId=None, sessionId=None, inputText="", **kwargs):
+        self.calls["InvokeAgent"] += 1
+        with self._lock:
+            if ((self.max_concurrent is not None and self.in_flight >= self.max_concurrent)
+                    or self._rng.random() < self.throttle_rate):
+                self.calls["Throttled"] += 1
+                raise ClientError({"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}}, "InvokeAgent")
+            if self._rng.random() < self.error_rate:
+                self.calls["Failed"] += 1
+                raise ClientError({"Error": {"Code": "DependencyFailedException", "Message": "down"}}, "InvokeAgent")
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        self.input_chars += len(inputText)
+        self.sessions.add(sessionId)
+        self.ended_sessions += bool(kwargs.get("endSession"))
+        head = inputText.splitlines()[0] if inputText else ""
+        text = f"ALERTA: {head}. " + "Verificar ventilação e equipamentos. " * (self.answer_chars // 36 + 1)
+        return {"completion": self._stream(text[:self.answer_chars]), "sessionId": sessionId}
@@ -1,11 +1,29 @@
+import re
 import json
-import uuid
-import boto3
+import hashlib
 import logging
 import posixpath
-from typing import Dict, Any
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Iterator, List, Tuple
 from datetime import datetime
-from botocore.exceptions import ClientError, BotoCoreError, ParamValidationError
+from urllib.parse import unquote_plus
+from concurrent.futures import ThreadPoolExecutor
+from backend.agent_context import (
+    HouseContext, SessionPool, build_prompt, column_stats, estimate_tokens, trigger_family,
+)
+from backend.agent_scheduler import AgentScheduler, AgentUnavailable, CircuitBreaker
+from backend.anomaly import AnomalyMonitor
+from backend.rollups import RollupBuffer, RollupStore, event_readings, event_ts
+from backend.s3_alerts import compact_alerts, index_entry, mark_tenants, write_tenant_indexes
+from backend.s3_triggers import TRIGGER_MAP, RuleEngine, fallback_message
+from backend.sms_dispatcher import SmsDispatcher
+from backend.tenancy import tenant_of, tenant_prefix
+from backend.tracing import NullTrace, Trace, sampled
+from backend.sensor_batch import batch_rows, decode_batch, is_sensor_batch, summarize_batch
+# só as classes de exceção (leve); sessão, clientes e dados de serviço do botocore ficam para get_client
+from botocore.exceptions import BotoCoreError, ClientError
 
 # ============================================================
 # CONSTANTES DE CONFIG  (preencha aqui; nada via env vars)
@@ -14,8 +32,109 @@ AGENT_REGION   = "us-east-1"              # região onde o Agent está publicado
 AGENT_ID       = "QAYKR34TMW"  # ex.: "A1BCDEFGHIJKLMN"
 AGENT_ALIAS_ID = "TSTALIASID"  # ex.: "TSTALIASID"
 OUTPUT_BUCKET  = "alertas-caseiro"         # bucket de saída p/ salvar o alerta
+OUTPUT_PREFIX  = "alerts/"                 # prefixo dos alertas e do catálogo (_latest.json, _index/, _segments/)
 SENDER_ID = "CAISEIRO"  # Replace with your actual Sender ID
 DESTINATION_NUMBER = "+351..."  # Replace with your destination number (E.164 format)
+MAX_WORKERS    = 8                        # nº máximo de records processados em paralelo por invocação
+
+# Pool/timeouts dos clientes boto3 (reutilizados entre invocações "quentes")
+CLIENT_POOL_SIZE = MAX_WORKERS * 2        # conexões HTTP mantidas por cliente
+CLIENT_TIMEOUTS  = {                      # serviço -> (connect_timeout, read_timeout) em segundos
+    "s3": (2, 10),
+    "sns": (2, 10),
+    "sqs": (2, 10),
+    "bedrock-agent-runtime": (2, 120),    # o stream do Agent pode demorar
+}
+CLIENT_MAX_ATTEMPTS = 3
+ENDPOINT_URLS = {}                        # ex.: {"s3": "http://localhost:4566"} p/ stubs locais
+
+# Deduplicação: repetições do mesmo trigger (mesma granja/pavilhão) dentro da janela
+# não chamam o Agent; a contagem é levada na próxima chamada
+DEDUP_WINDOW_S    = 300                   # 0 desativa
+DEDUP_BACKEND     = "memory"              # "memory" (por instância) | "dynamodb" (partilhado)
+DEDUP_TABLE       = "caseiro-dedup"       # tabela DynamoDB (pk string "pk", TTL em "expires_at")
+DEDUP_MAX_ENTRIES = 1024                  # tamanho do LRU em memória
+DEDUP_TTL_S       = 3600                  # tempo que uma contagem suprimida é lembrada
+
+# Cache de respostas do Agent (chave = hash do prompt enviado ao Agent, normalizado)
+CACHE_TTL_S       = 900                   # 0 desativa
+CACHE_MAX_ENTRIES = 512
+CACHE_S3_PREFIX   = ""                    # ex.: "cache/" p/ camada persistente em OUTPUT_BUCKET
+VOLATILE_FIELDS   = {"generated_at", "timestamp", "ts", "source"}
+
+# Sessões do Agent por granja/pavilhão/família de trigger e prompt compacto (backend/agent_context.py)
+AGENT_SESSION_MAX_AGE_S = 1800            # idade máxima; o último turno vai com endSession=True
+AGENT_SESSION_IDLE_S    = 540             # abaixo do idleSessionTTLInSeconds do Agent (600 por omissão)
+AGENT_SESSION_MAX_TURNS = 12              # o histórico da sessão também conta como tokens de entrada
+COMPACT_PROMPTS         = True            # False = envia o .txt bruto ao Agent
+PROMPT_TOKEN_BUDGET     = 300             # tamanho máximo do prompt compacto (~4 caracteres por token)
+PROMPT_MAX_HISTORY      = 3               # decisões anteriores do pavilhão por prompt
+
+# Agendamento das chamadas ao Agent por instância (backend/agent_scheduler.py): faixas de
+# severidade, limite de concorrência/tokens, backoff no throttling e disjuntor com fallback
+AGENT_MAX_CONCURRENCY  = 4                # chamadas simultâneas (cai pela metade a cada throttling)
+AGENT_TOKENS_PER_S     = 1000             # tokens de entrada por segundo (estimados)
+AGENT_TOKEN_BURST      = 2000
+AGENT_LANE_TRIGGERS    = {                # faixa -> trigger_keys; os restantes vão para "warning"
+    "critical": {"ammonia", "high_temperature", "low_temperature"},
+    "info": {"variable_fan_speed", "variable_current"},
+}
+AGENT_MAX_WAIT_S       = {"critical": 10, "warning": 4, "info": 1}  # espera na fila antes do fallback
+AGENT_MAX_ATTEMPTS     = 4                # tentativas com throttling antes do fallback
+AGENT_ERROR_BUDGET     = 0.5              # fração de erros (últimas 20 chamadas) que abre o disjuntor
+AGENT_LATENCY_BUDGET_S = 20               # chamadas mais lentas do que isto contam como lentas...
+AGENT_SLOW_BUDGET      = 0.5              # ...e esta fração delas também abre o disjuntor
+AGENT_BREAKER_OPEN_S   = 30               # tempo aberto antes da chamada de teste
+
+# Regras locais (backend/s3_triggers.RULES) avaliadas antes do dedup/Agent
+RULES_ENABLED = True
+
+# SMS
+SMS_MAX_CHARS = 1600                      # 160 = 1 segmento GSM; 1600 = máximo aceito pelo SNS
+STREAM_SMS    = True                      # envia o SMS assim que o stream tiver SMS_MAX_CHARS
+SMS_ROUTES    = [                         # destinos extra por severidade/trigger/granja (DESTINATION_NUMBER é o padrão)
+    # {"severity": {"critical"}, "to": ["+351...", DESTINATION_NUMBER]},
+    # {"farms": {"granja-norte"}, "to": ["+351..."]},
+    # {"triggers": {"variable_current"}, "to": ["+351..."]},
+]
+SMS_CRITICAL_TRIGGERS = {"ammonia", "high_temperature", "low_temperature"}
+# As quotas abaixo são por instância (token buckets em memória): com N instâncias em
+# paralelo, mais o sms_retry_handler, use a quota real / N (ver backend/sms_dispatcher.py)
+SMS_DEST_PER_HOUR   = 20                  # quota por destino (token bucket); acima disso os alertas viram resumo
+SMS_DEST_BURST      = 3
+SMS_ACCOUNT_TPS     = 20                  # limite de envio de SMS da conta SNS (msgs/s)
+SMS_DIGEST_WINDOW_S = 0                   # >0 espera este tempo para juntar alertas num resumo
+SMS_DRAIN_WAIT_S    = 2                   # espera máxima por quota no fim da invocação
+SMS_MAX_ATTEMPTS    = 4                   # tentativas com backoff quando o SNS devolve throttling
+SMS_IDEMPOTENCY_TTL_S = 86400             # reprocessar o mesmo objeto dentro disto não reenvia o SMS
+SMS_CLAIM_MAX_ENTRIES = 16384             # LRU em memória das chaves já enviadas (store própria, fora do dedup)
+# Fila SQS de reenvio (consumida por sms_retry_handler, com DLQ e maxReceiveCount=1 na redrive
+# policy): recebe as sobras da quota no fim da invocação e os SMS que o SNS recusou. "" = desativada
+# (as sobras ficam só na memória da instância e as falhas são descartadas)
+SMS_RETRY_QUEUE_URL = "https://sqs.us-east-1.amazonaws.com/<account-id>/caseiro-sms-retry"  # Replace with your queue URL
+SMS_RETRY_DELAY_S   = 300                 # DelaySeconds de cada reenvio (máx. 900)
+SMS_RETRY_MAX       = 12                  # reenvios de um alerta antes de ir para a DLQ
+SMS_RETRY_MAX_BYTES = 200_000             # tamanho máximo de cada mensagem (o SQS aceita 256 KiB)
+
+# Rollups (backend/rollups.py): contagens e min/max/média das leituras por pavilhão,
+# trigger_key e minuto/hora/dia, em OUTPUT_BUCKET/OUTPUT_PREFIX_rollups/ (gráfico de tendências do app)
+ROLLUPS_ENABLED    = True
+ROLLUP_RESOLUTIONS = ("minute", "hour", "day")
+
+# Compactação dos alertas (compaction_handler, função agendada à parte, ex.: EventBridge 1x/dia):
+# os .json de cada dia fechado viram segmentos .jsonl.gz lidos com GETs de faixa
+COMPACTION_MIN_AGE_DAYS = 2               # só dias com pelo menos esta idade (eventos atrasados de ontem)
+COMPACTION_LOOKBACK_DAYS = 7              # dias revistos por execução (os já compactados custam 1 LIST)
+
+# Gravação do alerta e envio do SMS correm em paralelo (pool partilhado entre invocações)
+IO_WORKERS = 4
+
+# Métricas (EMF: uma linha JSON por invocação, o CloudWatch extrai as métricas do log)
+METRICS_NAMESPACE   = "Caseiro/Pipeline"
+METRICS_FUNCTION    = "caseiro-alerts"     # dimensão "Function"
+METRICS_SAMPLE_RATE = 0.1                 # fração das invocações quentes emitidas (as frias saem sempre)
+PROFILE_ENABLED     = False               # cProfile por invocação (só para sessões de profiling)
+PROFILE_TOP_N       = 25                  # funções mostradas no log (ordenadas por tempo acumulado)
 
 # ============================================================
 # LOGGING
@@ -23,11 +142,82 @@ DESTINATION_NUMBER = "+351..."  # Replace with your destination number (E.164 fo
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+_cold = True  # primeira invocação deste ambiente de execução
+
 # ============================================================
-# CLIENTES AWS (apenas S3 aqui; o do Agent é criado com região no helper)
+# CLIENTES AWS (registro no escopo do módulo, criados na 1ª utilização)
 # ============================================================
-s3 = boto3.client("s3")
-sns_client = boto3.client('sns')
+# O botocore (boto3 incluído) só é importado na criação do 1º cliente: um evento
+# inválido não o paga, e o import do módulo (fase Init do Lambda) fica mais curto.
+# Os clientes saem direto de uma sessão botocore: mesma API que boto3.client, sem
+# as extensões de transferência do boto3 para o S3 (s3transfer), que não usamos.
+_clients: Dict[Tuple[str, str], Any] = {}
+_clients_lock = threading.Lock()
+_client_stats: Dict[str, Dict[str, float]] = {}
+_session = None
+
+def _botocore_session() -> Any:
+    global _session
+    if _session is None:
+        import botocore.session
+        _session = botocore.session.get_session()
+    return _session
+
+def get_client(service: str, region: str | None = None) -> Any:
+    """
+    Devolve o cliente do serviço, criando-o só na primeira chamada.
+    Em invocações "quentes" o mesmo cliente (e as conexões TLS do pool) é reutilizado.
+    """
+    cache_key = (service, region or "")
+    stats = _client_stats.setdefault(service, {"created": 0, "reused": 0, "init_ms": 0.0})
+    client = _clients.get(cache_key)
+    if client is not None:
+        stats["reused"] += 1
+        return client
+
+    with _clients_lock:
+        client = _clients.get(cache_key)
+        if client is not None:
+            stats["reused"] += 1
+            return client
+
+        t0 = time.perf_counter()  # inclui o import de botocore.session/client no 1º cliente
+        from botocore.config import Config
+
+        connect_timeout, read_timeout = CLIENT_TIMEOUTS.get(service, (2, 30))
+        config = Config(
+            max_pool_connections=CLIENT_POOL_SIZE,
+            tcp_keepalive=True,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            retries={"max_attempts": CLIENT_MAX_ATTEMPTS, "mode": "adaptive"},
+        )
+        client = _botocore_session().create_client(
+            service,
+            region_name=region,
+            endpoint_url=ENDPOINT_URLS.get(service),
+            config=config,
+        )
+        stats["init_ms"] += (time.perf_counter() - t0) * 1000
+        stats["created"] += 1
+        _clients[cache_key] = client
+        return client
+
+def client_stats() -> Dict[str, Dict[str, float]]:
+    """Contadores de criação/reuso dos clientes (para benchmarks)."""
+    return {service: dict(values) for service, values in _client_stats.items()}
+
+def _s3() -> Any:
+    return get_client("s3")
+
+def _sns() -> Any:
+    return get_client("sns")
+
+def _sqs() -> Any:
+    return get_client("sqs")
+
+def _agent_rt() -> Any:
+    return get_client("bedrock-agent-runtime", AGENT_REGION)
 
 # ============================================================
 # HELPERS
@@ -37,37 +227,517 @@ def _basename_no_ext(key: str) -> str:
     dot = base.rfind(".")
     return base[:dot] if dot > 0 else base
 
-def invoke_agent(input_text: str, session_id: str) -> str:
+def _alert_name(key: str) -> str:
+    # basename + hash da chave completa: triggers com o mesmo nome em pastas
+    # diferentes não se sobrescrevem, e a mesma entrada gera sempre o mesmo nome
+    return f"{_basename_no_ext(key)}-{hashlib.sha256(key.encode('utf-8')).hexdigest()[:8]}"
+
+def _s3_refs(record: Dict[str, Any]) -> List[Tuple[str, str]]:
+    """
+    Extrai os pares (bucket, key) de um record, aceitando:
+      - notificação S3 direta  (record["s3"])
+      - mensagem SQS com o evento S3 no body  (record["body"])
+      - evento EventBridge "Object Created"  (record["detail"])
+    """
+    if "s3" in record:
+        return [(record["s3"]["bucket"]["name"], unquote_plus(record["s3"]["object"]["key"]))]
+    if "detail" in record:
+        return [(record["detail"]["bucket"]["name"], record["detail"]["object"]["key"])]
+    if "body" in record:
+        body = json.loads(record["body"])
+        refs = []
+        for inner in body.get("Records", [body]):
+            refs.extend(_s3_refs(inner))
+        return refs
+    raise KeyError("s3")
+
+def _record_id(record: Dict[str, Any], index: int) -> str:
+    """Identificador usado no batchItemFailures (messageId no SQS, id no EventBridge)."""
+    if record.get("messageId"):
+        return record["messageId"]
+    if record.get("id"):
+        return record["id"]
+    try:
+        return record["s3"]["object"]["key"]
+    except (KeyError, TypeError):
+        return str(index)
+
+def _parse_trigger_txt(content: str) -> Dict[str, str]:
+    """
+    Lê o .txt gerado por send_trigger_txt: 1ª linha = mensagem, restantes "chave=valor".
+    """
+    lines = [ln.strip() for ln in content.splitlines() if ln.strip()]
+    fields = {"message": lines[0] if lines else ""}
+    for ln in lines[1:]:
+        k, sep, v = ln.partition("=")
+        if sep:
+            fields[k.strip()] = v.strip()
+    return fields
+
+def _trigger_event(fields: Dict[str, str], ts: float) -> Dict[str, Any]:
+    """Evento no formato do RuleEngine: campos numéricos do .txt viram leituras."""
+    readings = {}
+    for k, v in fields.items():
+        try:
+            readings[k] = float(v)
+        except ValueError:
+            pass
+    return {
+        "ts": ts,
+        "trigger_key": fields.get("trigger_key", ""),
+        "farm_id": fields.get("farm_id", "default"),
+        "house_id": fields.get("house_id", "default"),
+        "readings": readings,
+    }
+
+def invoke_agent_stream(input_text: str, session_id: str, end_session: bool = False) -> Iterator[str]:
     """
     Invoca o Agent do Amazon Bedrock na região definida em AGENT_REGION.
-    Retorna a resposta final (string concatenada do stream).
+    Gera os pedaços de texto à medida que chegam do stream "completion".
+    end_session=True fecha a sessão no Agent depois desta resposta.
     """
     if not AGENT_ID or "REPLACE_WITH" in AGENT_ID:
         raise RuntimeError("AGENT_ID não configurado. Preencha AGENT_ID no topo do script.")
     if not AGENT_ALIAS_ID or "REPLACE_WITH" in AGENT_ALIAS_ID:
         raise RuntimeError("AGENT_ALIAS_ID não configurado. Preencha AGENT_ALIAS_ID no topo do script.")
 
-    agent_rt = boto3.client("bedrock-agent-runtime", region_name=AGENT_REGION)
-
-    resp = agent_rt.invoke_agent(
+    resp = _agent_rt().invoke_agent(
         agentId=AGENT_ID,
         agentAliasId=AGENT_ALIAS_ID,
         sessionId=session_id,
         inputText=input_text,
-        endSession=False,
+        endSession=end_session,
         enableTrace=False,
         sessionState={}
     )
 
-    chunks = []
     for event in resp.get("completion", []):
         if "chunk" in event:
-            chunks.append(event["chunk"]["bytes"].decode("utf-8"))
+            yield event["chunk"]["bytes"].decode("utf-8")
         elif "trace" in event:
             # Se quiser depurar, mude enableTrace=True e logue aqui
             pass
 
-    return "".join(chunks).strip()
+def invoke_agent(input_text: str, session_id: str) -> str:
+    """
+    Invoca o Agent e retorna a resposta final (string concatenada do stream).
+    """
+    return "".join(invoke_agent_stream(input_text, session_id)).strip()
+
+# ============================================================
+# REGRAS LOCAIS (estado de histerese/persistência por instância)
+# ============================================================
+_rule_engine = RuleEngine()
+_rule_lock = threading.Lock()
+
+_ACTION_PRIORITY = {"drop": 0, "escalate": 1, "alert": 2}
+
+def decide_locally(fields: Dict[str, str], rows: List[Dict[str, Any]] | None = None) -> Dict[str, Any]:
+    """
+    Decide um trigger (.txt) ou, com `rows`, todas as linhas de um lote .csb de uma
+    vez; no lote vale a decisão mais forte (alert > escalate > drop).
+    """
+    if not RULES_ENABLED or not fields.get("trigger_key"):
+        return {"action": "escalate", "rule": None, "message": None}
+    with _rule_lock:
+        if not rows:
+            return _rule_engine.evaluate(_trigger_event(fields, time.time()))
+        decisions = _rule_engine.evaluate_batch(rows)
+    return max(decisions, key=lambda d: _ACTION_PRIORITY[d["action"]])
+
+# ============================================================
+# CONTEXTO DO AGENT (sessões e memória recente por pavilhão, por instância)
+# ============================================================
+_agent_sessions = SessionPool(AGENT_SESSION_MAX_AGE_S, AGENT_SESSION_IDLE_S, AGENT_SESSION_MAX_TURNS)
+_house_context = HouseContext()
+_agent_scheduler = AgentScheduler(
+    max_concurrency=AGENT_MAX_CONCURRENCY,
+    tokens_per_s=AGENT_TOKENS_PER_S,
+    token_burst=AGENT_TOKEN_BURST,
+    max_wait_s=AGENT_MAX_WAIT_S,
+    max_attempts=AGENT_MAX_ATTEMPTS,
+    breaker=CircuitBreaker(
+        max_error_rate=AGENT_ERROR_BUDGET,
+        latency_budget_s=AGENT_LATENCY_BUDGET_S,
+        max_slow_rate=AGENT_SLOW_BUDGET,
+        open_s=AGENT_BREAKER_OPEN_S,
+    ),
+)
+
+def agent_lane(fields: Dict[str, str]) -> str:
+    trigger_key = fields.get("trigger_key", "")
+    return next((lane for lane, keys in AGENT_LANE_TRIGGERS.items() if trigger_key in keys), "warning")
+
+# ============================================================
+# DETECÇÃO DE ANOMALIAS (lotes .csb sem trigger)
+# ============================================================
+_anomaly_monitor = AnomalyMonitor()
+_anomaly_lock = threading.Lock()
+_TRIGGER_MESSAGES = dict(TRIGGER_MAP.values())
+
+def detect_anomalies(meta: Dict[str, Any], columns: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Alimenta os detectores do equipamento (device_id, ou o pavilhão) com o lote."""
+    device = meta.get("device_id") or f"{meta.get('farm_id', 'default')}/{meta.get('house_id', 'default')}"
+    with _anomaly_lock:
+        return _anomaly_monitor.ingest(device, columns)
+
+# ============================================================
+# ROLLUPS (agregados por pavilhão/trigger/intervalo; ver backend/rollups.py)
+# ============================================================
+_rollup_store = None
+
+def flush_rollups(rollups: RollupBuffer) -> int:
+    """Grava os deltas da invocação (compare-and-swap por arquivo) e marca os pavilhões novos."""
+    global _rollup_store
+    if _rollup_store is None:
+        _rollup_store = RollupStore(_s3(), OUTPUT_BUCKET, OUTPUT_PREFIX)
+    written = _rollup_store.flush(rollups)
+    mark_tenants(_s3(), OUTPUT_BUCKET, rollups.tenants(), OUTPUT_PREFIX)
+    return written
+
+# ============================================================
+# COMPACTAÇÃO (handler agendado; ver backend/s3_alerts.compact_alerts)
+# ============================================================
+def compaction_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    Compacta os alertas dos dias fechados em OUTPUT_BUCKET/OUTPUT_PREFIX.
+    event opcional: {"since": "YYYY-MM-DD"} para compactar o histórico antigo de uma vez.
+    """
+    since = (event or {}).get("since")
+    result = compact_alerts(
+        _s3(), OUTPUT_BUCKET, OUTPUT_PREFIX,
+        COMPACTION_MIN_AGE_DAYS, COMPACTION_LOOKBACK_DAYS, since=since,
+    )
+    logger.info("Compactação: %d dia(s), %d alerta(s), %d objeto(s) apagado(s)",
+                result["days"], result["alerts"], result["deleted"])
+    return result
+
+# ============================================================
+# SMS (fila com quota por destino; ver backend/sms_dispatcher.py)
+# ============================================================
+def spill_sms(dest: str, items: List[Dict[str, Any]]) -> None:
+    """Guarda na fila de reenvio os alertas de `dest` que não saíram (partidos em mensagens de até SMS_RETRY_MAX_BYTES)."""
+    spills = max(item.get("spills", 0) for item in items) + 1
+    chunks, size = [[]], 0
+    for item in items:
+        item = {**item, "spills": spills}
+        item_size = len(json.dumps(item, ensure_ascii=False).encode("utf-8")) + 1
+        if chunks[-1] and size + item_size > SMS_RETRY_MAX_BYTES:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(item)
+        size += item_size
+    for chunk in chunks:
+        _sqs().send_message(
+            QueueUrl=SMS_RETRY_QUEUE_URL,
+            MessageBody=json.dumps({"to": dest, "spills": spills, "items": chunk}, ensure_ascii=False),
+            DelaySeconds=SMS_RETRY_DELAY_S,
+        )
+
+_sms_dispatcher = SmsDispatcher(
+    publish=lambda phone_number, message: send_sms(message, phone_number, SENDER_ID),
+    routes=SMS_ROUTES,
+    default_to=[DESTINATION_NUMBER],
+    dest_rate_per_s=SMS_DEST_PER_HOUR / 3600,
+    dest_burst=SMS_DEST_BURST,
+    account_rate_per_s=SMS_ACCOUNT_TPS,
+    digest_window_s=SMS_DIGEST_WINDOW_S,
+    max_chars=SMS_MAX_CHARS,
+    max_attempts=SMS_MAX_ATTEMPTS,
+    # mesmo backend do dedup (memória ou DynamoDB), mas store própria: TTL e LRU à medida da janela
+    claim=lambda key: get_sms_claim_store().admit(f"sms|{key}", SMS_IDEMPOTENCY_TTL_S, time.time())[0],
+    spill=spill_sms if SMS_RETRY_QUEUE_URL else None,
+    unclaim=lambda key: get_sms_claim_store().forget(f"sms|{key}"),
+)
+
+_io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS)
+
+def sms_severity(fields: Dict[str, str], decision: Dict[str, Any]) -> str:
+    if decision["action"] == "alert" or fields.get("trigger_key") in SMS_CRITICAL_TRIGGERS:
+        return "critical"
+    return "warning"
+
+def idempotency_key(bucket: str, key: str, etag: str | None) -> str:
+    """Mesmo objeto de entrada (mesma versão) -> mesma chave, em qualquer tentativa."""
+    return hashlib.sha256(f"{bucket}/{key}@{etag or ''}".encode("utf-8")).hexdigest()[:32]
+
+def notify_sms(message: str, fields: Dict[str, str], decision: Dict[str, Any], idem_key: str | None = None) -> List[str]:
+    """Enfileira o SMS e envia já o que couber na quota; o resto sai no fim do handler."""
+    destinations = _sms_dispatcher.submit(
+        message,
+        trigger_key=fields.get("trigger_key", ""),
+        severity=sms_severity(fields, decision),
+        idempotency_key=idem_key,
+        farm_id=fields.get("farm_id", ""),
+    )
+    _sms_dispatcher.pump()
+    return destinations
+
+def drain_sms() -> int:
+    """Esvazia a fila de SMS no fim da invocação; um erro não falha o lote (o que não saiu vai para spill)."""
+    try:
+        return _sms_dispatcher.drain(SMS_DRAIN_WAIT_S)
+    except Exception:
+        logger.exception("Falha ao esvaziar a fila de SMS")
+        _sms_dispatcher.spill_pending()
+        return 0
+
+# ============================================================
+# DEDUP / COALESCING (antes do Agent)
+# ============================================================
+class MemoryDedupStore:
+    """
+    LRU com TTL no escopo do módulo: vale para as invocações quentes da mesma instância.
+    """
+
+    def __init__(self, max_entries: int = DEDUP_MAX_ENTRIES, ttl_s: float = DEDUP_TTL_S):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self._entries: "OrderedDict[str, Dict[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def admit(self, key: str, window_s: float, now: float) -> Tuple[bool, int]:
+        """
+        (True, n)  -> abre nova janela; n = esta ocorrência + repetições suprimidas na anterior.
+        (False, n) -> repetição dentro da janela; n = ocorrências acumuladas até agora.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and now - entry["seen_at"] > self.ttl_s:
+                entry = None
+            if entry is not None and now - entry["opened_at"] < window_s:
+                entry["count"] += 1
+                entry["seen_at"] = now
+                self._entries[key] = entry
+                return False, int(entry["count"])
+
+            suppressed = int(entry["count"]) - 1 if entry is not None else 0
+            self._entries[key] = {"opened_at": now, "seen_at": now, "count": 1}
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return True, 1 + suppressed
+
+    def forget(self, key: str) -> None:
+        """Apaga a chave (ex.: SMS reclamado que acabou descartado sem ser enviado)."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def release(self, key: str, opened_at: float, carried: int = 0) -> None:
+        """
+        Fecha a janela aberta em `opened_at` (o alerta não chegou a ser gravado):
+        a nova tentativa abre outra e recebe as ocorrências contadas até aqui,
+        mais as `carried` que a tentativa falhada levava da janela anterior.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["opened_at"] == opened_at:
+                entry["opened_at"] = float("-inf")
+                entry["count"] += carried
+
+class DynamoDedupStore:
+    """
+    Mesma semântica de MemoryDedupStore, partilhada entre instâncias via tabela
+    DynamoDB (ou qualquer endpoint compatível, ex.: DynamoDB Local em ENDPOINT_URLS).
+    """
+
+    def __init__(self, table: str = DEDUP_TABLE, ttl_s: float = DEDUP_TTL_S):
+        self.table = table
+        self.ttl_s = ttl_s
+
+    def admit(self, key: str, window_s: float, now: float) -> Tuple[bool, int]:
+        ddb = get_client("dynamodb")
+        expires_at = str(int(now + self.ttl_s))
+        try:
+            # abre a janela se não existir ou se a anterior já fechou
+            old = ddb.update_item(
+                TableName=self.table,
+                Key={"pk": {"S": key}},
+                UpdateExpression="SET opened_at = :now, #c = :one, expires_at = :exp",
+                ConditionExpression="attribute_not_exists(pk) OR opened_at < :cutoff",
+                ExpressionAttributeNames={"#c": "count"},
+                ExpressionAttributeValues={
+                    ":now": {"N": repr(now)},
+                    ":one": {"N": "1"},
+                    ":exp": {"N": expires_at},
+                    ":cutoff": {"N": repr(now - window_s)},
+                },
+                ReturnValues="ALL_OLD",
+            ).get("Attributes") or {}
+            suppressed = 0
+            if old and float(old["expires_at"]["N"]) > now:
+                suppressed = int(old["count"]["N"]) - 1
+            return True, 1 + suppressed
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+                raise
+        new = ddb.update_item(
+            TableName=self.table,
+            Key={"pk": {"S": key}},
+            UpdateExpression="ADD #c :one SET expires_at = :exp",
+            ExpressionAttributeNames={"#c": "count"},
+            ExpressionAttributeValues={":one": {"N": "1"}, ":exp": {"N": expires_at}},
+            ReturnValues="UPDATED_NEW",
+        )["Attributes"]
+        return False, int(new["count"]["N"])
+
+    def forget(self, key: str) -> None:
+        get_client("dynamodb").delete_item(TableName=self.table, Key={"pk": {"S": key}})
+
+    def release(self, key: str, opened_at: float, carried: int = 0) -> None:
+        try:
+            # só a janela que esta tentativa abriu (outra instância pode já ter aberto a seguinte)
+            get_client("dynamodb").update_item(
+                TableName=self.table,
+                Key={"pk": {"S": key}},
+                UpdateExpression="SET opened_at = :closed ADD #c :carried",
+                ConditionExpression="opened_at = :opened",
+                ExpressionAttributeNames={"#c": "count"},
+                ExpressionAttributeValues={
+                    ":closed": {"N": "0"},
+                    ":carried": {"N": str(carried)},
+                    ":opened": {"N": repr(opened_at)},
+                },
+            )
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+                raise
+
+_dedup_store = None
+_sms_claim_store = None
+
+def get_dedup_store() -> Any:
+    global _dedup_store
+    if _dedup_store is None:
+        _dedup_store = DynamoDedupStore() if DEDUP_BACKEND == "dynamodb" else MemoryDedupStore()
+    return _dedup_store
+
+def get_sms_claim_store() -> Any:
+    """Chaves de idempotência dos SMS: lembradas por SMS_IDEMPOTENCY_TTL_S, não por DEDUP_TTL_S."""
+    global _sms_claim_store
+    if _sms_claim_store is None:
+        if DEDUP_BACKEND == "dynamodb":
+            _sms_claim_store = DynamoDedupStore(ttl_s=SMS_IDEMPOTENCY_TTL_S)
+        else:
+            _sms_claim_store = MemoryDedupStore(SMS_CLAIM_MAX_ENTRIES, SMS_IDEMPOTENCY_TTL_S)
+    return _sms_claim_store
+
+def dedup_key(fields: Dict[str, str]) -> str:
+    return "|".join((
+        fields.get("trigger_key", ""),
+        fields.get("farm_id", "default"),
+        fields.get("house_id", "default"),
+    ))
+
+# ============================================================
+# CACHE DE RESPOSTAS DO AGENT
+# ============================================================
+_ISO_TS = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}(:\d{2}(\.\d+)?)?Z?")  # o prompt compacto corta nos minutos
+_HHMM = re.compile(r"(@|^prev )\d{2}:\d{2}\b")  # horas do prompt compacto: "recent: x=1@HH:MM", "prev HH:MM ..."
+
+class TTLCache:
+    """LRU limitado por tamanho, com expiração por entrada."""
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl_s: float = CACHE_TTL_S):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, now: float | None = None) -> Any:
+        now = time.time() if now is None else now
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            stored_at, value = item
+            if now - stored_at > self.ttl_s:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: Any, now: float | None = None) -> None:
+        now = time.time() if now is None else now
+        with self._lock:
+            self._entries[key] = (now, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+_answer_cache = TTLCache()
+
+def prompt_fingerprint(prompt: str) -> str:
+    """
+    Hash do prompt sem campos voláteis (generated_at, timestamps ISO e as horas
+    HH:MM do prompt compacto), para que triggers que só diferem no horário
+    partilhem a mesma resposta.
+    """
+    lines = []
+    for ln in prompt.splitlines():
+        ln = ln.strip()
+        if not ln:
+            continue
+        k, sep, _ = ln.partition("=")
+        if sep and k.strip() in VOLATILE_FIELDS:
+            continue
+        lines.append(_HHMM.sub(r"\1", _ISO_TS.sub("", ln)).lower())
+    first, rest = (lines[0], sorted(lines[1:])) if lines else ("", [])
+    return hashlib.sha256("\n".join([first, *rest]).encode("utf-8")).hexdigest()
+
+def cached_answer(fingerprint: str) -> str | None:
+    answer = _answer_cache.get(fingerprint)
+    if answer is not None or not CACHE_S3_PREFIX:
+        return answer
+    try:
+        obj = _s3().get_object(Bucket=OUTPUT_BUCKET, Key=f"{CACHE_S3_PREFIX}{fingerprint}.json")
+        entry = json.loads(obj["Body"].read())
+    except (ClientError, BotoCoreError, ValueError):
+        return None
+    if time.time() - entry.get("cached_at", 0) > CACHE_TTL_S:
+        return None
+    _answer_cache.put(fingerprint, entry["answer"])
+    return entry["answer"]
+
+def store_answer(fingerprint: str, answer: str) -> None:
+    _answer_cache.put(fingerprint, answer)
+    if not CACHE_S3_PREFIX:
+        return
+    try:
+        _s3().put_object(
+            Bucket=OUTPUT_BUCKET,
+            Key=f"{CACHE_S3_PREFIX}{fingerprint}.json",
+            Body=json.dumps({"cached_at": time.time(), "answer": answer}, ensure_ascii=False).encode("utf-8"),
+            ContentType="application/json; charset=utf-8",
+        )
+    except (ClientError, BotoCoreError):
+        # camada persistente é só otimização: o Agent já respondeu, o record segue
+        logger.warning("Falha ao gravar a resposta em cache (%s)", fingerprint[:12], exc_info=True)
+
+# ============================================================
+# REENVIO DE SMS (handler da fila SMS_RETRY_QUEUE_URL)
+# ============================================================
+def sms_retry_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    Devolve ao dispatcher os alertas guardados na fila de reenvio e esvazia-o;
+    o que ainda não couber na quota volta para a fila com mais um reenvio.
+    Mensagens acima de SMS_RETRY_MAX reenvios (ou ilegíveis) saem em
+    batchItemFailures e a redrive policy manda-as para a DLQ.
+    """
+    failures = []
+    records = (event or {}).get("Records") or []
+    for index, record in enumerate(records):
+        try:
+            body = json.loads(record["body"])
+            if body["spills"] > SMS_RETRY_MAX:
+                raise ValueError(f"{body['spills']} reenvios (máximo {SMS_RETRY_MAX})")
+            _sms_dispatcher.requeue(body["to"], body["items"])
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error("Reenvio de SMS recusado (%s): %s", _record_id(record, index), e)
+            failures.append({"itemIdentifier": _record_id(record, index)})
+    sent = drain_sms()
+    logger.info("Reenvio de SMS: %d mensagem(ns), %d SMS enviado(s), %d pendente(s)",
+                len(records), sent, _sms_dispatcher.pending())
+    return {"sent": sent, "pending": _sms_dispatcher.pending(), "batchItemFailures": failures}
 
 # ============================================================
 # LAMBDA HANDLER
@@ -113,66 +783,27 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             }
         ]
     }
-    """
 
-    try:
-        logger.info(event)
-
-        # 1) Parâmetros mínimos do evento
-        bucket = event["Records"][0]["s3"]["bucket"]["name"]
-        key = event["Records"][0]["s3"]["object"]["key"]
-
-        # 2) Ler arquivo de entrada do S3
-        logger.info(f"Lendo s3://{bucket}/{key}")
-        s3_obj = s3.get_object(Bucket=bucket, Key=key)
-        file_content = s3_obj["Body"].read().decode("utf-8")
-
-        # 3) Montar prompt
-        prompt = file_content
-
-        # 4) Invocar Agent
-        session_id = str(uuid.uuid4())
-        logger.info(f"Invocando Agent {AGENT_ID}/{AGENT_ALIAS_ID} na região {AGENT_REGION} (session={session_id})")
-        answer = invoke_agent(prompt, session_id)  # string final
-
-        logger.info(f"AI Agent answer: {answer}")
-
-        # 5) Salvar saída no S3 (alerts/{basename}.json)
-        out_key = f"alerts/{_basename_no_ext(key)}.json"
-        payload = {
-            "generated_at": datetime.utcnow().isoformat() + "Z",
-            "agent": {
-                "agentId": AGENT_ID,
-                "agentAliasId": AGENT_ALIAS_ID,
-                "region": AGENT_REGION,
-                "sessionId": session_id
-            },
-            "source": {"bucket": bucket, "key": key},
-            "alert": answer
-        }
-
-        logger.info(f"Gravando s3://{OUTPUT_BUCKET}/{out_key}")
-        s3.put_object(
-            Bucket=OUTPUT_BUCKET,
-            Key=out_key,
-            Body=json.dumps(payload, ensure_ascii=False, indent=2).encode("utf-8"),
-            ContentType="application/json; charset=utf-8"
-        )
+    Todos os records são processados (S3 direto, SQS ou EventBridge). A resposta
+    traz o resultado de cada record e um "batchItemFailures" só com os que falharam
+    por erro interno (5xx), para que apenas esses sejam reenviados; records
+    inválidos (400) ficam no resultado, mas não voltam à fila.
+    """
 
+    global _cold
+    cold, _cold = _cold, False
+    trace = Trace()
+    if context is not None:
+        trace.set("request_id", getattr(context, "aws_request_id", None))
 
-        logger.info(f"A enviar SMS...")
-        sms_response = send_sms(payload["alert"], DESTINATION_NUMBER, SENDER_ID)
-        
-        logger.info(f"SMS sent successfully. MessageId: {sms_response.get('MessageId')}")
-
-        return {
-            "statusCode": 200,
-            "body": json.dumps({
-                "message": "Success",
-                "output_s3": f"s3://{OUTPUT_BUCKET}/{out_key}",
-                "preview": answer[:300],
-            }, ensure_ascii=False)
-        }
+    try:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Evento: %s", json.dumps(event, default=str))
+        records = event["Records"]
+        if not records:
+            raise KeyError("Records")
+        if not isinstance(records, list):
+            raise TypeError(f"Records must be a list, got {type(records).__name__}")
 
     except KeyError as e:
         msg = f"Missing required parameter: {str(e)}"
@@ -180,9 +811,377 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         return {"statusCode": 400, "body": json.dumps({"error": "Bad Request", "message": msg})}
 
     except Exception as e:
+        # evento malformado (não é dict, Records de outro tipo...): mesma resposta genérica de antes
         logger.exception("Erro inesperado")
         return {"statusCode": 500, "body": json.dumps({"error": "Internal Server Error", "message": str(e)})}
 
+    logger.info("Invocação com %d record(s)%s", len(records), " (cold start)" if cold else "")
+    trace.count("records", len(records))
+    trace.count("cold_start", int(cold))
+
+    profiler = None
+    if PROFILE_ENABLED:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        return _handle_records(records, trace)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            _log_profile(profiler)
+        trace.timing("handler_ms", (time.perf_counter() - trace.started) * 1000)
+        # frias sempre; quentes por amostragem (o print não entra no caminho de cada record)
+        if cold or sampled(METRICS_SAMPLE_RATE):
+            print(trace.to_emf(METRICS_NAMESPACE, {"Function": METRICS_FUNCTION}))
+
+def _handle_records(records: List[Dict[str, Any]], trace: Trace) -> Dict[str, Any]:
+    # Todos os records do lote, em paralelo (pool limitado por MAX_WORKERS)
+    rollups = RollupBuffer(ROLLUP_RESOLUTIONS) if ROLLUPS_ENABLED else None
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(records))) as pool:
+        results = list(pool.map(
+            _process_record, records, range(len(records)), [trace] * len(records), [rollups] * len(records)
+        ))
+
+    # Catálogo (global e por pavilhão): 1 parte por dia para a invocação inteira + ponteiro _latest.json.
+    # Falhar aqui não reenvia o lote (os alertas já foram gravados; o índice pode ser refeito).
+    # Em paralelo com o esvaziar da fila de SMS (resumos por destino; o que exceder a
+    # quota vai para a fila de reenvio). Como o catálogo, falhar aqui não reenvia o lote.
+    entries = [o.pop("_index_entry") for r in results for o in r.get("outputs", []) if "_index_entry" in o]
+    t_index = time.perf_counter()
+    index_future = _io_pool.submit(write_tenant_indexes, _s3(), OUTPUT_BUCKET, entries, OUTPUT_PREFIX)
+    rollup_future = _io_pool.submit(flush_rollups, rollups) if rollups else None
+    with trace.span("sms_drain"):
+        trace.count("sms_sent", drain_sms())
+    try:
+        index_future.result()
+    except Exception:
+        logger.exception("Falha ao atualizar o catálogo de alertas")
+    trace.timing("index_ms", (time.perf_counter() - t_index) * 1000)
+    if rollup_future is not None:
+        # como o catálogo: falhar aqui não reenvia o lote (os agregados só perdem estes deltas)
+        try:
+            trace.count("rollup_files", rollup_future.result())
+        except Exception:
+            logger.exception("Falha ao atualizar os rollups")
+        trace.timing("rollups_ms", (time.perf_counter() - t_index) * 1000)
+    trace.count("sms_pending", _sms_dispatcher.pending())
+
+    # só os erros 5xx voltam à fila; um 400 (record inválido) falharia igual em cada tentativa
+    failures = [{"itemIdentifier": r["itemIdentifier"]} for r in results if r["statusCode"] >= 500]
+    rejected = sum(1 for r in results if 400 <= r["statusCode"] < 500)
+    trace.count("failed_records", len(failures))
+    trace.count("rejected_records", rejected)
+    if not failures and not rejected:
+        status, message = 200, "Success"
+    elif len(failures) + rejected < len(results):
+        status, message = 207, "Partial failure"
+    else:
+        status, message = 500, "Failure"
+
+    return {
+        "statusCode": status,
+        "body": json.dumps({"message": message, "results": results}, ensure_ascii=False),
+        # formato aceito pelo ReportBatchItemFailures (SQS/Kinesis): só os falhados voltam à fila
+        "batchItemFailures": failures,
+    }
+
+def _log_profile(profiler: Any) -> None:
+    import io
+    import pstats
+
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+    logger.info("Profile (top %d por tempo acumulado):\n%s", PROFILE_TOP_N, out.getvalue())
+
+def _process_record(
+    record: Dict[str, Any], index: int, trace: Trace | None = None, rollups: RollupBuffer | None = None
+) -> Dict[str, Any]:
+    """
+    Processa um record do lote e devolve o resultado individual.
+    Nunca levanta exceção: erros viram statusCode 400/500 no próprio resultado.
+    Os agregados do record só entram em `rollups` se ele tiver sucesso (um record
+    reenviado não conta duas vezes).
+    """
+    item_id = _record_id(record, index)
+    trace = trace or NullTrace()
+    local = RollupBuffer(rollups.resolutions) if rollups is not None else None
+    try:
+        with trace.span("record"):
+            outputs = [process_object(bucket, key, trace, local) for bucket, key in _s3_refs(record)]
+        if rollups is not None:
+            rollups.merge(local)
+        return {"itemIdentifier": item_id, "statusCode": 200, "outputs": outputs}
+
+    except KeyError as e:
+        msg = f"Missing required parameter: {str(e)}"
+        logger.error("[%s] %s", item_id, msg)
+        return {"itemIdentifier": item_id, "statusCode": 400, "error": "Bad Request", "message": msg}
+
+    except ValueError as e:
+        # conteúdo inválido (farm_id/house_id fora do formato, lote .csb corrompido...):
+        # outra tentativa falharia igual, por isso não volta à fila
+        logger.error("[%s] %s", item_id, e)
+        return {"itemIdentifier": item_id, "statusCode": 400, "error": "Bad Request", "message": str(e)}
+
+    except Exception as e:
+        logger.exception("[%s] Erro inesperado", item_id)
+        return {"itemIdentifier": item_id, "statusCode": 500, "error": "Internal Server Error", "message": str(e)}
+
+def process_object(
+    bucket: str, key: str, trace: Trace | None = None, rollups: RollupBuffer | None = None
+) -> Dict[str, Any]:
+    """
+    Pipeline de um objeto de trigger: lê do S3, aplica regras locais e dedup,
+    invoca o Agent (em stream), enfileira o SMS e grava
+    alerts/<shard>/<farm>/<house>/{basename}-{hash}.json.
+    Cada etapa é cronometrada em `trace` (<etapa>_ms); o trigger e as leituras
+    entram em `rollups` (todos, inclusive os descartados/repetidos).
+    Se algo falhar antes de o alerta ficar gravado, a janela de dedup aberta
+    por este objeto é fechada: a nova tentativa não volta como repetição.
+    """
+    claims: List[Any] = []
+    try:
+        return _process_object(bucket, key, trace or NullTrace(), rollups, claims)
+    except BaseException:
+        for release in claims:
+            try:
+                release()
+            except Exception:
+                logger.exception("Falha ao libertar a janela de dedup de s3://%s/%s", bucket, key)
+        raise
+
+def _process_object(
+    bucket: str, key: str, trace: Trace, rollups: RollupBuffer | None, claims: List[Any]
+) -> Dict[str, Any]:
+    # 1) Ler arquivo de entrada do S3
+    logger.info("Lendo s3://%s/%s", bucket, key)
+    with trace.span("s3_read"):
+        s3_obj = _s3().get_object(Bucket=bucket, Key=key)
+        body = s3_obj["Body"].read()
+    trace.count("input_bytes", len(body))
+    idem_key = idempotency_key(bucket, key, s3_obj.get("ETag"))
+    rows = None
+    batch_stats = None
+    if is_sensor_batch(body):
+        # lote binário de leituras: decodificado sem cópia; o prompt é um resumo
+        with trace.span("decode"):
+            meta, columns = decode_batch(body)
+        if rollups is not None:
+            with trace.span("rollup"):
+                rollups.add_columns(*tenant_of(meta), columns)
+        if not meta.get("trigger_key"):
+            # leituras puras: só viram trigger se os detectores acharem mudança significativa
+            with trace.span("anomaly"):
+                anomalies = detect_anomalies(meta, columns)
+            if not anomalies:
+                logger.info("Lote de %d leituras ingerido (sem anomalias)", len(columns["ts"]))
+                trace.count("ingested")
+                return {"source": f"s3://{bucket}/{key}", "ingested": len(columns["ts"])}
+            first = anomalies[0]["trigger_key"]
+            meta = {
+                **meta,
+                "message": _TRIGGER_MESSAGES[first],
+                "trigger_key": first,
+                "anomalies": ",".join(f"{a['trigger_key']}:{a['signal']}:{a['reason']}" for a in anomalies),
+            }
+        rows = batch_rows(meta, columns)
+        batch_stats = column_stats(columns)
+        file_content = summarize_batch(meta, columns)
+    else:
+        file_content = body.decode("utf-8")
+    fields = _parse_trigger_txt(file_content)
+    farm_id, house_id = tenant_of(fields)
+    fields.update(farm_id=farm_id, house_id=house_id)
+    ev_ts = event_ts(fields, time.time())
+    readings = event_readings(fields)
+    if rollups is not None and fields.get("trigger_key"):
+        rollups.add_event(farm_id, house_id, fields["trigger_key"], ev_ts, readings)
+    _house_context.note_readings(
+        farm_id, house_id, ev_ts, {**{n: st["last"] for n, st in (batch_stats or {}).items()}, **readings}
+    )
+
+    # 2) Regras locais: descartar, alertar direto ou seguir para o Agent
+    with trace.span("rules"):
+        decision = decide_locally(fields, rows)
+    if decision["action"] == "drop":
+        logger.info("Trigger descartado pela regra %s", decision["rule"])
+        trace.count("dropped")
+        return {"source": f"s3://{bucket}/{key}", "dropped": True, "rule": decision["rule"]}
+    decided_locally = decision["action"] == "alert"
+
+    # 3) Dedup: repetições dentro da janela não chamam o Agent nem enviam SMS
+    occurrences = 1
+    if not decided_locally and DEDUP_WINDOW_S > 0 and fields.get("trigger_key"):
+        opened_at = time.time()
+        with trace.span("dedup"):
+            admitted, occurrences = get_dedup_store().admit(dedup_key(fields), DEDUP_WINDOW_S, opened_at)
+        if not admitted:
+            logger.info("Trigger %s repetido na janela (%d ocorrências); ignorado", dedup_key(fields), occurrences)
+            trace.count("coalesced")
+            return {"source": f"s3://{bucket}/{key}", "coalesced": True, "occurrences": occurrences}
+        # a janela só fica de pé com o alerta gravado (ver process_object)
+        claims.append(lambda: get_dedup_store().release(dedup_key(fields), opened_at, occurrences - 1))
+
+    # 4) Montar prompt
+    prompt = file_content
+    if occurrences > 1:
+        prompt = f"{prompt.rstrip()}\noccurrences={occurrences}\n"
+
+    # 5) Invocar Agent (ou usar a mensagem da regra / resposta em cache p/ o mesmo prompt enviado)
+    if decided_locally:
+        answer = decision["message"]
+    else:
+        # Sessão do pavilhão/família: o Agent já tem os turnos anteriores, o prompt só leva o que é novo
+        lease = _agent_sessions.acquire(farm_id, house_id, trigger_family(fields.get("trigger_key", "")))
+        agent_prompt = prompt
+        sent_upto = _house_context.last_seq()
+        if COMPACT_PROMPTS:
+            agent_prompt = build_prompt(
+                fields, readings, batch_stats, occurrences,
+                recent_readings=_house_context.readings(farm_id, house_id),
+                history=_house_context.history(farm_id, house_id, lease.seen, skip_session=lease.session_id),
+                budget_tokens=PROMPT_TOKEN_BUDGET,
+                max_history=PROMPT_MAX_HISTORY,
+            )
+        # chave = o que o Agent recebe: o mesmo trigger com outro contexto (leituras, histórico) não partilha resposta
+        fingerprint = prompt_fingerprint(agent_prompt)
+        answer = cached_answer(fingerprint) if CACHE_TTL_S > 0 else None
+    cache_hit = answer is not None and not decided_locally
+    session_id = None
+    sms_to = None
+    metrics: Dict[str, Any] = {}
+    if decided_locally:
+        logger.info("Regra %s decidiu localmente; Agent não invocado", decision["rule"])
+        trace.count("decided_locally")
+    elif cache_hit:
+        _agent_sessions.cancel(lease)
+        logger.info("Cache hit %s; Agent não invocado", fingerprint[:12])
+        trace.count("cache_hit")
+    else:
+        session_id = lease.session_id
+        lane = agent_lane(fields)
+        logger.info("Invocando Agent %s/%s na região %s (session=%s, end=%s, lane=%s)",
+                    AGENT_ID, AGENT_ALIAS_ID, AGENT_REGION, session_id, lease.end_session, lane)
+
+        def stream_answer():
+            # repetida pelo scheduler em caso de throttling: recomeça do zero
+            # (um SMS já enviado a meio do stream não se repete: leva idem_key)
+            nonlocal sms_to
+            t0 = time.perf_counter()
+            first_chunk_at = None
+            parts: List[str] = []
+            size = 0
+            for chunk in invoke_agent_stream(agent_prompt, session_id, lease.end_session):
+                if first_chunk_at is None:
+                    first_chunk_at = time.perf_counter()
+                parts.append(chunk)
+                size += len(chunk)
+                # SMS sai logo que houver texto suficiente; o resto do stream só vai para o S3
+                if STREAM_SMS and sms_to is None and size >= SMS_MAX_CHARS:
+                    prefix = "".join(parts).strip()
+                    if len(prefix) >= SMS_MAX_CHARS:
+                        logger.info("A enviar SMS (stream ainda em curso)...")
+                        sms_to = notify_sms(prefix[:SMS_MAX_CHARS], fields, decision, idem_key)
+            return parts, size, t0, first_chunk_at
+
+        queued_at = time.perf_counter()
+        try:
+            parts, size, t0, first_chunk_at = _agent_scheduler.run(stream_answer, lane, estimate_tokens(agent_prompt))
+        except AgentUnavailable as e:
+            _agent_sessions.release(lease, ok=False)
+            logger.warning("Agent indisponível (%s); alerta de modelo", e)
+            trace.count("agent_fallback")
+            answer = fallback_message(fields, readings)
+            session_id = None
+            metrics = {"fallback": str(e), "lane": lane}
+        except BaseException:
+            _agent_sessions.release(lease, ok=False)  # sessão em estado desconhecido: a próxima começa outra
+            raise
+        else:
+            _agent_sessions.release(lease, ok=True, seen=sent_upto)
+            answer = "".join(parts).strip()
+            metrics = {
+                "time_to_first_chunk_ms": round((first_chunk_at - t0) * 1000, 1) if first_chunk_at else None,
+                "stream_ms": round((time.perf_counter() - t0) * 1000, 1),
+                "chunks": len(parts),
+                "prompt_tokens": estimate_tokens(agent_prompt),
+                "session_turn_end": lease.end_session,
+                "lane": lane,
+            }
+            trace.count("prompt_tokens", metrics["prompt_tokens"])
+            trace.count("prompt_tokens_raw", estimate_tokens(prompt))
+            trace.count("agent_calls")
+            trace.count("agent_chunks", len(parts))
+            trace.count("agent_bytes", size)
+            trace.timing("agent_ms", metrics["stream_ms"])
+            trace.timing("agent_wait_ms", (t0 - queued_at) * 1000)  # fila + backoff de throttling
+            if metrics["time_to_first_chunk_ms"] is not None:
+                trace.timing("agent_ttfc_ms", metrics["time_to_first_chunk_ms"])
+            if CACHE_TTL_S > 0 and answer:
+                store_answer(fingerprint, answer)
+
+    logger.info("AI Agent answer: %s", answer)
+    _house_context.note_decision(
+        farm_id, house_id, ev_ts, fields.get("trigger_key", ""),
+        "alert" if decided_locally else "cached" if cache_hit else "fallback" if "fallback" in metrics else "agent",
+        decision["rule"], session_id,
+    )
+
+    # 6) Salvar saída no S3 (alerts/<shard>/<farm>/<house>/{basename}-{hash}.json) e 7) SMS em paralelo:
+    # o caminho crítico passa a ser max(S3, SNS). A chave de saída é determinística
+    # e o SMS leva idem_key, por isso uma nova tentativa não duplica nada.
+    out_key = f"{OUTPUT_PREFIX}{tenant_prefix(farm_id, house_id)}{_alert_name(key)}.json"
+    payload = {
+        "generated_at": datetime.utcnow().isoformat() + "Z",
+        "agent": {
+            "agentId": AGENT_ID,
+            "agentAliasId": AGENT_ALIAS_ID,
+            "region": AGENT_REGION,
+            "sessionId": session_id
+        },
+        "source": {"bucket": bucket, "key": key},
+        "trigger_key": fields.get("trigger_key"),
+        "farm_id": farm_id,
+        "house_id": house_id,
+        "occurrences": occurrences,
+        "cache_hit": cache_hit,
+        "decision": {"action": decision["action"], "rule": decision["rule"]},
+        "metrics": metrics,
+        "idempotency_key": idem_key,
+        "alert": answer
+    }
+
+    logger.info("Gravando s3://%s/%s", OUTPUT_BUCKET, out_key)
+    put_future = _io_pool.submit(
+        _timed_put,
+        trace,
+        Bucket=OUTPUT_BUCKET,
+        Key=out_key,
+        Body=json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+        ContentType="application/json; charset=utf-8"
+    )
+
+    # SMS (se ainda não saiu durante o stream): vai para a fila do dispatcher
+    if sms_to is None:
+        with trace.span("sms_enqueue"):
+            sms_to = notify_sms(answer[:SMS_MAX_CHARS], fields, decision, idem_key)
+    logger.info("SMS enfileirado para %s", ", ".join(sms_to))
+
+    put_future.result()
+
+    return {
+        "source": f"s3://{bucket}/{key}",
+        "output_s3": f"s3://{OUTPUT_BUCKET}/{out_key}",
+        "cache_hit": cache_hit,
+        "preview": answer[:300],
+        "_index_entry": index_entry(out_key, payload),  # consumido pelo handler
+    }
+
+def _timed_put(trace: Trace, **kwargs) -> Any:
+    with trace.span("s3_write"):
+        return _s3().put_object(**kwargs)
+
 def send_sms(message: str, phone_number: str, sender_id: str) -> Dict[str, Any]:
     """
     Send SMS using Amazon SNS.
@@ -213,7 +1212,7 @@ def send_sms(message: str, phone_number: str, sender_id: str) -> Dict[str, Any]:
         }
         
         # Send the SMS
-        response = sns_client.publish(
+        response = _sns().publish(
             PhoneNumber=phone_number,
             Message=message,
             MessageAttributes=message_attributes
@@ -222,5 +1221,5 @@ def send_sms(message: str, phone_number: str, sender_id: str) -> Dict[str, Any]:
         return response
         
     except ClientError as e:
-        logger.error(f"Failed to send SMS: {e}")
+        logger.error("Failed to send SMS: %s", e)
         raise